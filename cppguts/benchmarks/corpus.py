@@ -0,0 +1,163 @@
+import os
+
+
+def get_method_qualifiers(method_idx: int) -> (str, str):
+    '''
+    Get method declaration qualifiers. Every third method is static, every third is const.
+    :param method_idx: method number
+    :return: prefix, suffix - e.g. (`static `, ``) or (``, ` const`)
+    '''
+    if method_idx % 3 == 0:
+        return 'static ', ''
+    if method_idx % 3 == 1:
+        return '', ' const'
+    return '', ''
+
+
+def get_method_body(class_idx: int, method_idx: int, variant: int, indent: str) -> list:
+    return [f'{indent}{{',
+            f'{indent}  int result = a * {method_idx} + {class_idx};',
+            f'{indent}  result += static_cast<int>(b) - {variant};',
+            f'{indent}  return result;',
+            f'{indent}}}']
+
+
+def generate_header(directory: str, depth: int, include_depth: int) -> str:
+    '''
+    Generate header that is included by the previous one so that `include_depth` headers are parsed.
+    :return: filename
+    '''
+    filename = os.path.join(directory, f'header_{depth}.h')
+    lines = [f'#ifndef CPPGUTS_BENCHMARK_HEADER_{depth}_H',
+             f'#define CPPGUTS_BENCHMARK_HEADER_{depth}_H']
+    if depth + 1 < include_depth:
+        lines.append(f'#include "header_{depth + 1}.h"')
+    lines.append(f'namespace header_{depth} {{')
+    for i in range(20):
+        lines.append(f'struct Helper_{i} {{')
+        lines.append(f'  int value(int a) const {{ int v = a; for (int k = 0; k < {i}; ++k) v += k; return v; }}')
+        lines.append(f'  static double scale(double b) {{ return b * {i + 1}; }}')
+        lines.append('};')
+    lines.append('}')
+    lines.append('#endif')
+    with open(filename, mode='w') as file:
+        file.write('\n'.join(lines) + '\n')
+    return filename
+
+
+def generate_tu(filename: str, nclasses: int, nmethods: int, nnamespaces: int,
+                out_of_class: int, include_depth: int, variant: int):
+    '''
+    Generate translation unit with classes distributed over namespaces. First `out_of_class`
+    methods of every class are defined outside of the class, the others are defined inside.
+    Method bodies depend on `variant` so that source and destination differ only by bodies.
+    '''
+    lines = []
+    if include_depth > 0:
+        lines.append('#include "header_0.h"')
+        lines.append('')
+    nnamespaces = max(nnamespaces, 1)
+    for ns_idx in range(nnamespaces):
+        lines.append(f'namespace ns_{ns_idx} {{')
+        lines.append('')
+        for class_idx in range(ns_idx, nclasses, nnamespaces):
+            lines.append(f'class Class_{class_idx} {{')
+            lines.append('public:')
+            for method_idx in range(nmethods):
+                prefix, suffix = get_method_qualifiers(method_idx)
+                declaration = f'  {prefix}int method_{method_idx}(int a, double b){suffix}'
+                if method_idx < out_of_class:
+                    lines.append(declaration + ';')
+                else:
+                    lines.append(declaration)
+                    lines.extend(get_method_body(class_idx, method_idx, variant, '  '))
+            lines.append('};')
+            lines.append('')
+            for method_idx in range(min(out_of_class, nmethods)):
+                _, suffix = get_method_qualifiers(method_idx)
+                lines.append(f'int Class_{class_idx}::method_{method_idx}(int a, double b){suffix}')
+                lines.extend(get_method_body(class_idx, method_idx, variant, ''))
+                lines.append('')
+        lines.append('}')
+        lines.append('')
+    with open(filename, mode='w') as file:
+        file.write('\n'.join(lines))
+
+
+def generate_corpus(directory: str, nclasses: int = 10, nmethods: int = 10, nnamespaces: int = 1,
+                    out_of_class: int = 0, include_depth: int = 0) -> dict:
+    '''
+    Generate synthetic source/destination pair where every destination method has matching
+    source method with different body.
+    :param directory: where to generate files (created if doesn't exist)
+    :param nclasses: number of classes
+    :param nmethods: number of methods per class
+    :param nnamespaces: number of namespaces classes are distributed over
+    :param out_of_class: number of methods per class that are defined outside of the class
+    :param include_depth: length of the chain of headers included by both files
+    :return: corpus - dict with `src`, `dest` and `headers` file names and `ndefinitions`
+    '''
+    os.makedirs(directory, exist_ok=True)
+    headers = [generate_header(directory, depth, include_depth) for depth in range(include_depth)]
+    src = os.path.join(directory, 'src.hpp')
+    dest = os.path.join(directory, 'dest.hpp')
+    generate_tu(src, nclasses, nmethods, nnamespaces, out_of_class, include_depth, variant=1)
+    generate_tu(dest, nclasses, nmethods, nnamespaces, out_of_class, include_depth, variant=0)
+    return {'src': src,
+            'dest': dest,
+            'headers': headers,
+            'ndefinitions': nclasses * nmethods}
+
+
+def generate_table(table_idx: int, nbytes: int) -> list:
+    '''
+    Generate lookup table like the ones code generators emit (16 values per line).
+    :return: lines
+    '''
+    lines = [f'static const unsigned char table_{table_idx}[] = {{']
+    values = [f'0x{(table_idx * 31 + i * 7) % 256:02x}' for i in range(16)]
+    row = '  ' + ', '.join(values) + ','
+    lines.extend([row] * max(nbytes // len(row), 1))
+    lines.append('};')
+    return lines
+
+
+def generate_large_tu(filename: str, size: int, nfunctions: int, variant: int, table_size: int):
+    '''
+    Generate translation unit of about `size` bytes where `nfunctions` functions are spread
+    between data tables. Function bodies depend on `variant`, the tables don't.
+    '''
+    nfunctions = max(nfunctions, 1)
+    ntables = max(size // table_size, 1)
+    with open(filename, mode='w') as file:
+        for table_idx in range(ntables):
+            file.write('\n'.join(generate_table(table_idx, table_size)) + '\n\n')
+            # functions are placed after evenly spaced tables (the last one is always at the end)
+            for function_idx in range(nfunctions):
+                if function_idx * ntables // nfunctions == ntables - 1 - table_idx:
+                    file.write(f'int function_{function_idx}(int a, double b)\n')
+                    file.write('\n'.join(get_method_body(0, function_idx, variant, '')) + '\n\n')
+
+
+def generate_large_corpus(directory: str, size: int, nfunctions: int = 10, table_size: int = 64 * 1024) -> dict:
+    '''
+    Generate huge source/destination pair like generated C/C++ code: destination is mostly data tables
+    and only `nfunctions` functions differ from the source ones.
+    :param directory: where to generate files (created if doesn't exist)
+    :param size: approximate size of destination file in bytes
+    :param nfunctions: number of functions to be replaced
+    :param table_size: approximate size of one data table in bytes
+    :return: corpus - dict with `src`, `dest` and `headers` file names and `ndefinitions`
+    '''
+    os.makedirs(directory, exist_ok=True)
+    src = os.path.join(directory, 'src.cpp')
+    dest = os.path.join(directory, 'dest.cpp')
+    with open(src, mode='w') as file:
+        for function_idx in range(nfunctions):
+            file.write(f'int function_{function_idx}(int a, double b)\n')
+            file.write('\n'.join(get_method_body(0, function_idx, 1, '')) + '\n\n')
+    generate_large_tu(dest, size, nfunctions, 0, table_size)
+    return {'src': src,
+            'dest': dest,
+            'headers': [],
+            'ndefinitions': nfunctions}
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from clang.cindex import Index
+from cppguts.benchmarks.corpus import generate_large_corpus
+from cppguts.editcpp import edit_file
+
+
+# edit modes measured by default (`diff` has to keep both versions of the file),
+# `lexer_only` is `write` mode that finds definitions by `lexmatch` instead of libclang
+MEMORY_SCENARIOS = ('write', 'check', 'drift', 'lexer_only')
+
+
+def measure_peak_memory(func) -> (int, float):
+    '''
+    Call `func` and measure peak size of the memory allocated by Python while it runs.
+    Memory allocated by libclang itself is not traced.
+    :param func: callable without arguments
+    :return: peak, wall - peak size in bytes and wall time in seconds
+    '''
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        func()
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, wall
+
+
+def run_memory_benchmark(size: int, nfunctions: int = 10, scenarios: list = None, clangcmd: list = None,
+                         workdir: str = None) -> dict:
+    '''
+    Generate huge destination file (mostly data tables) and measure peak Python memory of `editcpp`
+    editing its `nfunctions` functions in every mode. Wall time of `lexer_only` scenario is to be compared
+    with the one of `write` scenario that parses both files by libclang.
+    :param size: approximate size of destination file in bytes
+    :param nfunctions: number of functions to be replaced
+    :param scenarios: edit modes and/or `lexer_only` to be measured (`MEMORY_SCENARIOS` by default)
+    :param clangcmd: list of clang arguments (without file name)
+    :param workdir: where to generate corpus (temporary directory by default)
+    :return: report - dict with `meta` and `results` keys that may be dumped as JSON, every result
+    has `peak` (bytes), `peak_to_file_size` and `wall` (seconds)
+    '''
+    clangcmd = clangcmd or ['-std=c++11']
+    tmpdir = None
+    if not workdir:
+        workdir = tmpdir = tempfile.mkdtemp(prefix='cppguts_memory_benchmark_')
+    try:
+        corpus = generate_large_corpus(workdir, size, nfunctions)
+        dest_size = os.path.getsize(corpus['dest'])
+        destcopy = corpus['dest'] + '.orig'
+        shutil.copyfile(corpus['dest'], destcopy)
+        index = Index.create()
+        dest_index = Index.create()
+        results = []
+        for scenario in scenarios or MEMORY_SCENARIOS:
+            shutil.copyfile(destcopy, corpus['dest'])
+            lexer_only = scenario == 'lexer_only'
+            mode = 'write' if lexer_only else scenario
+            # memory of parsed translation units belongs to libclang and isn't traced
+            peak, wall = measure_peak_memory(lambda: edit_file(index, corpus['src'], corpus['dest'], clangcmd,
+                                                               oldfile_del=True, print_diagnostics=False,
+                                                               mode=mode, lexer_only=lexer_only,
+                                                               dest_index=dest_index))
+            results.append({'scenario': scenario,
+                            'peak': peak,
+                            'peak_to_file_size': peak / dest_size,
+                            'wall': wall})
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {'meta': {'clang_args': clangcmd,
+                     'dest_size': dest_size,
+                     'nfunctions': nfunctions},
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=
+                                     'Measure peak Python memory of `editcpp` on a huge generated C++ file '
+                                     'and print JSON report. After passing the benchmark flags you are allowed '
+                                     'to pass clang commands (`-std=c++11` by default).')
+    parser.add_argument('--size', dest='size', action='store', metavar='MB',
+                        type=int, default=16, help='size of destination file in megabytes (default: %(default)s)')
+    parser.add_argument('--functions', dest='nfunctions', action='store', metavar='N',
+                        type=int, default=10, help='number of functions to be replaced (default: %(default)s)')
+    parser.add_argument('--scenarios', dest='scenarios', action='store',
+                        type=type('string'), default=None,
+                        help='comma separated list of edit modes and/or `lexer_only` (default: ' +
+                             ','.join(MEMORY_SCENARIOS) + ')')
+    parser.add_argument('--max-peak-ratio', dest='max_peak_ratio', action='store', metavar='RATIO',
+                        type=float, default=None,
+                        help='exit with status 1 if peak memory of any scenario exceeds RATIO * file size')
+    args, clangcmd = parser.parse_known_args()
+
+    scenarios = args.scenarios.split(',') if args.scenarios else None
+    report = run_memory_benchmark(args.size * 1024 * 1024, args.nfunctions, scenarios, clangcmd)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+    if args.max_peak_ratio is not None:
+        exceeded = [r['scenario'] for r in report['results'] if r['peak_to_file_size'] > args.max_peak_ratio]
+        if exceeded:
+            print(f"peak memory exceeds {args.max_peak_ratio} * file size: " + ', '.join(exceeded),
+                  file=sys.stderr)
+            parser.exit(1)
+
+
+if __name__ == '__main__':
+    main()
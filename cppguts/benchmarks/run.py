@@ -0,0 +1,188 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from clang.cindex import Index
+from cppguts.benchmarks.corpus import generate_corpus
+from cppguts.dumpcpp import get_info, parse_fields
+from cppguts.editcpp import (FAST_DISCOVERY_PARSE_OPTIONS, build_signature_index, edit_text,
+                             find_method_def_nodes, get_method_signature_key, get_replacement_spans)
+from cppguts.splice import apply_spans
+from cppguts.tucache import get_libclang_version
+
+
+def time_scenario(func, repeat: int) -> dict:
+    '''
+    Call `func` `repeat` times and collect wall time statistics.
+    :param func: callable without arguments
+    :param repeat: number of calls
+    :return: timings - dict with `repeat`, `min`, `median`, `mean` and `max` (in seconds)
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'repeat': repeat,
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'max': max(times)}
+
+
+def get_scenarios(corpus: dict, clangcmd: list) -> dict:
+    '''
+    Prepare benchmark scenarios. Each scenario measures one phase of `editcpp`/`dumpcpp`,
+    everything it depends on is prepared beforehand.
+    :param corpus: corpus as returned by `generate_corpus`
+    :param clangcmd: list of clang arguments (without file name)
+    :return: scenarios - dict where key is scenario name and value is callable
+    '''
+    index = Index.create()
+    dest_index = Index.create()
+    src, dest = corpus['src'], corpus['dest']
+    tu_src = index.parse(src, clangcmd)
+    tu_dest = index.parse(dest, clangcmd)
+    nodes_src = []
+    find_method_def_nodes(tu_src.cursor, nodes_src, src)
+    nodes_dest = []
+    find_method_def_nodes(tu_dest.cursor, nodes_dest, dest)
+    with open(src, mode='rb') as file:
+        srcdata = file.read()
+    with open(dest, mode='rb') as file:
+        destdata = file.read()
+    spans = get_replacement_spans(tu_src, tu_dest, src, dest, srcdata)
+    minimal_fields = parse_fields('minimal')
+
+    def matching():
+        signature_index = build_signature_index(nodes_dest)
+        for node in nodes_src:
+            signature_index.get(get_method_signature_key(node))
+
+    return {'parse': lambda: index.parse(dest, clangcmd),
+            'parse_fast_discovery': lambda: index.parse(dest, clangcmd, options=FAST_DISCOVERY_PARSE_OPTIONS),
+            'find_method_def_nodes': lambda: find_method_def_nodes(tu_dest.cursor, [], dest),
+            'matching': matching,
+            'splicing': lambda: apply_spans(destdata, spans),
+            'edit_text': lambda: edit_text(srcdata, destdata, clangcmd, src, dest, index, dest_index=dest_index),
+            'edit_text_lexer_only': lambda: edit_text(srcdata, destdata, src_filename=src, dest_filename=dest,
+                                                      lexer_only=True),
+            'dumpcpp.get_info': lambda: get_info(tu_dest.cursor),
+            'dumpcpp.get_info_minimal': lambda: get_info(tu_dest.cursor, fields=minimal_fields)}
+
+
+def run_benchmarks(corpus_params: dict, repeat: int = 5, scenarios: list = None,
+                   clangcmd: list = None, workdir: str = None) -> dict:
+    '''
+    Generate corpus and run benchmark scenarios on it.
+    :param corpus_params: keyword arguments of `generate_corpus` (except `directory`)
+    :param repeat: number of runs of every scenario
+    :param scenarios: names of scenarios to run (all by default)
+    :param clangcmd: list of clang arguments (without file name)
+    :param workdir: where to generate corpus (temporary directory by default)
+    :return: report - dict with `meta` and `results` keys that may be dumped as JSON
+    '''
+    clangcmd = clangcmd or ['-std=c++11']
+    tmpdir = None
+    if not workdir:
+        workdir = tmpdir = tempfile.mkdtemp(prefix='cppguts_benchmark_')
+    try:
+        corpus = generate_corpus(workdir, **corpus_params)
+        all_scenarios = get_scenarios(corpus, clangcmd)
+        results = []
+        for name in scenarios or all_scenarios:
+            if name not in all_scenarios:
+                raise ValueError(f"unknown scenario: `{name}`, available are: " + ', '.join(all_scenarios))
+            result = {'scenario': name}
+            result.update(time_scenario(all_scenarios[name], repeat))
+            results.append(result)
+        dest_size = os.path.getsize(corpus['dest'])
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {'meta': {'timestamp': datetime.datetime.now().isoformat(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'libclang': get_libclang_version(),
+                     'clang_args': clangcmd,
+                     'corpus': dict(corpus_params, ndefinitions=corpus['ndefinitions'], dest_size=dest_size)},
+            'results': results}
+
+
+def compare_reports(report: dict, baseline: dict) -> list:
+    '''
+    Compare median times of the report with the baseline report.
+    :return: rows - list of (scenario, baseline median, median, ratio) tuples
+    '''
+    baseline_medians = {result['scenario']: result['median'] for result in baseline['results']}
+    rows = []
+    for result in report['results']:
+        baseline_median = baseline_medians.get(result['scenario'])
+        ratio = result['median'] / baseline_median if baseline_median else None
+        rows.append((result['scenario'], baseline_median, result['median'], ratio))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=
+                                     'Run `editcpp`/`dumpcpp` benchmarks on a synthetic C++ corpus and '
+                                     'print JSON report. After passing the benchmark flags you are allowed '
+                                     'to pass clang commands (`-std=c++11` by default).')
+    parser.add_argument('--classes', dest='nclasses', action='store', metavar='N',
+                        type=int, default=50, help='number of classes (default: %(default)s)')
+    parser.add_argument('--methods', dest='nmethods', action='store', metavar='N',
+                        type=int, default=20, help='number of methods per class (default: %(default)s)')
+    parser.add_argument('--namespaces', dest='nnamespaces', action='store', metavar='N',
+                        type=int, default=5, help='number of namespaces (default: %(default)s)')
+    parser.add_argument('--out-of-class', dest='out_of_class', action='store', metavar='N',
+                        type=int, default=5,
+                        help='number of methods per class defined outside of the class (default: %(default)s)')
+    parser.add_argument('--include-depth', dest='include_depth', action='store', metavar='N',
+                        type=int, default=10, help='length of the chain of included headers (default: %(default)s)')
+    parser.add_argument('--repeat', dest='repeat', action='store', metavar='N',
+                        type=int, default=5, help='number of runs of every scenario (default: %(default)s)')
+    parser.add_argument('--scenarios', dest='scenarios', action='store',
+                        type=type('string'), default=None, help='comma separated list of scenarios (all by default)')
+    parser.add_argument('--output', dest='output', action='store',
+                        type=type('string'), default=None, help='write JSON report to the file instead of stdout')
+    parser.add_argument('--baseline', dest='baseline', action='store',
+                        type=type('string'), default=None,
+                        help='JSON report of previous run to compare median times with (printed to stderr)')
+    args, clangcmd = parser.parse_known_args()
+
+    corpus_params = {'nclasses': args.nclasses,
+                     'nmethods': args.nmethods,
+                     'nnamespaces': args.nnamespaces,
+                     'out_of_class': args.out_of_class,
+                     'include_depth': args.include_depth}
+    scenarios = args.scenarios.split(',') if args.scenarios else None
+    try:
+        report = run_benchmarks(corpus_params, args.repeat, scenarios, clangcmd)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.output:
+        with open(args.output, mode='w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline, mode='r') as file:
+            baseline = json.load(file)
+        for scenario, baseline_median, median, ratio in compare_reports(report, baseline):
+            ratio = f"{ratio:.2f}x" if ratio is not None else 'n/a'
+            print(f"{scenario:30} {baseline_median or 0:10.6f} -> {median:10.6f}  {ratio}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
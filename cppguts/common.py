@@ -0,0 +1,87 @@
+import json
+import os
+import shlex
+
+from clang.cindex import Index
+
+
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.h', '.hh', '.hpp', '.hxx', '.h++', '.inl', '.ipp')
+
+
+def get_compile_command_args(args: list, directory: str, filename: str) -> list:
+    '''
+    Convert compiler command line to libclang arguments: drop the compiler, the input file
+    and the output related flags. Relative paths are resolved via `-working-directory`.
+    :param args: compiler command line (including compiler itself)
+    :param directory: working directory of the command
+    :param filename: absolute path to the compiled file
+    :return: clang_args - list of clang arguments (without file name)
+    '''
+    clang_args = ['-working-directory=' + directory]
+    skip_next = False
+    for arg in args[1:]:
+        if skip_next:
+            skip_next = False
+        elif arg in ('-o', '-MF', '-MT', '-MQ'):
+            skip_next = True
+        elif arg in ('-c', '-M', '-MM', '-MD', '-MMD', '-MP') or (arg.startswith('-o') and len(arg) > 2):
+            pass
+        elif not arg.startswith('-') and os.path.normpath(os.path.join(directory, arg)) == filename:
+            pass
+        else:
+            clang_args.append(arg)
+    return clang_args
+
+
+def load_compile_commands(compile_commands: str) -> list:
+    '''
+    Load compilation database.
+    :param compile_commands: path to `compile_commands.json` or to the directory where it resides
+    :return: entries - list of dict with `file` (absolute path) and `clang_args` keys
+    '''
+    if os.path.isdir(compile_commands):
+        compile_commands = os.path.join(compile_commands, 'compile_commands.json')
+    with open(compile_commands, mode='r') as file:
+        data = json.load(file)
+
+    entries = []
+    for item in data:
+        directory = item.get('directory') or os.path.dirname(os.path.abspath(compile_commands))
+        filename = os.path.normpath(os.path.join(directory, item['file']))
+        if 'arguments' in item:
+            args = list(item['arguments'])
+        else:
+            args = shlex.split(item['command'])
+        entries.append({'file': filename,
+                        'clang_args': get_compile_command_args(args, directory, filename)})
+    return entries
+
+
+def is_subpath(filename: str, directory: str) -> bool:
+    filename = os.path.normcase(os.path.realpath(filename))
+    directory = os.path.normcase(os.path.realpath(directory))
+    return filename == directory or filename.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def format_exception(e: Exception) -> str:
+    '''
+    Describe unexpected exception of a task processed by worker (libclang raises `TranslationUnitLoadError`
+    and alike) so that it is reported with the task result instead of stopping the whole pool.
+    :return: message - exception prefixed by its type name
+    '''
+    return f"{type(e).__name__}: {e}\n"
+
+
+# each worker process parses all its files with the same indexes, they are created by the first task
+# (`ProcessPoolExecutor` has no initializer before Python 3.7)
+_worker_indexes = {}
+
+
+def get_worker_index(slot: str = 'main') -> Index:
+    '''
+    :param slot: name of the index, files parsed concurrently by another thread need an index of their own
+    :return: index of the worker process
+    '''
+    if slot not in _worker_indexes:
+        _worker_indexes[slot] = Index.create()
+    return _worker_indexes[slot]
@@ -1,84 +1,134 @@
 import argparse
+import json
 import os
+import re
+import sys
 
-from clang.cindex import Cursor, Index
+from clang.cindex import (BaseEnumeration, Cursor, Index, SourceLocation, SourceRange,
+                          StorageClass, Token, Type)
+from cppguts import profiling
+from cppguts.indexcpp import default_index_file, parse_kinds, query_symbols
+from cppguts.profiling import add_profile_arguments
+from cppguts.tucache import (DEFAULT_CACHE_SIZE, DIAGNOSTIC_SEVERITIES, add_diagnostics_arguments,
+                             default_cache_dir, parse_tu, select_diagnostics)
 from pprint import pprint
 
 
-def get_diag_info(diag):
-    return {'severity': diag.severity,
-            'location': diag.location,
-            'category_name': diag.category_name,
-            'spelling': diag.spelling,
-            'ranges': diag.ranges,
-            'fixits': diag.fixits}
-
-
-def get_node_info(node: Cursor, children = None) -> dict:
-    return {'access_specifier': node.access_specifier,
-            'availability': node.availability,
-            'brief_comment': node.brief_comment,
-            'canonical': node.canonical,
-            'data': node.data,
-            'displayname': node.displayname,
-            # 'enum_type' : node.enum_type,
-            # 'enum_value' : node.enum_value,
-            'exception_specification_kind': node.exception_specification_kind,
-            'extent': node.extent,
-            'from_cursor_result': node.from_cursor_result,
-            'from_location': node.from_location,
-            'from_result': node.from_result,
-            'get_arguments': node.get_arguments(),
-            'get_bitfield_width': node.get_bitfield_width(),
-            'get_children': node.get_children(),
-            'get_definition': node.get_definition(),
-            'get_field_offsetof': node.get_field_offsetof(),
-            # 'get_included_file' : node.get_included_file(),
-            'get_num_template_arguments': node.get_num_template_arguments(),
-            # 'get_template_argument_kind' : node.get_template_argument_kind(),
-            # 'get_template_argument_type' : node.get_template_argument_type(),
-            # 'get_template_argument_unsigned_value' : node.get_template_argument_unsigned_value(),
-            # 'get_template_argument_value' : node.get_template_argument_value(),
-            'get_tokens': node.get_tokens(),
-            'get_usr': node.get_usr(),
-            'hash': node.hash,
-            'is_abstract_record': node.is_abstract_record(),
-            'is_anonymous': node.is_anonymous(),
-            'is_bitfield': node.is_bitfield(),
-            'is_const_method': node.is_const_method(),
-            'is_converting_constructor': node.is_converting_constructor(),
-            'is_copy_constructor': node.is_copy_constructor(),
-            'is_default_constructor': node.is_default_constructor(),
-            'is_default_method': node.is_default_method(),
-            'is_definition': node.is_definition(),
-            'is_move_constructor': node.is_move_constructor(),
-            'is_mutable_field': node.is_mutable_field(),
-            'is_pure_virtual_method': node.is_pure_virtual_method(),
-            'is_scoped_enum': node.is_scoped_enum(),
-            'is_static_method': node.is_static_method(),
-            'is_virtual_method': node.is_virtual_method(),
-            'kind': node.kind,
-            'lexical_parent.displayname': node.lexical_parent.displayname if node.lexical_parent else None,
-            'linkage': node.linkage,
-            'location': node.location,
-            # 'mangled_name': node.mangled_name if node.mangled_name else None,
-            # 'objc_type_encoding': node.objc_type_encoding,
-            # 'raw_comment': node.raw_comment,
-            # 'referenced': node.referenced,
-            'result_type spelling': node.result_type.spelling,
-            'semantic_parent.displayname': node.semantic_parent.displayname if node.semantic_parent else None,
-            'spelling': node.spelling,
-            'storage_class': node.storage_class,
-            # 'tls_kind': node.tls_kind,
-            'translation_unit spelling': node.translation_unit.spelling if node.translation_unit else None,
-            'type spelling': node.type.spelling,
-            # 'underlying_typedef_type spelling': node.underlying_typedef_type.spelling if node.underlying_typedef_type else None,
-            # 'walk_preorder': node.walk_preorder,
-            # 'xdata': node.xdata,
-            'children' : children}
+# accessors of the node info, each is called only if the field is requested
+NODE_INFO_GETTERS = {
+    'access_specifier': lambda node: node.access_specifier,
+    'availability': lambda node: node.availability,
+    'brief_comment': lambda node: node.brief_comment,
+    'canonical': lambda node: node.canonical,
+    'data': lambda node: node.data,
+    'displayname': lambda node: node.displayname,
+    # 'enum_type': lambda node: node.enum_type,
+    # 'enum_value': lambda node: node.enum_value,
+    'exception_specification_kind': lambda node: node.exception_specification_kind,
+    'extent': lambda node: node.extent,
+    'from_cursor_result': lambda node: node.from_cursor_result,
+    'from_location': lambda node: node.from_location,
+    'from_result': lambda node: node.from_result,
+    'get_arguments': lambda node: node.get_arguments(),
+    'get_bitfield_width': lambda node: node.get_bitfield_width(),
+    'get_children': lambda node: node.get_children(),
+    'get_definition': lambda node: node.get_definition(),
+    'get_field_offsetof': lambda node: node.get_field_offsetof(),
+    # 'get_included_file': lambda node: node.get_included_file(),
+    'get_num_template_arguments': lambda node: node.get_num_template_arguments(),
+    # 'get_template_argument_kind': lambda node: node.get_template_argument_kind(),
+    # 'get_template_argument_type': lambda node: node.get_template_argument_type(),
+    # 'get_template_argument_unsigned_value': lambda node: node.get_template_argument_unsigned_value(),
+    # 'get_template_argument_value': lambda node: node.get_template_argument_value(),
+    'get_tokens': lambda node: node.get_tokens(),
+    'get_usr': lambda node: node.get_usr(),
+    'hash': lambda node: node.hash,
+    'is_abstract_record': lambda node: node.is_abstract_record(),
+    'is_anonymous': lambda node: node.is_anonymous(),
+    'is_bitfield': lambda node: node.is_bitfield(),
+    'is_const_method': lambda node: node.is_const_method(),
+    'is_converting_constructor': lambda node: node.is_converting_constructor(),
+    'is_copy_constructor': lambda node: node.is_copy_constructor(),
+    'is_default_constructor': lambda node: node.is_default_constructor(),
+    'is_default_method': lambda node: node.is_default_method(),
+    'is_definition': lambda node: node.is_definition(),
+    'is_move_constructor': lambda node: node.is_move_constructor(),
+    'is_mutable_field': lambda node: node.is_mutable_field(),
+    'is_pure_virtual_method': lambda node: node.is_pure_virtual_method(),
+    'is_scoped_enum': lambda node: node.is_scoped_enum(),
+    'is_static_method': lambda node: node.is_static_method(),
+    'is_virtual_method': lambda node: node.is_virtual_method(),
+    'kind': lambda node: node.kind,
+    'lexical_parent.displayname': lambda node: node.lexical_parent.displayname if node.lexical_parent else None,
+    'linkage': lambda node: node.linkage,
+    'location': lambda node: node.location,
+    # 'mangled_name': lambda node: node.mangled_name if node.mangled_name else None,
+    # 'objc_type_encoding': lambda node: node.objc_type_encoding,
+    # 'raw_comment': lambda node: node.raw_comment,
+    # 'referenced': lambda node: node.referenced,
+    'result_type spelling': lambda node: node.result_type.spelling,
+    'semantic_parent.displayname': lambda node: node.semantic_parent.displayname if node.semantic_parent else None,
+    'spelling': lambda node: node.spelling,
+    'storage_class': lambda node: node.storage_class,
+    # 'tls_kind': lambda node: node.tls_kind,
+    'translation_unit spelling': lambda node: node.translation_unit.spelling if node.translation_unit else None,
+    'type spelling': lambda node: node.type.spelling,
+    # 'underlying_typedef_type spelling': lambda node: node.underlying_typedef_type.spelling if node.underlying_typedef_type else None,
+    # 'walk_preorder': lambda node: node.walk_preorder,
+    # 'xdata': lambda node: node.xdata,
+}
+
+# presets that may be passed instead of (or together with) the field names
+FIELD_PRESETS = {
+    'minimal': ['kind', 'spelling', 'displayname', 'location', 'extent'],
+    'semantic': ['kind', 'spelling', 'displayname', 'location', 'extent',
+                 'access_specifier', 'get_usr', 'is_const_method', 'is_definition',
+                 'is_static_method', 'is_virtual_method', 'lexical_parent.displayname',
+                 'linkage', 'result_type spelling', 'semantic_parent.displayname',
+                 'storage_class', 'type spelling'],
+    'full': list(NODE_INFO_GETTERS),
+}
+
+
+def parse_fields(fields: str) -> list:
+    '''
+    Parse comma separated list of field names and/or presets.
+    :param fields: for example `minimal,get_usr`
+    :return: fields - list of field names without duplicates
+    '''
+    parsed = []
+    for field in fields.split(','):
+        field = field.strip()
+        if not field:
+            continue
+        if field in FIELD_PRESETS:
+            names = FIELD_PRESETS[field]
+        elif field in NODE_INFO_GETTERS:
+            names = [field]
+        else:
+            raise ValueError(f"unknown field or preset: `{field}`")
+        parsed.extend(name for name in names if name not in parsed)
+    return parsed
+
+
+def get_node_info(node: Cursor, children = None, fields: list = None) -> dict:
+    '''
+    Get node info. Only requested accessors are called so that expensive ones
+    (`get_tokens`, `get_definition` and alike) are not evaluated if not needed.
+    :param node: cursor
+    :param children: value of `children` field
+    :param fields: list of field names (all the fields by default)
+    :return: node_info - dict
+    '''
+    if fields is None:
+        fields = NODE_INFO_GETTERS
+    node_info = {field: NODE_INFO_GETTERS[field](node) for field in fields}
+    node_info['children'] = children
+    return node_info
 
 
 def find_nodes(node: Cursor, nodes_found: list, objname: str):
+    profiling.count('cursors_visited')
     if objname and objname == node.spelling:
         nodes_found.append(node)
 
@@ -86,14 +136,108 @@ def find_nodes(node: Cursor, nodes_found: list, objname: str):
         find_nodes(child, nodes_found, objname)
 
 
-def get_info(node: Cursor, maxdepth: int = None, depth: int = 0) -> dict:
+def get_info(node: Cursor, maxdepth: int = None, depth: int = 0, fields: list = None) -> dict:
+    profiling.count('cursors_visited')
     if maxdepth is not None and depth >= maxdepth:
         children = None
     else:
-        children = [get_info(c, maxdepth, depth+1)
+        children = [get_info(c, maxdepth, depth+1, fields)
                     for c in node.get_children()]
 
-    return get_node_info(node, children)
+    return get_node_info(node, children, fields)
+
+
+def iter_nodes(node: Cursor, maxdepth: int = None):
+    '''
+    Walk the cursor tree iteratively in preorder (no recursion limit, no tree kept in memory).
+    :param node: cursor to start from
+    :param maxdepth: limit cursor expansion to depth N
+    :return: generator of (node_id, parent_id, depth, node) where node ids are
+    numbers in preorder and parent_id of the starting node is None
+    '''
+    stack = [(node, None, 0)]
+    node_id = 0
+    while stack:
+        node, parent_id, depth = stack.pop()
+        profiling.count('cursors_visited')
+        yield node_id, parent_id, depth, node
+        if maxdepth is None or depth < maxdepth:
+            children = list(node.get_children())
+            stack.extend((child, node_id, depth+1) for child in reversed(children))
+        node_id += 1
+
+
+def to_json_value(value):
+    '''
+    Convert value returned by libclang to JSON serializable value.
+    :param value: libclang value (cursor, type, location, enumeration and so on)
+    :return: json_value
+    '''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (BaseEnumeration, StorageClass)):
+        return value.name
+    if isinstance(value, SourceLocation):
+        return {'file': value.file.name if value.file else None,
+                'line': value.line,
+                'column': value.column,
+                'offset': value.offset}
+    if isinstance(value, SourceRange):
+        return {'start': to_json_value(value.start),
+                'end': to_json_value(value.end)}
+    if isinstance(value, Cursor):
+        return {'kind': to_json_value(value.kind),
+                'spelling': value.spelling,
+                'location': to_json_value(value.location)}
+    if isinstance(value, Type):
+        return value.spelling
+    if isinstance(value, Token):
+        return value.spelling
+    if isinstance(value, (list, tuple)) or hasattr(value, '__next__'):
+        return [to_json_value(v) for v in value]
+    return str(value)
+
+
+def get_node_json(node: Cursor, node_id: int = None, parent_id: int = None, depth: int = None,
+                  fields: list = None) -> dict:
+    '''
+    Get node info that may be serialized to JSON. Children are not included:
+    they refer to their parent via `parent_id` instead.
+    :param node: cursor
+    :param node_id: id of the node
+    :param parent_id: id of the parent node
+    :param depth: depth of the node
+    :param fields: list of field names (all the fields by default)
+    :return: node_json - dict
+    '''
+    if fields is None:
+        fields = NODE_INFO_GETTERS
+    # `data` is raw libclang pointer
+    fields = [field for field in fields if field not in ('get_children', 'data')]
+    node_json = {'id': node_id, 'parent_id': parent_id, 'depth': depth}
+    for key, value in get_node_info(node, fields=fields).items():
+        if key == 'children' or callable(value):
+            continue
+        node_json[key] = to_json_value(value)
+    return node_json
+
+
+def dump_jsonl(node: Cursor, stream=sys.stdout, maxdepth: int = None, objname: str = None,
+               fields: list = None):
+    '''
+    Write one JSON object per cursor (JSON Lines) while walking the tree.
+    :param node: cursor to start from
+    :param stream: stream to write to
+    :param maxdepth: limit cursor expansion to depth N
+    :param objname: write only nodes with this spelling
+    :param fields: list of field names (all the fields by default)
+    '''
+    for node_id, parent_id, depth, node in iter_nodes(node, maxdepth):
+        if objname and objname != node.spelling:
+            continue
+        line = json.dumps(get_node_json(node, node_id, parent_id, depth, fields)) + '\n'
+        stream.write(line)
+        profiling.count('bytes_written', len(line))
 
 
 def main():
@@ -103,34 +247,106 @@ def main():
                                      'commands like `-I` (to include dir), `-std=c++17` and other. '
                                      'Dont pass a file without flag to clang! Use `--dest-file=` instead.')
     parser.add_argument('--file', dest='file', action='store',
-                        type=type('string'), required=True, default=None,
-                        help='file to be dumped')
+                        type=type('string'), required=False, default=None,
+                        help='file to be dumped (with `--index` only definitions from this file are listed)')
     parser.add_argument("--max-depth", dest="maxdepth", action='store',
                         metavar="N", type=int, required=False, default=None,
                         help="limit cursor expansion to depth N",)
     parser.add_argument("--object-name", dest="objname", action='store',
                         type=type('string'), required=False, default=None,
                         help="parse only specified names (spelling)")
+    parser.add_argument('--jsonl', dest='jsonl', action='store_true',
+                        help='stream one JSON object per cursor (JSON Lines) with its depth and parent id '
+                             'instead of pprinting the whole tree, diagnostics are printed to stderr')
+    parser.add_argument('--fields', dest='fields', action='store',
+                        type=type('string'), required=False, default='full',
+                        help='comma separated list of node fields and/or presets to be dumped, '
+                             'presets are: ' + ', '.join(FIELD_PRESETS) + ' (default: %(default)s)')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+                        type=type('string'), required=False, default=default_cache_dir(),
+                        help='directory where parsed translation units are cached (default: %(default)s)')
+    parser.add_argument('--cache-size', dest='cache_size', action='store',
+                        metavar='MB', type=int, required=False, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='max size of the translation unit cache in megabytes (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='always parse the file from scratch and do not use the translation unit cache')
+    parser.add_argument('--pch-header', dest='pch_headers', action='append',
+                        metavar='HEADER', type=type('string'), default=None,
+                        help='common header (file or name like `iostream`) to be precompiled once and '
+                             'reused by the next runs, may be passed several times')
+    parser.add_argument('--index', dest='index_file', action='store', nargs='?',
+                        const=default_index_file(), type=type('string'), default=None,
+                        help='answer `--object-name`, `--object-regex` and `--kind` queries from the symbol '
+                             'index built by `indexcpp` instead of parsing (default index: %(const)s)')
+    parser.add_argument('--object-regex', dest='objregex', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='with `--index`: list definitions whose spelling matches regular expression')
+    parser.add_argument('--kind', dest='kinds', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='with `--index`: comma separated list of cursor kinds like `CXX_METHOD,FUNCTION_DECL`')
+    add_diagnostics_arguments(parser)
+    add_profile_arguments(parser)
     args, clangcmd = parser.parse_known_args()
 
+    if args.index_file:
+        try:
+            kinds = parse_kinds(args.kinds) if args.kinds else None
+            with profiling.profile(args.profile, pstats_file=args.profile_pstats):
+                with profiling.phase('query'):
+                    symbols = query_symbols(args.index_file, args.objname, args.objregex, kinds, args.file)
+        except (ValueError, re.error, FileNotFoundError) as e:
+            parser.error(str(e))
+        for symbol in symbols:
+            if args.jsonl:
+                sys.stdout.write(json.dumps(symbol) + '\n')
+            else:
+                pprint(('found node', symbol), indent=10)
+        return
+
+    if args.objregex or args.kinds:
+        parser.error("`--object-regex` and `--kind` are answered from the symbol index only (use `--index`)\n")
+    if not args.file:
+        parser.error("`--file` is required (or use `--index`)\n")
     if not os.path.isfile(args.file):
         parser.error(f"specified file doesn't exist:\n{args.file}")
 
-    clangcmd.append(args.file)
+    try:
+        fields = parse_fields(args.fields)
+    except ValueError as e:
+        parser.error(f"{e}\navailable fields:\n" + '\n'.join(NODE_INFO_GETTERS))
 
-    index = Index.create()
-    tu = index.parse(None, clangcmd)
-    if not tu:
-        parser.error(f"unable to load input:\n{args.file}")
+    with profiling.profile(args.profile, pstats_file=args.profile_pstats):
+        index = Index.create()
+        with profiling.phase('parse'):
+            tu, diagnostics = parse_tu(index, args.file, clangcmd,
+                                       cache_dir=None if args.no_cache else args.cache_dir,
+                                       cache_size=args.cache_size * 1024 * 1024,
+                                       pch_headers=args.pch_headers)
+        if not tu:
+            parser.error(f"unable to load input:\n{args.file}")
+        diagnostics = select_diagnostics(diagnostics, DIAGNOSTIC_SEVERITIES[args.diagnostics_severity])
 
-    pprint(('diagnostics:', [get_diag_info(d) for d in tu.diagnostics]))
-    if args.objname:
-        nodes_found = []
-        find_nodes(tu.cursor, nodes_found, args.objname)
-        for node in nodes_found:
-            pprint(('found node', get_node_info(node)), indent=10)
-    else:
-        pprint(('nodes', get_info(tu.cursor)))
+        if args.jsonl:
+            with profiling.phase('diagnostics'):
+                pprint(('diagnostics:', diagnostics), stream=sys.stderr)
+            with profiling.phase('dump'):
+                dump_jsonl(tu.cursor, sys.stdout, args.maxdepth, args.objname, fields)
+            return
+
+        with profiling.phase('diagnostics'):
+            pprint(('diagnostics:', diagnostics))
+        if args.objname:
+            nodes_found = []
+            with profiling.phase('find_nodes'):
+                find_nodes(tu.cursor, nodes_found, args.objname)
+            with profiling.phase('dump'):
+                for node in nodes_found:
+                    pprint(('found node', get_node_info(node, fields=fields)), indent=10)
+        else:
+            with profiling.phase('collect'):
+                info = get_info(tu.cursor, args.maxdepth, fields=fields)
+            with profiling.phase('dump'):
+                pprint(('nodes', info))
 
 
 if __name__ == '__main__':
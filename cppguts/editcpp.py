@@ -1,19 +1,44 @@
 import argparse
+import contextlib
+import difflib
+import functools
+import glob
+import json
+import mmap
 import os
 import shutil
+import tempfile
 import warnings
 
-from clang.cindex import Cursor, CursorKind, Index
+from clang.cindex import Cursor, CursorKind, Diagnostic, Index, TranslationUnit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cppguts import profiling
+from cppguts.common import (SOURCE_EXTENSIONS, format_exception, get_worker_index, is_subpath,
+                            load_compile_commands)
+from cppguts.lexmatch import find_lexical_definitions, fingerprint
+from cppguts.profiling import add_profile_arguments
+from cppguts.splice import CHUNK_SIZE, apply_spans, check_spans, write_spans
+from cppguts.tucache import (DEFAULT_CACHE_SIZE, DIAGNOSTIC_SEVERITIES, add_diagnostics_arguments,
+                             default_cache_dir, get_pch_args, parse_tu, select_diagnostics)
 from pprint import pprint
 
 
-def get_diag_info(diag):
-    return {'severity': diag.severity,
-            'location': diag.location,
-            'category_name': diag.category_name,
-            'spelling': diag.spelling,
-            'ranges': diag.ranges,
-            'fixits': diag.fixits}
+class EditCppError(Exception):
+    '''
+    Raised when a source/destination pair can't be processed.
+    '''
+
+
+# parse options that are not exposed by python bindings
+PARSE_CREATE_PREAMBLE_ON_FIRST_PARSE = 0x100
+PARSE_LIMIT_SKIP_FUNCTION_BODIES_TO_PREAMBLE = 0x800
+
+# function bodies of the headers included at the beginning of a file (preamble) are skipped
+# while definitions of the file itself are kept intact
+FAST_DISCOVERY_PARSE_OPTIONS = (TranslationUnit.PARSE_PRECOMPILED_PREAMBLE |
+                                TranslationUnit.PARSE_SKIP_FUNCTION_BODIES |
+                                PARSE_CREATE_PREAMBLE_ON_FIRST_PARSE |
+                                PARSE_LIMIT_SKIP_FUNCTION_BODIES_TO_PREAMBLE)
 
 
 def find_include_directives(txtdata: list) -> (list, list):
@@ -87,26 +112,123 @@ def copy_file(srcfile: str, destfile: str) -> str:
     return copiedfile
 
 
-def find_method_def_nodes(node: Cursor, nodes_found: list, location_filename=str()):
+def get_file_identity(filename: str):
+    '''
+    Get identity of a file that allows to compare files without calling `os.path.samefile`
+    for every cursor. If the file doesn't exist (unsaved file) its absolute path is used.
+    :param filename: file name
+    :return: identity - (st_dev, st_ino) or normalized absolute path
+    '''
     try:
-        if location_filename:
-            if (node.kind == CursorKind.CXX_METHOD and node.is_definition() and
-                    os.path.samefile(node.location.file.name, location_filename)):
-                nodes_found.append(node)
-            elif (node.kind == CursorKind.FUNCTION_DECL and node.is_definition() and
-                  os.path.samefile(node.location.file.name, location_filename)):
+        st = os.stat(filename)
+        return st.st_dev, st.st_ino
+    except OSError:
+        return os.path.normcase(os.path.abspath(filename))
+
+
+@contextlib.contextmanager
+def map_file(filename: str):
+    '''
+    Map file into memory read-only: slicing the mapping by extent offsets reads only the sliced bytes
+    and the file isn't kept in Python memory. On Windows (mapped file can't be replaced) and for empty
+    files the content is read as `bytes`.
+    :param filename: file name
+    :return: data - mmap or bytes
+    '''
+    with open(filename, mode='rb') as file:
+        if os.name == 'nt' or os.fstat(file.fileno()).st_size == 0:
+            yield file.read()
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def find_method_def_nodes(node: Cursor, nodes_found: list, location_filename=str(), file_filter=None):
+    '''
+    Find function/method definitions in the `node` subtree. The tree is walked iteratively.
+    If `location_filename` is given then subtrees located in other files (included headers)
+    are pruned without being visited. File identity is calculated once per distinct file name.
+    Variables and fields are not expanded (initializers of huge data tables don't contain definitions).
+    :param node: cursor to start from (usually translation unit cursor)
+    :param nodes_found: list where found definitions are appended to (in preorder)
+    :param location_filename: file where definitions are expected to be
+    :param file_filter: used instead of `location_filename` to select several files, callable that
+    takes file name reported by libclang and returns True if the file is to be searched
+    '''
+    if location_filename:
+        location_identity = get_file_identity(location_filename)
+        file_filter = lambda filename: get_file_identity(filename) == location_identity
+    is_location_file = {}   # file name reported by libclang -> bool
+    nvisited = npruned = 0
+    nfound = len(nodes_found)
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        nvisited += 1
+        try:
+            if file_filter and node.kind != CursorKind.TRANSLATION_UNIT:
+                file = node.location.file
+                if not file:
+                    npruned += 1
+                    continue
+                if file.name not in is_location_file:
+                    is_location_file[file.name] = file_filter(file.name)
+                if not is_location_file[file.name]:
+                    npruned += 1
+                    continue
+
+            if node.kind in (CursorKind.CXX_METHOD, CursorKind.FUNCTION_DECL) and node.is_definition():
                 nodes_found.append(node)
-            else:
-                for child in node.get_children():
-                    find_method_def_nodes(child, nodes_found, location_filename)
+                continue
+            if node.kind in (CursorKind.VAR_DECL, CursorKind.FIELD_DECL):
+                continue
+        except ValueError as e:
+            msg = "Warning:\n" \
+                  "an exception were raised by libclang\n" \
+                  "node spelling:\t" + node.spelling + "\n" + \
+                  "node display:\t" + node.displayname + "\n" + \
+                  "node mangled name:\t" + node.mangled_name + "\n" + \
+                  "node location filename:\t" + node.location.file.name + "\n"
+            warnings.warn(msg, RuntimeWarning)
+            print("raised exception:\t", e)
+
+        # reversed so that nodes are found in the same order as by recursive walk
+        stack.extend(reversed(list(node.get_children())))
+
+    profiling.count('cursors_visited', nvisited)
+    profiling.count('cursors_pruned', npruned)
+    profiling.count('definitions_found', len(nodes_found) - nfound)
+
+
+def get_method_signature_key(node: Cursor, use_usr: bool = False) -> tuple:
+    '''
+    Calculate canonical signature of a function/method. Two nodes match each other
+    if their keys are equal. Key is calculated once per node so matching may be done
+    via dict lookup instead of pairwise comparison.
+    :param node: function/method cursor
+    :param use_usr: append Unified Symbol Resolution to the key
+    :return: key - tuple or None if libclang failed to provide node properties
+    '''
+    try:
+        # if parent of the FUNCTION is the filename than we must not use it
+        # as comparable functions belong to different files
+        if (node.kind == CursorKind.FUNCTION_DECL and
+                node.semantic_parent.kind == CursorKind.TRANSLATION_UNIT):
+            parent = None
         else:
-            if node.kind == CursorKind.CXX_METHOD and node.is_definition():
-                nodes_found.append(node)
-            elif node.kind == CursorKind.FUNCTION_DECL and node.is_definition():
-                nodes_found.append(node)
-            else:
-                for child in node.get_children():
-                    find_method_def_nodes(child, nodes_found, location_filename)
+            parent = node.semantic_parent.displayname
+        key = (node.kind.name,
+               node.is_definition(),
+               node.is_const_method(),
+               node.is_virtual_method(),
+               node.is_static_method(),
+               node.spelling,
+               node.type.spelling,
+               parent)
+        if use_usr:
+            key += (node.get_usr(),)
+        return key
     except ValueError as e:
         msg = "Warning:\n" \
               "an exception were raised by libclang\n" \
@@ -116,50 +238,46 @@ def find_method_def_nodes(node: Cursor, nodes_found: list, location_filename=str
               "node location filename:\t" + node.location.file.name + "\n"
         warnings.warn(msg, RuntimeWarning)
         print("raised exception:\t", e)
-        for child in node.get_children():
-            find_method_def_nodes(child, nodes_found, location_filename)
+
+
+def format_signature_key(key: tuple) -> str:
+    '''
+    Format signature key as `parent::spelling->type` for messages.
+    :param key: key as returned by `get_method_signature_key`
+    :return: str
+    '''
+    return f"{key[7]}::{key[5]}->{key[6]}"
+
+
+def build_signature_index(nodes: list, use_usr: bool = False) -> dict:
+    '''
+    Build index of function/method nodes by their signature keys.
+    :param nodes: list of function/method cursors
+    :param use_usr: append Unified Symbol Resolution to the keys
+    :return: signature_index - dict where key is signature key and value is list of nodes
+    (more than one node means that the key is ambiguous)
+    '''
+    signature_index = {}
+    for node in nodes:
+        key = get_method_signature_key(node, use_usr)
+        if key is not None:
+            signature_index.setdefault(key, []).append(node)
+    return signature_index
 
 
 def find_method_matching_node(reference_node: Cursor, nodes: list) -> Cursor:
     if reference_node:
+        reference_key = get_method_signature_key(reference_node)
+        if reference_key is None:
+            return None
         for node in nodes:
-            if compare_method_nodes(reference_node, node):
+            if get_method_signature_key(node) == reference_key:
                 return node
 
 
 def compare_method_nodes(node_1: Cursor, node_2: Cursor) -> bool:
-    try:
-        if (node_1.kind == node_2.kind and
-                node_1.is_definition() == node_2.is_definition() and
-                node_1.is_const_method() == node_2.is_const_method() and
-                node_1.is_virtual_method() == node_2.is_virtual_method() and
-                node_1.is_static_method() == node_2.is_static_method() and
-                node_1.spelling == node_2.spelling and
-                node_1.type.spelling == node_2.type.spelling):
-            # if parent of one of the comparable FUNCTION is the filename than
-            # we must not compare their parent as they belongs to different files
-            if (node_1.kind == CursorKind.FUNCTION_DECL and
-                    node_2.kind == CursorKind.FUNCTION_DECL and
-                    node_1.semantic_parent.kind == CursorKind.TRANSLATION_UNIT and
-                    node_2.semantic_parent.kind == CursorKind.TRANSLATION_UNIT):
-                return True
-            else:
-                return node_1.semantic_parent.displayname == node_2.semantic_parent.displayname
-    except ValueError as e:
-        msg = "Warning:\n" \
-              "an exception were raised by libclang\n" \
-              "node_1 spelling:\t" + node_1.spelling + "\n" + \
-              "node_2 spelling:\t" + node_2.spelling + "\n" + \
-              "node_1 display:\t" + node_1.displayname + "\n" + \
-              "node_2 display:\t" + node_2.displayname + "\n" + \
-              "node_1 mangled name:\t" + node_1.mangled_name + "\n" + \
-              "node_2 mangled name:\t" + node_2.mangled_name + "\n" + \
-              "node_1 location filename:\t" + node_1.location.file.name + "\n" + \
-              "node_2 location filename:\t" + node_2.location.file.name + "\n"
-        warnings.warn(msg, RuntimeWarning)
-        print("raised exception:\t", e)
-
-    return False
+    key_1 = get_method_signature_key(node_1)
+    return key_1 is not None and key_1 == get_method_signature_key(node_2)
 
 
 # Comparing types is more difficult than I expected. Two classes with same name
@@ -184,6 +302,964 @@ def compare_method_argument_types(node_1: Cursor, node_2: Cursor) -> bool:
     return is_equal
 
 
+def edit_file(index: Index, srcfile: str, destfile: str, clangcmd: list,
+              oldfile_del: bool = False, print_diagnostics: bool = True,
+              cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE,
+              fast_discovery: bool = False, use_usr: bool = False, pch_headers: list = None,
+              mode: str = 'write', lexer_only: bool = False,
+              diagnostics_severity: int = Diagnostic.Warning, dest_index: Index = None) -> (list, str):
+    '''
+    Replace function/method definitions in `destfile` by the ones found in `srcfile`.
+    Destination file is not touched if none of its definitions differ from the source ones.
+    It is the file counterpart of `edit_text` rather than a wrapper around it: both match definitions
+    and select the changed ones the same way (`prepare_edit`), but files are memory-mapped and the new
+    version is streamed to the disk instead of being built in memory.
+    :param index: clang index used to parse both files
+    :param srcfile: file with new functions definitions
+    :param destfile: file with old functions definitions
+    :param clangcmd: list of clang arguments (without file name)
+    :param oldfile_del: delete old version of destination file instead of keeping it as `_OLD`
+    :param print_diagnostics: pprint clang diagnostics for both files
+    :param cache_dir: translation unit cache directory, `None` disables the cache
+    :param cache_size: max cache size in bytes
+    :param fast_discovery: skip function bodies of included headers while parsing
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :param pch_headers: list of common headers to be precompiled once and used by both files
+    :param mode: `write` - write destination file, `check` - only report definitions that differ,
+    `diff` - only report unified diff between destination file and its new version,
+    `drift` - only report definitions that differ and how many of the matched ones do
+    :param lexer_only: find definitions from the token streams of the files, nothing is parsed by libclang
+    (`index`, `clangcmd` and parse related arguments are ignored)
+    :param diagnostics_severity: print only diagnostics of this severity or higher
+    :param dest_index: clang index used to parse destination concurrently with source
+    (new one is created if `None`)
+    :return: changed, report - list of (start_offset, end_offset, replacement) spans that differ
+    from the destination definitions (ignoring whitespaces and comments) and report text (empty in `write` mode)
+    '''
+    if mode not in EDIT_MODES:
+        raise EditCppError(f"unknown mode: `{mode}`, available are: " + ', '.join(EDIT_MODES) + "\n")
+
+    if not os.path.isfile(srcfile):
+        raise EditCppError(f"specified source file doesn't exist:\n{srcfile}\n")
+
+    if not os.path.isfile(destfile):
+        raise EditCppError(f"specified destination file doesn't exist:\n{destfile}\n")
+
+    if lexer_only:
+        # files are scanned and definitions are sliced from the mapped files
+        with map_file(srcfile) as srcdata, map_file(destfile) as destdata:
+            spans = get_lexical_replacement_spans(srcdata, destdata, srcfile, destfile)
+            return patch_dest_data(destfile, destdata, spans, oldfile_del, mode)
+
+    options = FAST_DISCOVERY_PARSE_OPTIONS if fast_discovery else 0
+    if pch_headers:
+        # build PCH once before both files are parsed concurrently
+        for extension in {os.path.splitext(srcfile)[1], os.path.splitext(destfile)[1]}:
+            get_pch_args(index, pch_headers, clangcmd, extension, cache_dir, cache_size)
+
+    def parse(index, filename):
+        with profiling.phase('parse'):
+            return parse_tu(index, filename, clangcmd, options, cache_dir, cache_size, pch_headers)
+
+    (tu_src, diag_src), (tu_dest, diag_dest) = parse_concurrently(
+        index, lambda index: parse(index, srcfile), lambda index: parse(index, destfile), dest_index)
+    if not tu_src:
+        raise EditCppError(f"clang unable to load source file:\n{srcfile}\n")
+    if not tu_dest:
+        raise EditCppError(f"clang unable to load destination file:\n{destfile}\n")
+
+    if print_diagnostics:
+        with profiling.phase('diagnostics'):
+            # print information about unknown files/functions/methods
+            pprint(('diagnostics in SOURCE:\t'+srcfile, select_diagnostics(diag_src, diagnostics_severity)))
+            pprint(('diagnostics in DESTINATION:\t'+destfile, select_diagnostics(diag_dest, diagnostics_severity)))
+
+    # libclang offsets are in bytes, definitions are sliced from the mapped files
+    with map_file(srcfile) as srcdata, map_file(destfile) as destdata:
+        spans = get_replacement_spans(tu_src, tu_dest, srcfile, destfile, srcdata, use_usr, match_by_name=True)
+        return patch_dest_data(destfile, destdata, spans, oldfile_del, mode)
+
+
+EDIT_MODES = ('write', 'check', 'diff', 'drift')
+
+
+def parse_concurrently(index: Index, parse_src, parse_dest, dest_index: Index = None) -> tuple:
+    '''
+    Parse source and destination translation units at the same time. Destination is parsed by another
+    thread with its own clang index (index must not be shared between threads), libclang releases
+    the GIL while it parses.
+    :param index: clang index used to parse source
+    :param parse_src: callable that takes clang index and parses source
+    :param parse_dest: callable that takes clang index and parses destination
+    :param dest_index: clang index used to parse destination (new one is created if `None`)
+    :return: src_result, dest_result - values returned by `parse_src` and `parse_dest`
+    '''
+    dest_index = dest_index or Index.create()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        dest_future = pool.submit(lambda: parse_dest(dest_index))
+        src_result = parse_src(index)
+        return src_result, dest_future.result()
+
+
+def patch_dest_data(destfile: str, destdata: bytes, spans: list, oldfile_del: bool = False,
+                    mode: str = 'write') -> (list, str):
+    '''
+    Apply the spans whose replacement differs from the destination definition and finish the edit.
+    :param destfile: destination file name
+    :param destdata: current content of destination file (bytes or mmap)
+    :param spans: list of (start_offset, end_offset, replacement) tuples of all matched definitions
+    :param oldfile_del: delete old version of destination file instead of keeping it as `_OLD`
+    :param mode: `write`, `check`, `diff` or `drift`
+    :return: changed, report - applied spans and report text (empty in `write` mode)
+    '''
+    changed = prepare_edit(destfile, destdata, spans)
+    return changed, finish_edit(destfile, destdata, changed, oldfile_del, mode, len(spans))
+
+
+def prepare_edit(destfile: str, destdata: bytes, spans: list) -> list:
+    '''
+    Select the spans whose replacement differs from the destination definition and check that they
+    may be applied. Every edit (files, texts, server requests) goes through it before anything is spliced.
+    :param destfile: destination file name (for messages)
+    :param destdata: current content of destination file (bytes or mmap)
+    :param spans: list of (start_offset, end_offset, replacement) tuples of all matched definitions
+    :return: changed - list of spans
+    '''
+    changed = get_changed_spans(destdata, spans)
+    try:
+        check_spans(changed, len(destdata))
+    except ValueError as e:
+        raise EditCppError(f"unable to replace functions/methods in destination file:\n{destfile}\n{e}\n")
+    return changed
+
+
+def finish_edit(destfile: str, olddata: bytes, changed: list,
+                oldfile_del: bool = False, mode: str = 'write', nmatched: int = None) -> str:
+    '''
+    Write new version of destination file (only if it differs from the old one) or report the changes.
+    New version is streamed to the disk, it is built in memory only for `diff` mode.
+    :param destfile: destination file name
+    :param olddata: current content of destination file (bytes or mmap)
+    :param changed: spans that differ from the destination definitions
+    :param oldfile_del: delete old version of destination file instead of keeping it as `_OLD`
+    :param mode: `write`, `check`, `diff` or `drift`
+    :param nmatched: number of matched definitions (for `drift` report)
+    :return: report - text to be printed (empty in `write` mode)
+    '''
+    if mode == 'check':
+        return format_changed_definitions(destfile, olddata, changed)
+    if mode == 'drift':
+        nmatched = len(changed) if nmatched is None else nmatched
+        return (format_changed_definitions(destfile, olddata, changed) +
+                f"{destfile}: {len(changed)} of {nmatched} definition(s) drifted from the source\n")
+    if mode == 'diff':
+        # unified diff needs both versions in memory anyway
+        olddata = olddata[:]
+        with profiling.phase('splice'):
+            newdata = apply_spans(olddata, changed)
+        return format_diff(destfile, olddata, newdata)
+    if changed:
+        with profiling.phase('write'):
+            write_dest_file(destfile, olddata, oldfile_del, changed)
+    return ''
+
+
+def get_changed_spans(data: bytes, spans: list) -> list:
+    '''
+    Select spans whose replacement differs from the text they replace. Texts that are not equal byte to byte
+    are compared by their fingerprints (hashes of token streams) so the definitions that differ only
+    in whitespaces and comments are left as they are.
+    :param data: original data
+    :param spans: list of (start_offset, end_offset, replacement) tuples
+    :return: changed - list of spans
+    '''
+    changed = []
+    with profiling.phase('fingerprint'):
+        for span in spans:
+            text = data[span[0]:span[1]]
+            if text == span[2]:
+                continue
+            profiling.count('fingerprints', 2)
+            if fingerprint(text) != fingerprint(span[2]):
+                changed.append(span)
+    return changed
+
+
+def format_changed_definitions(destfile: str, data: bytes, changed: list) -> str:
+    '''
+    Format `file:line: first line of definition` for every changed definition.
+    :param destfile: destination file name
+    :param data: original content of destination file
+    :param changed: spans that differ from the destination definitions
+    :return: report
+    '''
+    lines = []
+    line = 1
+    pos = 0
+    for start, end, _ in sorted(changed, key=lambda span: span[0]):
+        line += count_newlines(data, pos, start)
+        pos = start
+        eol = data.find(b'\n', start, end)
+        signature = data[start:end if eol < 0 else eol].decode('utf-8', errors='replace').strip()
+        lines.append(f"{destfile}:{line}: {signature}\n")
+    return ''.join(lines)
+
+
+def count_newlines(data, start: int, end: int) -> int:
+    '''
+    Count line feeds in `data[start:end]` chunk by chunk (mmap doesn't have `count`).
+    :param data: bytes or mmap
+    :return: count
+    '''
+    count = 0
+    for chunk_start in range(start, end, CHUNK_SIZE):
+        count += data[chunk_start:min(chunk_start + CHUNK_SIZE, end)].count(b'\n')
+    return count
+
+
+def format_diff(destfile: str, olddata: bytes, newdata: bytes) -> str:
+    '''
+    Get unified diff between old and new versions of destination file.
+    :param destfile: destination file name
+    :param olddata: current content of destination file
+    :param newdata: new content of destination file
+    :return: diff - empty if files are identical
+    '''
+    if olddata == newdata:
+        return ''
+    oldlines = olddata.decode('utf-8', errors='replace').splitlines(keepends=True)
+    newlines = newdata.decode('utf-8', errors='replace').splitlines(keepends=True)
+    diff = []
+    for line in difflib.unified_diff(oldlines, newlines, fromfile=destfile, tofile=destfile):
+        diff.append(line)
+        if not line.endswith('\n'):
+            diff.append('\n\\ No newline at end of file\n')
+    return ''.join(diff)
+
+
+def edit_text(src_text, dest_text, clangcmd: list = None, src_filename: str = 'src.cpp',
+              dest_filename: str = 'dest.cpp', index: Index = None, fast_discovery: bool = False,
+              use_usr: bool = False, tu_src: TranslationUnit = None, tu_dest: TranslationUnit = None,
+              lexer_only: bool = False, dest_index: Index = None) -> tuple:
+    '''
+    Replace function/method definitions in `dest_text` by the ones found in `src_text`.
+    Texts are passed to libclang as unsaved files, nothing is read from or written to the disk
+    (except for the headers the texts include).
+    :param src_text: str or bytes with new functions definitions
+    :param dest_text: str or bytes with old functions definitions
+    :param clangcmd: list of clang arguments (without file name)
+    :param src_filename: file name of `src_text` as libclang sees it (the file doesn't have to exist)
+    :param dest_filename: file name of `dest_text` as libclang sees it (the file doesn't have to exist)
+    :param index: clang index (new one is created if needed)
+    :param fast_discovery: skip function bodies of included headers while parsing
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :param tu_src: already parsed source translation unit (`src_text` must be its content)
+    :param tu_dest: already parsed destination translation unit (`dest_text` must be its content)
+    :param lexer_only: find definitions from the token streams of the texts, nothing is parsed by libclang
+    :param dest_index: clang index used to parse destination concurrently with source
+    (new one is created if `None`)
+    :return: patched_text, spans - patched destination (same type as `dest_text`) and list of applied
+    (start_offset, end_offset, replacement) tuples, offsets are in bytes of the original destination.
+    Definitions that differ from the source ones only in whitespaces and comments are not replaced
+    '''
+    srcdata = src_text.encode('utf-8') if isinstance(src_text, str) else src_text
+    destdata = dest_text.encode('utf-8') if isinstance(dest_text, str) else dest_text
+    if lexer_only:
+        spans = get_lexical_replacement_spans(srcdata, destdata, src_filename, dest_filename)
+        return _apply_edit(dest_text, destdata, prepare_edit(dest_filename, destdata, spans))
+
+    clangcmd = list(clangcmd or [])
+    unsaved_files = [(src_filename, srcdata), (dest_filename, destdata)]
+    options = FAST_DISCOVERY_PARSE_OPTIONS if fast_discovery else 0
+    if tu_src is None or tu_dest is None:
+        index = index or Index.create()
+
+    def parse(index, filename):
+        with profiling.phase('parse'):
+            return index.parse(filename, clangcmd, unsaved_files, options)
+
+    if tu_src is None and tu_dest is None:
+        tu_src, tu_dest = parse_concurrently(index, lambda index: parse(index, src_filename),
+                                             lambda index: parse(index, dest_filename), dest_index)
+    elif tu_src is None:
+        tu_src = parse(index, src_filename)
+    elif tu_dest is None:
+        tu_dest = parse(index, dest_filename)
+
+    spans = get_replacement_spans(tu_src, tu_dest, src_filename, dest_filename, srcdata, use_usr,
+                                  match_by_name=True)
+    return _apply_edit(dest_text, destdata, prepare_edit(dest_filename, destdata, spans))
+
+
+def _apply_edit(dest_text, destdata: bytes, spans: list) -> tuple:
+    with profiling.phase('splice'):
+        destdata = apply_spans(destdata, spans)
+    if isinstance(dest_text, str):
+        return destdata.decode('utf-8'), spans
+    return destdata, spans
+
+
+def get_name_filter(filename: str):
+    '''
+    Get file filter that compares file names instead of file identities (works with unsaved files).
+    Translation units loaded from AST files report absolute file names so they are compared too.
+    :param filename: file name as it was passed to libclang
+    :return: file_filter - callable that takes file name reported by libclang
+    '''
+    abs_filename = os.path.abspath(filename)
+    return lambda name: name == filename or os.path.abspath(name) == abs_filename
+
+
+def get_replacement_spans(tu_src: TranslationUnit, tu_dest: TranslationUnit, srcfile: str, destfile: str,
+                          srcdata: bytes, use_usr: bool = False, match_by_name: bool = False) -> list:
+    '''
+    Find function/method definitions in both files and match them.
+    :param tu_src: translation unit of source file
+    :param tu_dest: translation unit of destination file
+    :param srcfile: file with new functions definitions
+    :param destfile: file with old functions definitions
+    :param srcdata: content of source file (the one libclang has parsed)
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :param match_by_name: select definitions by comparing file names reported by libclang to `srcfile`
+    and `destfile` instead of file identities (no `stat` calls, works with unsaved files)
+    :return: spans - list of (start_offset, end_offset, replacement) tuples to be applied to destination
+    '''
+    method_def_nodes_src = find_file_definitions(tu_src, srcfile, 'source', match_by_name)
+    method_def_nodes_dest = find_file_definitions(tu_dest, destfile, 'destination', match_by_name)
+    with profiling.phase('matching'):
+        return match_definitions(method_def_nodes_src, method_def_nodes_dest, srcdata, use_usr)
+
+
+def find_file_definitions(tu: TranslationUnit, filename: str, role: str, match_by_name: bool = False) -> list:
+    '''
+    Find function/method definitions of the main file of translation unit.
+    :param tu: translation unit
+    :param filename: main file of translation unit
+    :param role: `source` or `destination` (for messages)
+    :param match_by_name: select definitions by comparing file names instead of file identities
+    (see `get_replacement_spans`)
+    :return: method_def_nodes - list of cursors, `EditCppError` is raised if there are none
+    '''
+    method_def_nodes = []
+    with profiling.phase('find_definitions'):
+        if match_by_name:
+            find_method_def_nodes(tu.cursor, method_def_nodes, file_filter=get_name_filter(filename))
+        else:
+            find_method_def_nodes(tu.cursor, method_def_nodes, filename)
+    if not method_def_nodes:
+        raise get_no_definitions_error(filename, role)
+    return method_def_nodes
+
+
+def get_no_definitions_error(filename: str, role: str, lexer_only: bool = False) -> EditCppError:
+    '''
+    :param filename: file without definitions
+    :param role: `source` or `destination`
+    :param lexer_only: definitions were searched by `lexmatch`
+    :return: error to be raised
+    '''
+    msg = f"unable to find any function/method definition in {role} file:\n{filename}\n"
+    if not lexer_only:
+        msg += "probably you forgot to pass `-std=c++03` (or higher) flag?\n"
+    return EditCppError(msg)
+
+
+def get_node_label(node: Cursor) -> str:
+    '''
+    Describe function/method as `parent::spelling->type` for messages.
+    '''
+    return f"{node.semantic_parent.displayname}::{node.spelling}->{node.type.spelling}"
+
+
+def match_definitions(method_def_nodes_src: list, method_def_nodes_dest: list, srcdata: bytes,
+                      use_usr: bool = False) -> list:
+    '''
+    Match every source definition to exactly one destination definition by signature key.
+    :param method_def_nodes_src: source function/method definitions
+    :param method_def_nodes_dest: destination function/method definitions
+    :param srcdata: content of source file (the one libclang has parsed)
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :return: spans - list of (start_offset, end_offset, replacement) tuples to be applied to destination
+    '''
+    src_definitions = get_source_definitions(method_def_nodes_src, srcdata, use_usr)
+    return match_source_definitions(src_definitions, method_def_nodes_dest, use_usr)
+
+
+def get_source_definitions(method_def_nodes_src: list, srcdata: bytes, use_usr: bool = False) -> list:
+    '''
+    Extract everything that is needed to match source definitions so that they may be matched
+    against any number of destination files without keeping the source translation unit.
+    :param method_def_nodes_src: source function/method definitions
+    :param srcdata: content of source file (the one libclang has parsed)
+    :param use_usr: append Unified Symbol Resolution to the keys
+    :return: src_definitions - list of (key, text, label) tuples
+    '''
+    return [(get_method_signature_key(node, use_usr),
+             srcdata[node.extent.start.offset:node.extent.end.offset],
+             get_node_label(node))
+            for node in method_def_nodes_src]
+
+
+def match_source_definitions(src_definitions: list, method_def_nodes_dest: list, use_usr: bool = False) -> list:
+    '''
+    Match every source definition to exactly one destination definition by signature key.
+    :param src_definitions: list of (key, text, label) tuples as returned by `get_source_definitions`
+    :param method_def_nodes_dest: destination function/method definitions
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :return: spans - list of (start_offset, end_offset, replacement) tuples to be applied to destination
+    '''
+    return match_signature_keys(src_definitions, build_signature_index(method_def_nodes_dest, use_usr),
+                                method_def_nodes_dest, get_node_label,
+                                lambda node: (node.extent.start.offset, node.extent.end.offset, node.extent.start.line),
+                                "also check is it definition? static? virtual? const?\n")
+
+
+def match_signature_keys(src_definitions: list, signature_index_dest: dict, definitions_dest: list,
+                         get_label, get_extent, hint: str) -> list:
+    '''
+    Match every source definition to exactly one destination definition by signature key.
+    Destination definitions are described only for error messages.
+    :param src_definitions: list of (key, text, label) tuples
+    :param signature_index_dest: dict where key is signature key and value is list of destination definitions
+    :param definitions_dest: all destination definitions (for messages)
+    :param get_label: callable that takes destination definition and returns its description
+    :param get_extent: callable that takes destination definition and returns (start_offset, end_offset, line)
+    :param hint: what else to check if a source definition doesn't match anything
+    :return: spans - list of (start_offset, end_offset, replacement) tuples to be applied to destination
+    '''
+    profiling.count('comparisons', len(src_definitions))
+    spans = []
+    for key, text, label in src_definitions:
+        matches = signature_index_dest.get(key)
+        if not matches:
+            raise EditCppError(get_unmatched_message(label, [get_label(d) for d in definitions_dest]) + hint)
+        if len(matches) > 1:
+            err_msg = (f"ambiguous source function/method, several destination functions/methods match it:\n" +
+                       f"\t{label}\n" +
+                       f"matching destination functions/methods:\n")
+            for definition in matches:
+                err_msg += f"\t{get_label(definition)}\tat line {get_extent(definition)[2]}\n"
+            raise EditCppError(err_msg)
+        start, end, _ = get_extent(matches[0])
+        spans.append((start, end, text))
+    return spans
+
+
+def get_unmatched_message(label: str, labels_dest: list = None) -> str:
+    '''
+    :param label: description of source definition that doesn't match any destination one
+    :param labels_dest: descriptions of all destination definitions (not listed if None)
+    :return: message
+    '''
+    msg = f"unable to find any destination function/method matching for a source function/method:\n\t{label}\n"
+    if labels_dest is not None:
+        msg += "found destination functions/methods:\n" + ''.join(f"\t{l}\n" for l in labels_dest)
+    return msg
+
+
+def reserve_unique_filename(filename: str) -> str:
+    '''
+    Create empty file with unique name by adding `_i` to the name (`myfile.cpp` becomes `myfile_0.cpp`).
+    The file is created exclusively so the directory isn't listed and concurrent runs never get the same name.
+    :param filename: base name for a file
+    :return: uniquename - name of the created file
+    '''
+    basename, extension = os.path.splitext(filename)
+    uniquename = filename
+    i = 0
+    while True:
+        try:
+            os.close(os.open(uniquename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return uniquename
+        except FileExistsError:
+            uniquename = basename + '_' + str(i) + extension
+            i += 1
+
+
+def get_lexical_replacement_spans(srcdata: bytes, destdata: bytes, srcfile: str, destfile: str) -> list:
+    '''
+    Same as `get_replacement_spans` but definitions are found by `lexmatch.find_lexical_definitions`:
+    no headers are needed. `virtual` and `static` are not compared as they are not repeated
+    by out-of-class definitions.
+    :param srcdata: content of source file
+    :param destdata: content of destination file
+    :param srcfile: file with new functions definitions (for messages)
+    :param destfile: file with old functions definitions (for messages)
+    :return: spans - list of (start_offset, end_offset, replacement) tuples to be applied to destination
+    '''
+    src_definitions = get_lexical_source_definitions(srcdata, srcfile)
+    return match_lexical_source_definitions(src_definitions, destdata, destfile)
+
+
+def get_lexical_source_definitions(srcdata: bytes, srcfile: str) -> list:
+    '''
+    Same as `get_source_definitions` but definitions are found by `lexmatch.find_lexical_definitions`.
+    :param srcdata: content of source file
+    :param srcfile: file with new functions definitions (for messages)
+    :return: src_definitions - list of (key, text, label) tuples
+    '''
+    with profiling.phase('find_definitions'):
+        records_src = find_lexical_definitions(srcdata)
+    if not records_src:
+        raise get_no_definitions_error(srcfile, 'source', lexer_only=True)
+    profiling.count('definitions_found', len(records_src))
+    return [(key, srcdata[start:end], f"{format_signature_key(key)}\tat line {line}")
+            for key, start, end, line in records_src]
+
+
+def match_lexical_source_definitions(src_definitions: list, destdata: bytes, destfile: str) -> list:
+    '''
+    Find definitions of destination file by `lexmatch.find_lexical_definitions` and match
+    every source definition to exactly one of them.
+    :param src_definitions: list of (key, text, label) tuples as returned by `get_lexical_source_definitions`
+    :param destdata: content of destination file
+    :param destfile: file with old functions definitions (for messages)
+    :return: spans - list of (start_offset, end_offset, replacement) tuples to be applied to destination
+    '''
+    with profiling.phase('find_definitions'):
+        records_dest = find_lexical_definitions(destdata)
+    if not records_dest:
+        raise get_no_definitions_error(destfile, 'destination', lexer_only=True)
+    profiling.count('definitions_found', len(records_dest))
+
+    with profiling.phase('matching'):
+        signature_index_dest = {}
+        for record in records_dest:
+            signature_index_dest.setdefault(record[0], []).append(record)
+        return match_signature_keys(src_definitions, signature_index_dest, records_dest,
+                                    lambda record: format_signature_key(record[0]), lambda record: record[1:],
+                                    "also check is it definition? const?\n")
+
+
+def write_dest_file(destfile: str, data: bytes, oldfile_del: bool = False, spans: list = None):
+    '''
+    Atomically replace destination file by its new version: the data is written to a temporary file
+    that then replaces the destination. Old version is either deleted or kept as a copy with `_OLD` suffix.
+    :param destfile: destination file name
+    :param data: new content of the file or, if `spans` are given, its old content (bytes or mmap)
+    :param oldfile_del: delete old version of destination file instead of keeping it as `_OLD`
+    :param spans: list of (start_offset, end_offset, replacement) tuples to be applied to `data`
+    while it is written chunk by chunk
+    '''
+    destdir = os.path.dirname(os.path.abspath(destfile))
+    fd, tmpfile = tempfile.mkstemp(prefix='.' + os.path.basename(destfile) + '.', suffix='.tmp', dir=destdir)
+    try:
+        with os.fdopen(fd, mode='wb') as file:
+            if spans is None:
+                size = file.write(data)
+            else:
+                with profiling.phase('splice'):
+                    size = write_spans(file, data, spans)
+        shutil.copymode(destfile, tmpfile)
+
+        if not oldfile_del:
+            filename, file_extension = os.path.splitext(destfile)
+            shutil.copy2(destfile, reserve_unique_filename(filename + '_OLD' + file_extension))
+
+        os.replace(tmpfile, destfile)
+    except BaseException:
+        try:
+            os.remove(tmpfile)
+        except OSError:
+            pass
+        raise
+    profiling.count('bytes_written', size)
+
+
+def load_manifest(manifest: str) -> list:
+    '''
+    Load src/dest pairs from JSON or TOML manifest.
+    Manifest is either a list of pairs or a table with `pairs` list.
+    Each pair has `src_file`, `dest_file` and optional `clang_args` and `oldfile_delete` keys.
+    Relative paths are resolved against the manifest directory.
+    :param manifest: path to `.json` or `.toml` file
+    :return: pairs - list of dict with `src_file`, `dest_file`, `clang_args` and `oldfile_delete` keys
+    '''
+    if os.path.splitext(manifest)[1].lower() == '.toml':
+        try:
+            import tomllib
+            with open(manifest, mode='rb') as file:
+                data = tomllib.load(file)
+        except ImportError:
+            try:
+                import toml
+            except ImportError:
+                raise EditCppError("TOML manifest requires Python 3.11+ or `toml` package, "
+                                   "use JSON manifest instead\n")
+            with open(manifest, mode='r') as file:
+                data = toml.load(file)
+    else:
+        with open(manifest, mode='r') as file:
+            data = json.load(file)
+
+    if isinstance(data, dict):
+        data = data.get('pairs', [])
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    pairs = []
+    for i, item in enumerate(data):
+        if 'src_file' not in item or 'dest_file' not in item:
+            raise EditCppError(f"manifest pair #{i} must have both `src_file` and `dest_file`:\n{item}\n")
+        pairs.append({'src_file': os.path.join(manifest_dir, item['src_file']),
+                      'dest_file': os.path.join(manifest_dir, item['dest_file']),
+                      'clang_args': list(item.get('clang_args', [])),
+                      'oldfile_delete': item.get('oldfile_delete', None)})
+    return pairs
+
+
+class EditOptions:
+    '''
+    Options shared by all the files processed by a pool of worker processes (see `edit_file`).
+    '''
+
+    def __init__(self, cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE, fast_discovery: bool = False,
+                 use_usr: bool = False, pch_headers: list = None, mode: str = 'write', lexer_only: bool = False):
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.fast_discovery = fast_discovery
+        self.use_usr = use_usr
+        self.pch_headers = pch_headers
+        self.mode = mode
+        self.lexer_only = lexer_only
+
+    @property
+    def parse_options(self) -> int:
+        return FAST_DISCOVERY_PARSE_OPTIONS if self.fast_discovery else 0
+
+
+def make_result(src_file: str, dest_file: str) -> dict:
+    '''
+    :return: result - dict with `src_file`, `dest_file`, `ok`, `message`, `changed` (number of changed definitions)
+    and `report` keys, it is not `ok` until processing succeeds
+    '''
+    return {'src_file': src_file,
+            'dest_file': dest_file,
+            'ok': False,
+            'message': '',
+            'changed': 0,
+            'report': ''}
+
+
+def get_error_message(e: Exception) -> str:
+    '''
+    :return: message of `EditCppError` as it is, other exceptions are formatted by `format_exception`
+    '''
+    if isinstance(e, EditCppError):
+        return str(e)
+    return format_exception(e)
+
+
+def _edit_pairs(options: EditOptions, pairs: list) -> list:
+    results = []
+    for pair in pairs:
+        result = make_result(pair['src_file'], pair['dest_file'])
+        try:
+            changed, result['report'] = edit_file(get_worker_index(), pair['src_file'], pair['dest_file'],
+                                                  pair['clang_args'], pair['oldfile_delete'],
+                                                  print_diagnostics=False, cache_dir=options.cache_dir,
+                                                  cache_size=options.cache_size,
+                                                  fast_discovery=options.fast_discovery,
+                                                  use_usr=options.use_usr, pch_headers=options.pch_headers,
+                                                  mode=options.mode, lexer_only=options.lexer_only,
+                                                  dest_index=get_worker_index('dest'))
+            result['changed'] = len(changed)
+            result['ok'] = True
+        except Exception as e:
+            result['message'] = get_error_message(e)
+        results.append(result)
+    return results
+
+
+def run_manifest(pairs: list, jobs: int = None, cache_dir: str = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE, fast_discovery: bool = False,
+                 use_usr: bool = False, pch_headers: list = None, mode: str = 'write',
+                 lexer_only: bool = False) -> list:
+    '''
+    Process src/dest pairs on a pool of worker processes.
+    Pairs that share destination file are processed sequentially by the same worker.
+    :param pairs: list of dict as returned by `load_manifest`
+    :param jobs: number of worker processes (number of cores by default)
+    :param cache_dir: translation unit cache directory, `None` disables the cache
+    :param cache_size: max cache size in bytes
+    :param fast_discovery: skip function bodies of included headers while parsing
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :param pch_headers: list of common headers to be precompiled once and used by all the files
+    :param mode: `write`, `check`, `diff` or `drift` (see `edit_file`)
+    :param lexer_only: find definitions from the token streams of the files, nothing is parsed by libclang
+    :return: results - list of dict with `src_file`, `dest_file`, `ok`, `message`, `changed`
+    (number of changed definitions) and `report` keys
+    '''
+    groups = {}
+    for pair in pairs:
+        key = os.path.normcase(os.path.abspath(pair['dest_file']))
+        groups.setdefault(key, []).append(pair)
+    if not groups:
+        return []
+
+    if pch_headers and not lexer_only:
+        # build PCHs before workers start so that they don't build the same PCH concurrently
+        index = Index.create()
+        for pair in pairs:
+            for filename in (pair['src_file'], pair['dest_file']):
+                get_pch_args(index, pch_headers, pair['clang_args'], os.path.splitext(filename)[1],
+                             cache_dir, cache_size)
+
+    jobs = min(jobs or os.cpu_count() or 1, len(groups))
+    options = EditOptions(cache_dir, cache_size, fast_discovery, use_usr, pch_headers, mode, lexer_only)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = []
+        for group_results in pool.map(functools.partial(_edit_pairs, options), groups.values()):
+            results.extend(group_results)
+    return results
+
+
+def _edit_dest_file(options: EditOptions, src_file: str, src_definitions: list, clang_args: list,
+                    oldfile_del: bool, destfile: str) -> dict:
+    result = make_result(src_file, destfile)
+    try:
+        if not os.path.isfile(destfile):
+            raise EditCppError(f"specified destination file doesn't exist:\n{destfile}\n")
+        if options.lexer_only:
+            with map_file(destfile) as destdata:
+                spans = match_lexical_source_definitions(src_definitions, destdata, destfile)
+        else:
+            tu, _ = parse_tu(get_worker_index(), destfile, clang_args, options.parse_options,
+                             options.cache_dir, options.cache_size, options.pch_headers)
+            nodes = find_file_definitions(tu, destfile, 'destination')
+            spans = match_source_definitions(src_definitions, nodes, options.use_usr)
+        with map_file(destfile) as destdata:
+            changed, result['report'] = patch_dest_data(destfile, destdata, spans, oldfile_del, options.mode)
+        result['changed'] = len(changed)
+        result['ok'] = True
+    except Exception as e:
+        result['message'] = get_error_message(e)
+    return result
+
+
+def edit_files(srcfile: str, destfiles: list, clangcmd: list, oldfile_del: bool = False, jobs: int = None,
+               cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE, fast_discovery: bool = False,
+               use_usr: bool = False, pch_headers: list = None, mode: str = 'write',
+               lexer_only: bool = False) -> list:
+    '''
+    Replace function/method definitions in every destination file by the ones found in `srcfile`.
+    Source file is parsed once, its signature keys and definition texts are sent to a pool of worker
+    processes that parse and patch destination files in parallel.
+    :param srcfile: file with new functions definitions
+    :param destfiles: list of files with old functions definitions
+    :param clangcmd: list of clang arguments (without file name)
+    :param oldfile_del: delete old versions of destination files instead of keeping them as `_OLD`
+    :param jobs: number of worker processes (number of cores by default)
+    :param cache_dir: translation unit cache directory, `None` disables the cache
+    :param cache_size: max cache size in bytes
+    :param fast_discovery: skip function bodies of included headers while parsing
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :param pch_headers: list of common headers to be precompiled once and used by all the files
+    :param mode: `write`, `check`, `diff` or `drift` (see `edit_file`)
+    :param lexer_only: find definitions from the token streams of the files, nothing is parsed by libclang
+    :return: results - list of dict with `src_file`, `dest_file`, `ok`, `message`, `changed`
+    (number of changed definitions) and `report` keys
+    '''
+    if not os.path.isfile(srcfile):
+        raise EditCppError(f"specified source file doesn't exist:\n{srcfile}\n")
+
+    options = EditOptions(cache_dir, cache_size, fast_discovery, use_usr, pch_headers, mode, lexer_only)
+    if lexer_only:
+        with map_file(srcfile) as srcdata:
+            src_definitions = get_lexical_source_definitions(srcdata, srcfile)
+    else:
+        index = Index.create()
+        with profiling.phase('parse'):
+            tu_src, _ = parse_tu(index, srcfile, clangcmd, options.parse_options, cache_dir, cache_size, pch_headers)
+        nodes = find_file_definitions(tu_src, srcfile, 'source')
+        with map_file(srcfile) as srcdata:
+            src_definitions = get_source_definitions(nodes, srcdata, use_usr)
+
+    jobs = min(jobs or os.cpu_count() or 1, len(destfiles))
+    with profiling.phase('destination_files'), \
+            ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(functools.partial(_edit_dest_file, options, srcfile, src_definitions,
+                                               list(clangcmd), oldfile_del), destfiles))
+
+
+def expand_dest_files(patterns: list) -> list:
+    '''
+    Expand glob patterns (`**` matches any subdirectories), other names are kept as they are.
+    Each file is listed once even if several patterns match it.
+    :param patterns: list of file names and/or glob patterns
+    :return: destfiles - list of file names
+    '''
+    destfiles = []
+    seen = set()
+    for pattern in patterns:
+        names = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for name in names:
+            key = os.path.normcase(os.path.abspath(name))
+            if key not in seen:
+                seen.add(key)
+                destfiles.append(name)
+    return destfiles
+
+
+def _find_project_definitions(options: EditOptions, project_root: str, exclude_dir: str, src_keys: set,
+                              entry: dict) -> dict:
+    result = {'file': entry['file'],
+              'ok': False,
+              'message': '',
+              'definitions': []}
+    try:
+        tu, diagnostics = parse_tu(get_worker_index(), entry['file'], entry['clang_args'],
+                                   cache_dir=options.cache_dir,
+                                   cache_size=options.cache_size,
+                                   pch_headers=options.pch_headers)
+        nodes = []
+        find_method_def_nodes(tu.cursor, nodes, file_filter=lambda filename: (
+            is_subpath(filename, project_root) and not is_subpath(filename, exclude_dir)))
+        for node in nodes:
+            key = get_method_signature_key(node, options.use_usr)
+            if key in src_keys:
+                result['definitions'].append((os.path.realpath(node.location.file.name), key,
+                                              node.extent.start.offset, node.extent.end.offset))
+        result['ok'] = True
+    except Exception as e:
+        result['message'] = get_error_message(e)
+    return result
+
+
+def edit_project(compile_commands: str, src_dir: str, clangcmd: list, project_root: str = None,
+                 jobs: int = None, oldfile_del: bool = False, cache_dir: str = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE, use_usr: bool = False, pch_headers: list = None,
+                 mode: str = 'write') -> list:
+    '''
+    Replace function/method definitions in all the project files by the ones found in `src_dir`.
+    Every translation unit of compilation database is parsed (in parallel) with its own flags and
+    definitions are searched in all the project files it includes. Each destination file is edited once
+    even if it is included by many translation units.
+    :param compile_commands: path to `compile_commands.json` or to the directory where it resides
+    :param src_dir: directory with files that contain new functions definitions
+    :param clangcmd: list of clang arguments for source files that are not in compilation database
+    :param project_root: only files in this directory may be edited (current directory by default)
+    :param jobs: number of worker processes (number of cores by default)
+    :param oldfile_del: delete old version of destination files instead of keeping them as `_OLD`
+    :param cache_dir: translation unit cache directory, `None` disables the cache
+    :param cache_size: max cache size in bytes
+    :param use_usr: also require Unified Symbol Resolution of matching functions/methods to be equal
+    :param pch_headers: list of common headers to be precompiled (once per distinct set of flags)
+    :param mode: `write`, `check`, `diff` or `drift` (see `edit_file`)
+    :return: results - list of dict with `src_file`, `dest_file`, `ok`, `message`, `changed`
+    (number of changed definitions) and `report` keys
+    '''
+    entries = load_compile_commands(compile_commands)
+    entries_args = {os.path.normcase(e['file']): e['clang_args'] for e in entries}
+    project_root = project_root or os.getcwd()
+
+    # parse source files once and extract new definitions
+    index = Index.create()
+    src_texts = {}      # signature key -> (src file, definition text)
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() not in SOURCE_EXTENSIONS:
+                continue
+            srcfile = os.path.abspath(os.path.join(dirpath, filename))
+            args = entries_args.get(os.path.normcase(srcfile), clangcmd)
+            with profiling.phase('parse'):
+                tu_src, _ = parse_tu(index, srcfile, args, cache_dir=cache_dir, cache_size=cache_size,
+                                     pch_headers=pch_headers)
+            nodes = []
+            with profiling.phase('find_definitions'):
+                find_method_def_nodes(tu_src.cursor, nodes, srcfile)
+            with map_file(srcfile) as srcdata:
+                for node in nodes:
+                    key = get_method_signature_key(node, use_usr)
+                    if key is None:
+                        continue
+                    if key in src_texts:
+                        raise EditCppError(f"function/method is defined in several source files:\n"
+                                           f"\t{get_node_label(node)}\n"
+                                           f"\t{src_texts[key][0]}\n\t{srcfile}\n")
+                    src_texts[key] = (srcfile, srcdata[node.extent.start.offset:node.extent.end.offset])
+    if not src_texts:
+        raise EditCppError(f"unable to find any function/method definition in source directory:\n{src_dir}\n")
+
+    # find matching definitions in all translation units
+    results = []
+    dest_spans = {}     # dest file -> signature key -> set of (start, end)
+    options = EditOptions(cache_dir, cache_size, use_usr=use_usr, pch_headers=pch_headers, mode=mode)
+    if entries:
+        jobs = min(jobs or os.cpu_count() or 1, len(entries))
+        with profiling.phase('translation_units'), \
+                ProcessPoolExecutor(max_workers=jobs) as pool:
+            for tu_result in pool.map(functools.partial(_find_project_definitions, options, project_root,
+                                                          os.path.abspath(src_dir), set(src_texts)), entries):
+                if not tu_result['ok']:
+                    result = make_result(None, tu_result['file'])
+                    result['message'] = tu_result['message']
+                    results.append(result)
+                for destfile, key, start, end in tu_result['definitions']:
+                    dest_spans.setdefault(destfile, {}).setdefault(key, set()).add((start, end))
+
+    # edit each destination file once
+    for destfile in sorted(dest_spans):
+        result = make_result(None, destfile)
+        try:
+            spans = []
+            src_files = set()
+            for key, key_spans in dest_spans[destfile].items():
+                if len(key_spans) > 1:
+                    lines = ', '.join(str(start) for start, _ in sorted(key_spans))
+                    raise EditCppError(f"ambiguous function/method, it has different extents in "
+                                       f"different translation units (offsets {lines}):\n"
+                                       f"\t{format_signature_key(key)}\n")
+                start, end = next(iter(key_spans))
+                srcfile, text = src_texts[key]
+                src_files.add(srcfile)
+                spans.append((start, end, text))
+            with map_file(destfile) as destdata:
+                changed, result['report'] = patch_dest_data(destfile, destdata, spans, oldfile_del, mode)
+            result['src_file'] = ', '.join(sorted(src_files))
+            result['ok'] = True
+            result['changed'] = len(changed)
+            result['message'] = f"{len(changed)} of {len(spans)} definition(s) changed\n"
+        except EditCppError as e:
+            result['message'] = str(e)
+        results.append(result)
+
+    matched_keys = set()
+    for key_spans in dest_spans.values():
+        matched_keys.update(key_spans)
+    for key in src_texts:
+        if key not in matched_keys:
+            result = make_result(src_texts[key][0], None)
+            result['message'] = get_unmatched_message(format_signature_key(key))
+            results.append(result)
+    return results
+
+
+def print_results(results: list) -> int:
+    '''
+    Print success/failure summary followed by `check`/`diff` reports.
+    :param results: list of dict with `src_file`, `dest_file`, `ok` and `message` keys
+    (and optional `changed` and `report` keys)
+    :return: nfailed - number of failures
+    '''
+    nfailed = 0
+    nunchanged = 0
+    for result in results:
+        if result['ok']:
+            unchanged = result.get('changed', 1) == 0
+            nunchanged += unchanged
+            print(f"[ OK ] {result['src_file']} -> {result['dest_file']}" + (" (unchanged)" if unchanged else ""))
+        else:
+            nfailed += 1
+            print(f"[FAIL] {result['src_file']} -> {result['dest_file']}")
+            print('\t' + result['message'].rstrip().replace('\n', '\n\t'))
+    print(f"{len(results) - nfailed} succeeded, {nfailed} failed" +
+          (f" ({nunchanged} unchanged)" if nunchanged else ""))
+    for result in results:
+        if result.get('report'):
+            print(result['report'], end='')
+    return nfailed
+
+
 def main():
     parser = argparse.ArgumentParser(description=
                                      'Replace C++ function/method definition in destination file '
@@ -193,99 +1269,157 @@ def main():
                                      'commands like `-I` (to include dir), `-std=c++17` and other. '
                                      'Dont pass a file without flag to clang! Use `--dest-file=` instead.')
     parser.add_argument('--src-file', dest='srcfile', action='store',
-                        type=type('string'), required=True, default=None,
+                        type=type('string'), required=False, default=None,
                         help='file with new functions definitions')
-    parser.add_argument('--dest-file', dest='destfile', action='store',
-                        type=type('string'), required=True,
-                        help='file with old functions definitions')
+    parser.add_argument('--dest-file', dest='destfiles', action='store', nargs='+',
+                        type=type('string'), required=False, default=None,
+                        help='file(s) with old functions definitions, glob patterns like `vendor/**/lib.h` '
+                             'are expanded (source file is parsed once, destination files are processed in parallel)')
+    parser.add_argument('--manifest', dest='manifest', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='JSON/TOML file with list of src/dest pairs to be processed in one run '
+                             '(used instead of `--src-file` and `--dest-file`)')
+    parser.add_argument('--compile-commands', dest='compile_commands', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='`compile_commands.json` (or directory with it): edit all the project files '
+                             'that have definitions matching the ones from `--src-dir`, '
+                             'each translation unit is parsed with its own flags')
+    parser.add_argument('--src-dir', dest='src_dir', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='directory with files that contain new functions definitions '
+                             '(used with `--compile-commands`)')
+    parser.add_argument('--project-root', dest='project_root', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='only files in this directory are edited with `--compile-commands` '
+                             '(current directory by default)')
+    parser.add_argument('--jobs', dest='jobs', action='store',
+                        metavar='N', type=int, required=False, default=None,
+                        help='number of worker processes used with several destination files, `--manifest` '
+                             'and `--compile-commands` '
+                             '(number of cores by default)')
+    parser.add_argument('--check', dest='mode', action='store_const', const='check',
+                        help='do not write anything, only print definitions that differ from the source ones '
+                             '(exit status is 1 if any)')
+    parser.add_argument('--diff', dest='mode', action='store_const', const='diff',
+                        help='do not write anything, only print unified diff of the destination files '
+                             '(exit status is 1 if any)')
+    parser.add_argument('--drift', dest='mode', action='store_const', const='drift',
+                        help='do not write anything, only report definitions that drifted from the source ones '
+                             '(whitespaces and comments are ignored) and how many of the matched ones did '
+                             '(exit status is 1 if any)')
     parser.add_argument('--oldfile-delete', dest='oldfile_del', action='store_true',
                         help='use this to delete old version of destination file')
     parser.add_argument('--oldfile-keep', dest='oldfile_del', action='store_false',
                         help='use this to keep old version of destination file (default)')
-    parser.set_defaults(oldfile_del=False)
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+                        type=type('string'), required=False, default=default_cache_dir(),
+                        help='directory where parsed translation units are cached (default: %(default)s)')
+    parser.add_argument('--cache-size', dest='cache_size', action='store',
+                        metavar='MB', type=int, required=False, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='max size of the translation unit cache in megabytes (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='always parse files from scratch and do not use the translation unit cache')
+    parser.add_argument('--fast-discovery', dest='fast_discovery', action='store_true',
+                        help='skip function bodies of the headers included at the beginning of the files, '
+                             'only definitions of the files themselves are parsed completely')
+    parser.add_argument('--match-usr', dest='use_usr', action='store_true',
+                        help='also require Unified Symbol Resolution (USR) of matching functions/methods to be equal')
+    parser.add_argument('--lexer-only', dest='lexer_only', action='store_true',
+                        help='find definitions from the token streams of the files themselves: nothing is parsed '
+                             'by clang so include paths are not needed (virtual/static are not compared, '
+                             'identifiers in capitals before the return type are taken for macros)')
+    parser.add_argument('--pch-header', dest='pch_headers', action='append',
+                        metavar='HEADER', type=type('string'), default=None,
+                        help='common header (file or name like `iostream`) to be precompiled once and used by '
+                             'all the parsed files, may be passed several times')
+    add_diagnostics_arguments(parser)
+    add_profile_arguments(parser)
+    parser.set_defaults(oldfile_del=False, mode='write')
     args, clangcmd = parser.parse_known_args()
 
-    if not os.path.isfile(args.srcfile):
-        parser.error(f"specified source file doesn't exist:\n{args.srcfile}\n")
+    with profiling.profile(args.profile, pstats_file=args.profile_pstats):
+        _main(parser, args, clangcmd)
 
-    if not os.path.isfile(args.destfile):
-        parser.error(f"specified destination file doesn't exist:\n{args.destfile}\n")
 
-    clangcmd_src = clangcmd.copy()
-    clangcmd_dest = clangcmd.copy()
-    clangcmd_src.append(args.srcfile)
-    clangcmd_dest.append(args.destfile)
+def _main(parser: argparse.ArgumentParser, args: argparse.Namespace, clangcmd: list):
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = args.cache_size * 1024 * 1024
+    if args.lexer_only and args.use_usr:
+        parser.error("`--match-usr` can't be used together with `--lexer-only`\n")
 
-    index = Index.create()
-    tu_src = index.parse(None, clangcmd_src)
-    if not tu_src:
-        parser.error(f"clang unable to load source file:\n{args.srcfile}\n")
+    if args.manifest:
+        if args.srcfile or args.destfiles:
+            parser.error("`--manifest` can't be used together with `--src-file`/`--dest-file`\n")
+        if not os.path.isfile(args.manifest):
+            parser.error(f"specified manifest file doesn't exist:\n{args.manifest}\n")
+        try:
+            pairs = load_manifest(args.manifest)
+        except (EditCppError, ValueError) as e:
+            parser.error(f"unable to load manifest:\n{args.manifest}\n{e}")
 
-    tu_dest = index.parse(None, clangcmd_dest)
-    if not tu_dest:
-        parser.error(f"clang unable to load destination file:\n{args.destfile}\n")
-
-    # print information about unknown files/functions/methods
-    pprint(('diagnostics in SOURCE:\t'+args.srcfile, [get_diag_info(d) for d in tu_src.diagnostics]))
-    pprint(('diagnostics in DESTINATION:\t'+args.destfile, [get_diag_info(d) for d in tu_dest.diagnostics]))
-
-    method_def_nodes_src = []
-    find_method_def_nodes(tu_src.cursor, method_def_nodes_src, args.srcfile)
-    if not method_def_nodes_src:
-        parser.error(f"unable to find any method definition in source file:\n{args.srcfile}\n" +
-                      f"probably you forgot to pass `-std=c++03` (or higher) flag?\n")
-
-    method_def_nodes_dest = []
-    find_method_def_nodes(tu_dest.cursor, method_def_nodes_dest, args.destfile)
-    if not method_def_nodes_dest:
-        parser.error(f"unable to find any function/method definition in destination file:\n{args.destfile}" +
-                      f"\nprobably you forgot to pass `-std=c++3` (or higher) flag?\n")
-
-    # read source file
-    with open(args.srcfile, mode='r') as file:
-        srcdata = file.readlines()
-        srcdata = [line.rstrip() for line in srcdata]
-
-    # read destination file
-    with open(args.destfile, mode='r') as file:
-        destdata = file.readlines()
-        destdata = [line.rstrip() for line in destdata]
-
-    dest_lines = list(range(1, len(destdata)+1))
-    for node_src in method_def_nodes_src:
-        node_dest = find_method_matching_node(node_src, method_def_nodes_dest)
-        if not node_dest:
-            err_msg = (f"unable to find any destination function/method matching for a source function/method:\n" +
-                        f"\t{node_src.semantic_parent.displayname}::{node_src.spelling}->{node_src.type.spelling}\n" +
-                        f"found destination functions/methods:\n")
-            for node in method_def_nodes_dest:
-                err_msg += f"\t{node.semantic_parent.displayname}::{node.spelling}->{node.type.spelling}\n"
-            err_msg += f"also check is it definition? static? virtual? const?\n"
-            parser.error(err_msg)
-
-        idx = dest_lines.index(node_dest.extent.start.line)
-        for i in range(0, node_dest.extent.end.line - node_dest.extent.start.line + 1):
-            dest_lines.remove(node_dest.extent.start.line+i)   # remove by value (not by index)
-            del destdata[idx]
-
-        for i in range(0, node_src.extent.end.line - node_src.extent.start.line + 1):
-            dest_lines.insert(idx + i, None)
-            destdata.insert(idx + i, srcdata[node_src.extent.start.line + i - 1])
-
-    prepared_filename = prepare_filename(args.destfile)
-    with open(prepared_filename, "w") as file:
-        for line in destdata:
-            file.write("%s\n" % line)
-
-    if args.oldfile_del:
-        os.remove(args.destfile)
-    else:
-        filename, file_extension = os.path.splitext(args.destfile)
-        prepared_oldfilename = prepare_filename(filename + '_OLD' + file_extension)
-        os.rename(args.destfile, prepared_oldfilename)
+        for pair in pairs:
+            pair['clang_args'] = clangcmd + pair['clang_args']
+            if pair['oldfile_delete'] is None:
+                pair['oldfile_delete'] = args.oldfile_del
+
+        results = run_manifest(pairs, args.jobs, cache_dir, cache_size, args.fast_discovery, args.use_usr,
+                               args.pch_headers, args.mode, args.lexer_only)
+        if print_results(results) or (args.mode != 'write' and any(r['changed'] for r in results)):
+            parser.exit(1)
+        return
+
+    if args.compile_commands or args.src_dir:
+        if not args.compile_commands or not args.src_dir:
+            parser.error("`--compile-commands` and `--src-dir` must be used together\n")
+        if args.srcfile or args.destfiles:
+            parser.error("`--compile-commands` can't be used together with `--src-file`/`--dest-file`\n")
+        if not os.path.exists(args.compile_commands):
+            parser.error(f"specified compilation database doesn't exist:\n{args.compile_commands}\n")
+        if not os.path.isdir(args.src_dir):
+            parser.error(f"specified source directory doesn't exist:\n{args.src_dir}\n")
+        if args.lexer_only:
+            parser.error("`--compile-commands` can't be used together with `--lexer-only`\n")
+        try:
+            results = edit_project(args.compile_commands, args.src_dir, clangcmd, args.project_root,
+                                   args.jobs, args.oldfile_del, cache_dir, cache_size, args.use_usr,
+                                   args.pch_headers, args.mode)
+        except (EditCppError, ValueError, KeyError) as e:
+            parser.error(str(e))
+        if print_results(results) or (args.mode != 'write' and any(r['changed'] for r in results)):
+            parser.exit(1)
+        return
+
+    if not args.srcfile or not args.destfiles:
+        parser.error("both `--src-file` and `--dest-file` are required (or use `--manifest`)\n")
 
-    os.rename(prepared_filename, args.destfile)
+    destfiles = expand_dest_files(args.destfiles)
+    if not destfiles:
+        parser.error("no destination file matches:\n" + '\n'.join(args.destfiles) + "\n")
+    if len(destfiles) > 1:
+        try:
+            results = edit_files(args.srcfile, destfiles, clangcmd, args.oldfile_del, args.jobs, cache_dir,
+                                 cache_size, args.fast_discovery, args.use_usr, args.pch_headers, args.mode,
+                                 args.lexer_only)
+        except EditCppError as e:
+            parser.error(str(e))
+        if print_results(results) or (args.mode != 'write' and any(r['changed'] for r in results)):
+            parser.exit(1)
+        return
+
+    index = Index.create()
+    try:
+        changed, report = edit_file(index, args.srcfile, destfiles[0], clangcmd, args.oldfile_del,
+                                    print_diagnostics=args.mode == 'write', cache_dir=cache_dir,
+                                    cache_size=cache_size, fast_discovery=args.fast_discovery,
+                                    use_usr=args.use_usr, pch_headers=args.pch_headers, mode=args.mode,
+                                    lexer_only=args.lexer_only,
+                                    diagnostics_severity=DIAGNOSTIC_SEVERITIES[args.diagnostics_severity])
+    except EditCppError as e:
+        parser.error(str(e))
+    print(report, end='')
+    if args.mode != 'write' and changed:
+        parser.exit(1)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,382 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+
+from clang.cindex import Cursor, CursorKind, Index
+from concurrent.futures import ProcessPoolExecutor
+from cppguts import profiling
+from cppguts.common import format_exception, get_worker_index, is_subpath, load_compile_commands
+from cppguts.profiling import add_profile_arguments
+from cppguts.tucache import (DEFAULT_CACHE_SIZE, default_cache_dir, get_file_record, get_libclang_version,
+                             is_file_record_valid, parse_tu)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    filename TEXT UNIQUE NOT NULL,
+    key TEXT NOT NULL,
+    files TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS symbols (
+    unit_id INTEGER NOT NULL REFERENCES units(id) ON DELETE CASCADE,
+    usr TEXT,
+    spelling TEXT,
+    displayname TEXT,
+    kind TEXT,
+    parent TEXT,
+    type TEXT,
+    file TEXT,
+    start_line INTEGER,
+    start_column INTEGER,
+    start_offset INTEGER,
+    end_line INTEGER,
+    end_column INTEGER,
+    end_offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS symbols_unit ON symbols(unit_id);
+CREATE INDEX IF NOT EXISTS symbols_spelling ON symbols(spelling);
+CREATE INDEX IF NOT EXISTS symbols_kind ON symbols(kind);
+CREATE INDEX IF NOT EXISTS symbols_usr ON symbols(usr);
+'''
+
+SYMBOL_FIELDS = ('usr', 'spelling', 'displayname', 'kind', 'parent', 'type', 'file',
+                 'start_line', 'start_column', 'start_offset', 'end_line', 'end_column', 'end_offset')
+
+# definitions are searched only inside of these cursors (function bodies are never visited)
+SCOPE_KINDS = frozenset((CursorKind.TRANSLATION_UNIT, CursorKind.NAMESPACE, CursorKind.LINKAGE_SPEC,
+                         CursorKind.UNEXPOSED_DECL, CursorKind.CLASS_DECL, CursorKind.STRUCT_DECL,
+                         CursorKind.UNION_DECL, CursorKind.ENUM_DECL, CursorKind.CLASS_TEMPLATE,
+                         CursorKind.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION))
+
+
+def default_index_file() -> str:
+    '''
+    :return: index_file - path to the default symbol index (in the cache directory)
+    '''
+    return os.path.join(default_cache_dir(), 'symbols.sqlite')
+
+
+def connect(index_file: str) -> sqlite3.Connection:
+    '''
+    Open symbol index and create its tables if needed.
+    :param index_file: SQLite database file
+    :return: connection
+    '''
+    index_dir = os.path.dirname(os.path.abspath(index_file))
+    os.makedirs(index_dir, exist_ok=True)
+    db = sqlite3.connect(index_file)
+    db.execute('PRAGMA foreign_keys = ON')
+    db.executescript(SCHEMA)
+    return db
+
+
+def get_unit_key(clangcmd: list, options: int = 0) -> str:
+    '''
+    Calculate key of everything but the files that affects definitions found in translation unit:
+    clang arguments, parse options, working directory and libclang version.
+    :param clangcmd: list of clang arguments (without file name)
+    :param options: parse options
+    :return: key - hexdigest
+    '''
+    key_data = [list(clangcmd), options, os.getcwd(), get_libclang_version()]
+    return hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+
+def is_unit_up_to_date(db: sqlite3.Connection, filename: str, key: str) -> bool:
+    '''
+    Check that translation unit was indexed with the same key and neither its main file
+    nor the files it includes were changed since then.
+    :param db: connection
+    :param filename: main file of translation unit
+    :param key: key as returned by `get_unit_key`
+    :return: True if the unit doesn't need to be indexed again
+    '''
+    row = db.execute('SELECT key, files FROM units WHERE filename = ?',
+                     (os.path.abspath(filename),)).fetchone()
+    if not row or row[0] != key:
+        return False
+    return all(is_file_record_valid(record) for record in json.loads(row[1]))
+
+
+def find_definitions(node: Cursor, project_root: str = None) -> list:
+    '''
+    Collect definitions of namespace and class scopes (functions, methods, classes, variables and alike),
+    function bodies are not visited.
+    :param node: cursor to start from (usually translation unit cursor)
+    :param project_root: collect only definitions from the files under this directory (all files if None)
+    :return: symbols - list of tuples with `SYMBOL_FIELDS` values
+    '''
+    symbols = []
+    in_project = {}
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        profiling.count('cursors_visited')
+        if node.kind != CursorKind.TRANSLATION_UNIT:
+            location_file = node.location.file
+            if location_file is None:
+                continue
+            filename = location_file.name
+            if filename not in in_project:
+                in_project[filename] = not project_root or is_subpath(filename, project_root)
+            if not in_project[filename]:
+                profiling.count('cursors_pruned')
+                continue
+            if node.is_definition():
+                extent = node.extent
+                parent = node.semantic_parent
+                symbols.append((node.get_usr(), node.spelling, node.displayname, node.kind.name,
+                                parent.displayname if parent and parent.kind != CursorKind.TRANSLATION_UNIT else None,
+                                node.type.spelling, os.path.abspath(filename),
+                                extent.start.line, extent.start.column, extent.start.offset,
+                                extent.end.line, extent.end.column, extent.end.offset))
+        if node.kind in SCOPE_KINDS:
+            stack.extend(reversed(list(node.get_children())))
+    profiling.count('definitions_found', len(symbols))
+    return symbols
+
+
+def index_unit(index: Index, filename: str, clangcmd: list, project_root: str = None,
+               cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE, pch_headers: list = None) -> dict:
+    '''
+    Parse translation unit and collect its definitions.
+    :param index: clang index
+    :param filename: main file of translation unit
+    :param clangcmd: list of clang arguments (without file name)
+    :param project_root: collect only definitions from the files under this directory (all files if None)
+    :param cache_dir: translation unit cache directory, `None` disables the cache
+    :param cache_size: max cache size in bytes
+    :param pch_headers: list of common headers to be precompiled once and used by all the files
+    :return: unit - dict with `filename`, `files` (records of the main and included files) and `symbols` keys
+    '''
+    with profiling.phase('parse'):
+        tu, _ = parse_tu(index, filename, clangcmd, 0, cache_dir, cache_size, pch_headers)
+    with profiling.phase('find_definitions'):
+        symbols = find_definitions(tu.cursor, project_root)
+    filenames = {os.path.abspath(filename)}
+    filenames.update(os.path.abspath(include.include.name) for include in tu.get_includes())
+    return {'filename': os.path.abspath(filename),
+            'files': [get_file_record(name) for name in sorted(filenames) if os.path.isfile(name)],
+            'symbols': symbols}
+
+
+def store_unit(db: sqlite3.Connection, unit: dict, key: str):
+    '''
+    Replace indexed definitions of translation unit in one transaction.
+    :param db: connection
+    :param unit: unit as returned by `index_unit`
+    :param key: key as returned by `get_unit_key`
+    '''
+    with db:
+        db.execute('DELETE FROM units WHERE filename = ?', (unit['filename'],))
+        unit_id = db.execute('INSERT INTO units (filename, key, files) VALUES (?, ?, ?)',
+                             (unit['filename'], key, json.dumps(unit['files']))).lastrowid
+        db.executemany(f"INSERT INTO symbols (unit_id, {', '.join(SYMBOL_FIELDS)}) "
+                       f"VALUES (?, {', '.join('?' * len(SYMBOL_FIELDS))})",
+                       [(unit_id,) + symbol for symbol in unit['symbols']])
+
+
+def _index_entry(options: dict, entry: dict) -> dict:
+    try:
+        return index_unit(get_worker_index(), entry['file'], entry['clang_args'], options['project_root'],
+                          options['cache_dir'], options['cache_size'], options['pch_headers'])
+    except Exception as e:
+        return {'filename': os.path.abspath(entry['file']), 'error': format_exception(e).rstrip()}
+
+
+def update_index(index_file: str, entries: list, project_root: str = None, jobs: int = None,
+                 cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE, pch_headers: list = None) -> dict:
+    '''
+    Index translation units that are new or changed since the last run (by the hashes of the files
+    they consist of). Units whose main file was removed are dropped from the index.
+    :param index_file: SQLite database file
+    :param entries: list of dict with `file` and `clang_args` keys (as returned by `load_compile_commands`)
+    :param project_root: collect only definitions from the files under this directory (all files if None)
+    :param jobs: number of worker processes (number of cores by default)
+    :param cache_dir: translation unit cache directory, `None` disables the cache
+    :param cache_size: max cache size in bytes
+    :param pch_headers: list of common headers to be precompiled once and used by all the files
+    :return: stats - dict with `indexed`, `up_to_date`, `removed` (numbers of units) and `errors`
+    (list of (filename, message) tuples) keys
+    '''
+    db = connect(index_file)
+    try:
+        keys = {}
+        stale = []
+        for entry in entries:
+            key = get_unit_key(entry['clang_args'])
+            if is_unit_up_to_date(db, entry['file'], key):
+                continue
+            keys[os.path.abspath(entry['file'])] = key
+            stale.append(entry)
+
+        stats = {'indexed': 0, 'up_to_date': len(entries) - len(stale), 'removed': 0, 'errors': []}
+        if stale:
+            options = {'project_root': project_root, 'cache_dir': cache_dir, 'cache_size': cache_size,
+                       'pch_headers': pch_headers}
+            jobs = min(jobs or os.cpu_count() or 1, len(stale))
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                # units are written by the main process only as SQLite doesn't like concurrent writers
+                for unit in pool.map(functools.partial(_index_entry, options), stale):
+                    if 'error' in unit:
+                        stats['errors'].append((unit['filename'], unit['error']))
+                        continue
+                    with profiling.phase('store'):
+                        store_unit(db, unit, keys[unit['filename']])
+                    stats['indexed'] += 1
+
+        with db:
+            for (filename,) in db.execute('SELECT filename FROM units').fetchall():
+                if not os.path.isfile(filename):
+                    db.execute('DELETE FROM units WHERE filename = ?', (filename,))
+                    stats['removed'] += 1
+    finally:
+        db.close()
+    return stats
+
+
+def _regexp(pattern: str, value: str) -> bool:
+    return value is not None and _compile_regex(pattern).search(value) is not None
+
+
+_regex_cache = {}
+
+
+def _compile_regex(pattern: str):
+    regex = _regex_cache.get(pattern)
+    if regex is None:
+        regex = _regex_cache[pattern] = re.compile(pattern)
+    return regex
+
+
+def query_symbols(index_file: str, name: str = None, regex: str = None, kinds: list = None,
+                  filename: str = None) -> list:
+    '''
+    Find indexed definitions, nothing is parsed. Definitions from headers included by several
+    translation units are listed once.
+    :param index_file: SQLite database file
+    :param name: spelling of the definition
+    :param regex: regular expression searched in the spelling
+    :param kinds: list of cursor kind names (e.g. `CXX_METHOD`)
+    :param filename: only definitions residing in this file
+    :return: symbols - list of dict with `SYMBOL_FIELDS` keys
+    '''
+    if not os.path.isfile(index_file):
+        raise FileNotFoundError(f"symbol index doesn't exist (run `indexcpp` first):\n{index_file}")
+    if regex:
+        _compile_regex(regex)   # raise `re.error` before the query
+    conditions = []
+    params = []
+    if name:
+        conditions.append('spelling = ?')
+        params.append(name)
+    if regex:
+        conditions.append('spelling REGEXP ?')
+        params.append(regex)
+    if kinds:
+        conditions.append(f"kind IN ({', '.join('?' * len(kinds))})")
+        params.extend(kinds)
+    if filename:
+        conditions.append('file = ?')
+        params.append(os.path.abspath(filename))
+    query = f"SELECT DISTINCT {', '.join(SYMBOL_FIELDS)} FROM symbols"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY file, start_offset'
+
+    db = sqlite3.connect(index_file)
+    try:
+        db.create_function('regexp', 2, _regexp)
+        return [dict(zip(SYMBOL_FIELDS, row)) for row in db.execute(query, params)]
+    finally:
+        db.close()
+
+
+def parse_kinds(kinds: str) -> list:
+    '''
+    Parse comma separated list of cursor kind names.
+    :param kinds: for example `CXX_METHOD,FUNCTION_DECL`
+    :return: kinds - list of kind names
+    '''
+    known = {kind.name for kind in CursorKind.get_all_kinds()}
+    parsed = []
+    for kind in kinds.split(','):
+        kind = kind.strip().upper()
+        if not kind:
+            continue
+        if kind not in known:
+            raise ValueError(f"unknown cursor kind: `{kind}`")
+        parsed.append(kind)
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=
+                                     'Store definitions of translation units in SQLite symbol index to be '
+                                     'queried by `dumpcpp --index`. Only new or changed translation units '
+                                     'are parsed. After passing `indexcpp` flags you are allowed to pass clang '
+                                     'commands like `-I` (to include dir), `-std=c++17` and other. '
+                                     'Dont pass a file without flag to clang! Use `--file=` instead.')
+    parser.add_argument('--file', dest='files', action='append',
+                        type=type('string'), required=False, default=None,
+                        help='translation unit to be indexed, may be passed several times')
+    parser.add_argument('--compile-commands', dest='compile_commands', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='index every translation unit of `compile_commands.json` (or directory with it) '
+                             'with its own compile flags')
+    parser.add_argument('--project-root', dest='project_root', action='store',
+                        type=type('string'), required=False, default=None,
+                        help='index only definitions from the files under this directory '
+                             '(default: current directory)')
+    parser.add_argument('--db', dest='index_file', action='store',
+                        type=type('string'), required=False, default=default_index_file(),
+                        help='symbol index file (default: %(default)s)')
+    parser.add_argument('--jobs', dest='jobs', action='store',
+                        metavar='N', type=int, required=False, default=None,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+                        type=type('string'), required=False, default=default_cache_dir(),
+                        help='directory where parsed translation units are cached (default: %(default)s)')
+    parser.add_argument('--cache-size', dest='cache_size', action='store',
+                        metavar='MB', type=int, required=False, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='max size of the translation unit cache in megabytes (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='always parse the files from scratch and do not use the translation unit cache')
+    parser.add_argument('--pch-header', dest='pch_headers', action='append',
+                        metavar='HEADER', type=type('string'), default=None,
+                        help='common header (file or name like `iostream`) to be precompiled once and '
+                             'reused by the next runs, may be passed several times')
+    add_profile_arguments(parser)
+    args, clangcmd = parser.parse_known_args()
+
+    if not args.files and not args.compile_commands:
+        parser.error("`--file` or `--compile-commands` is required\n")
+    entries = []
+    for filename in args.files or []:
+        if not os.path.isfile(filename):
+            parser.error(f"specified file doesn't exist:\n{filename}\n")
+        entries.append({'file': filename, 'clang_args': clangcmd})
+    if args.compile_commands:
+        if not os.path.exists(args.compile_commands):
+            parser.error(f"specified compilation database doesn't exist:\n{args.compile_commands}\n")
+        entries.extend(load_compile_commands(args.compile_commands))
+
+    with profiling.profile(args.profile, pstats_file=args.profile_pstats):
+        stats = update_index(args.index_file, entries, args.project_root or os.getcwd(), args.jobs,
+                             None if args.no_cache else args.cache_dir, args.cache_size * 1024 * 1024,
+                             args.pch_headers)
+    for filename, message in stats['errors']:
+        print(f"FAILED {filename}:\n{message}")
+    print(f"{stats['indexed']} indexed, {stats['up_to_date']} up to date, {stats['removed']} removed, "
+          f"{len(stats['errors'])} failed")
+    if stats['errors']:
+        parser.exit(1)
+
+
+if __name__ == '__main__':
+    main()
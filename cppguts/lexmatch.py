@@ -0,0 +1,692 @@
+import codecs
+import hashlib
+import re
+
+
+# data is decoded as latin-1 so that string offsets are equal to byte offsets,
+# whitespaces don't match any group so they are skipped by `finditer`,
+# punctuators are matched longest first (`--x` and `- -x` are different token streams)
+_TOKEN_RE = re.compile(r'''
+    (?P<skip>//[^\n]*|/\*.*?\*/|^[ \t]*\#(?:\\\r?\n|[^\n])*)
+  | (?P<raw_string>(?:u8|u|U|L)?R"(?P<delim>[^()\\\s]{0,16})\(.*?\)(?P=delim)")
+  | (?:u8|u|U|L)?"(?:\\.|[^"\\\n])*"
+  | (?:u8|u|U|L)?'(?:\\.|[^'\\\n])*'
+  | \.?[0-9](?:[eEpP][+-]|['\w.])*
+  | [A-Za-z_$][\w$]*
+  | <=>|<<=|>>=|->\*|\.\.\.|::|->|\.\*|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^]=|\#\#
+  | \S
+''', re.VERBOSE | re.DOTALL | re.MULTILINE)
+
+# keywords that are dropped from the return type (they are not a part of function type)
+SPECIFIERS = {'static', 'virtual', 'inline', 'explicit', 'constexpr', 'consteval', 'friend', 'extern',
+              '__inline', '__forceinline', 'typename'}
+
+# keywords that may follow parameter list of a function definition
+FUNCTION_QUALIFIERS = {'const', 'volatile', '&', '&&', 'noexcept', 'throw', 'override', 'final',
+                       '__attribute__', '[', ':', '{', '->'}
+
+# builtin type keywords that can't be parameter names
+TYPE_KEYWORDS = {'void', 'bool', 'char', 'wchar_t', 'char8_t', 'char16_t', 'char32_t', 'short', 'int', 'long',
+                 'signed', 'unsigned', 'float', 'double', 'auto', 'const', 'volatile'}
+
+# keywords whose combinations are spelled in canonical form (`long unsigned int` is `unsigned long`)
+ARITHMETIC_KEYWORDS = {'signed', 'unsigned', 'short', 'long', 'int', 'char', 'double'}
+
+CV_QUALIFIERS = ('const', 'volatile')
+
+# keywords that can't be the type of parameter by themselves (`const Foo` has no name)
+ELABORATED_KEYWORDS = {'const', 'volatile', 'struct', 'class', 'union', 'enum', 'typename', 'register'}
+
+# attributes that are not a part of function type
+ATTRIBUTE_KEYWORDS = {'__attribute__', '__declspec'}
+
+# characters that may start a comment, literal or preprocessor directive (those may contain unbalanced braces)
+# and the braces themselves: bodies and data tables are skipped without splitting them into tokens
+_BRACE_RE = re.compile(r'''[{}"'/#]''')
+_RAW_STRING_RE = re.compile(r'R"(?P<delim>[^()\\\s]{0,16})\(.*?\)(?P=delim)"', re.DOTALL)
+_STRING_RE = re.compile(r'"(?:\\.|[^"\\\n])*"')
+_CHAR_RE = re.compile(r"'(?:\\.|[^'\\\n])*'")
+
+ACCESS_SPECIFIERS = ('public', 'protected', 'private')
+
+OPENING = {')': '(', '}': '{'}
+
+# identifiers in capitals before the return type are taken for macros (`API int f()`, `DECL(x) int f()`)
+_MACRO_RE = re.compile(r'[A-Z_][A-Z0-9_]+$')
+
+
+def tokenize(text: str) -> list:
+    '''
+    Split C++ code into tokens. Comments and preprocessor directives are dropped.
+    :param text: code (decode bytes as latin-1 to get byte offsets)
+    :return: tokens - list of (text, start_offset, end_offset) tuples, `>>` is split into two `>`
+    so that nested template argument lists are closed
+    '''
+    return list(iter_tokens(text))
+
+
+def iter_tokens(text: str, pos: int = 0):
+    '''
+    Same as `tokenize` but tokens are generated lazily.
+    :param pos: offset to start from
+    '''
+    for m in _TOKEN_RE.finditer(text, pos):
+        if m.lastgroup == 'skip':
+            continue
+        token = m.group()
+        if token == '>>':
+            yield '>', m.start(), m.start() + 1
+            yield '>', m.start() + 1, m.end()
+        else:
+            yield token, m.start(), m.end()
+
+
+def skip_braces(text: str, pos: int) -> int:
+    '''
+    Find the brace that closes the one just before `pos`. Comments, literals and preprocessor directives
+    are skipped the same way `tokenize` does, nothing else is tokenized.
+    :return: offset after closing brace (end of the code if braces are unbalanced)
+    '''
+    depth = 1
+    while True:
+        m = _BRACE_RE.search(text, pos)
+        if not m:
+            return len(text.rstrip())
+        char, start = m.group(), m.start()
+        pos = start + 1
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return pos
+        elif char == '"':
+            m = (text[start - 1:start] == 'R' and _RAW_STRING_RE.match(text, start - 1)) or \
+                _STRING_RE.match(text, start)
+            pos = m.end() if m else pos
+        elif char == "'":
+            word_start = start
+            while word_start > 0 and (text[word_start - 1].isalnum() or text[word_start - 1] in "_.'"):
+                word_start -= 1
+            if not text[word_start].isdigit() and text[word_start] != '.':
+                # not a digit separator (`1'000`)
+                m = _CHAR_RE.match(text, start)
+                pos = m.end() if m else pos
+        else:
+            # comment or directive: the same match as the one of `tokenize`
+            if char == '#':
+                start = text.rfind('\n', 0, start) + 1
+            m = _TOKEN_RE.match(text, start)
+            if m and m.lastgroup == 'skip' and m.end() > pos:
+                pos = m.end()
+
+
+def fingerprint(data: bytes) -> bytes:
+    '''
+    Hash normalized token stream of the code: whitespaces and comments don't change the fingerprint.
+    Preprocessor directives are hashed with their whitespaces collapsed.
+    :param data: code
+    :return: digest
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    for m in _TOKEN_RE.finditer(data.decode('latin-1')):
+        text = m.group()
+        if m.lastgroup == 'skip':
+            if text.startswith('/'):
+                continue
+            text = ' '.join(text.replace('\\\n', ' ').split())
+        h.update(text.encode('latin-1'))
+        h.update(b'\0')
+    return h.digest()
+
+
+def find_closing(tokens: list, i: int, opening: str, closing: str) -> int:
+    '''
+    Find closing bracket matching the opening one.
+    :param tokens: list of tokens
+    :param i: index of opening bracket
+    :return: index of closing bracket (index of the last token if brackets are unbalanced)
+    '''
+    depth = 0
+    for j in range(i, len(tokens)):
+        text = tokens[j][0]
+        if text == opening:
+            depth += 1
+        elif text == closing:
+            depth -= 1
+            if depth == 0:
+                return j
+    return len(tokens) - 1
+
+
+def find_closing_text(texts: list, i: int, opening: str, closing: str) -> int:
+    '''
+    Same as `find_closing` but for the list of token texts.
+    '''
+    return find_closing([(text,) for text in texts], i, opening, closing)
+
+
+def skip_template_header(tokens: list, i: int, end: int) -> int:
+    '''
+    Skip `template <...>` prefixes and attributes `[[...]]` of the declaration.
+    :return: index of the first token of the declaration itself
+    '''
+    while i < end:
+        if tokens[i][0] == 'template' and i + 1 < end and tokens[i + 1][0] == '<':
+            i = find_closing(tokens, i + 1, '<', '>') + 1
+        elif tokens[i][0] == '[' and i + 1 < end and tokens[i + 1][0] == '[':
+            i = find_closing(tokens, i, '[', ']') + 1
+        else:
+            return i
+    return i
+
+
+def join_tokens(tokens: list) -> str:
+    '''
+    Join token texts with spaces except around `::`, `<`, `>`, `,`, `(`, `)`, `[` and `]`.
+    '''
+    result = ''
+    prev = ''
+    for text in tokens:
+        if result and prev not in ('::', '<', '(', '[') and text not in ('::', '<', '>', ',', '(', ')', '[', ']'):
+            result += ' '
+        result += text
+        prev = text
+    return result
+
+
+def get_parameter_types(tokens: list) -> list:
+    '''
+    Get types of the parameters (without names and default values) spelled by `normalize_type`.
+    :param tokens: token texts between parentheses of parameter list
+    :return: types - list of str
+    '''
+    params = []
+    param = []
+    depth = 0
+    for text in tokens:
+        if text in ('(', '[', '{', '<'):
+            depth += 1
+        elif text in (')', ']', '}', '>'):
+            depth -= 1
+        if text == ',' and depth == 0:
+            params.append(param)
+            param = []
+        else:
+            param.append(text)
+    if param:
+        params.append(param)
+
+    types = []
+    for param in params:
+        # drop default value
+        depth = 0
+        for j, text in enumerate(param):
+            if text in ('(', '[', '{', '<'):
+                depth += 1
+            elif text in (')', ']', '}', '>'):
+                depth -= 1
+            elif text == '=' and depth == 0:
+                param = param[:j]
+                break
+        types.append(normalize_type(param, parameter=True))
+    if types == ['void']:
+        return []
+    return types
+
+
+def is_name(text: str) -> bool:
+    return bool(re.match(r'[A-Za-z_$]', text))
+
+
+def is_macro_name(tokens: list, i: int) -> bool:
+    '''
+    Check whether the token is an identifier in capitals (like `API` or `DECL(x)`) that is taken for a macro.
+    '''
+    return (bool(_MACRO_RE.match(tokens[i][0])) and
+            (i + 1 >= len(tokens) or tokens[i + 1][0] not in ('::', '<')))
+
+
+def skip_macro(tokens: list, i: int, end: int) -> int:
+    '''
+    Skip attribute (`__attribute__((x))`, `__declspec(x)`) or macro (`API`, `DECL(x)`) that starts at `i`.
+    :return: index of the token after it or `i` if there is no attribute or macro
+    '''
+    if tokens[i][0] not in ATTRIBUTE_KEYWORDS and not is_macro_name(tokens, i):
+        return i
+    i += 1
+    if i < end and tokens[i][0] == '(':
+        i = find_closing(tokens, i, '(', ')') + 1
+    return i
+
+
+def skip_declaration_prefix(tokens: list, start: int, name_start: int) -> (int, bool):
+    '''
+    Skip linkage specification (`extern "C"`), attributes and macros that precede the return type:
+    they are neither a part of the function type nor of its extent. Macros are recognized
+    by their names in capitals and are skipped only if something is left for the return type.
+    :param start: index of the first token of the declaration
+    :param name_start: index of the first token of qualified name
+    :return: start, linkage - index of the first token of the rest of the declaration and whether
+    the declaration has linkage specification
+    '''
+    linkage = False
+    while start < name_start:
+        if tokens[start][0] == 'extern' and start + 1 < name_start and tokens[start + 1][0].startswith('"'):
+            start += 2
+            linkage = True
+            continue
+        after = skip_macro(tokens, start, name_start)
+        if after == start or after >= name_start:
+            break
+        start = after
+    return start, linkage
+
+
+def normalize_type(tokens: list, parameter: bool = False) -> str:
+    '''
+    Spell the type the way libclang does: `const`/`volatile` of declaration specifiers go first,
+    combinations of arithmetic keywords are spelled in canonical form (`unsigned` is `unsigned int`,
+    `long unsigned int` is `unsigned long`) and pointers are spelled like `char *const *`.
+    Parameter names are dropped (including the ones of function pointers), array and function
+    parameters are adjusted to pointers.
+    :param tokens: token texts of the type
+    :param parameter: tokens are parameter declaration
+    :return: type spelling
+    '''
+    # declaration specifiers end where the declarator (`*`, `&`, `(`, `[`) starts
+    end = len(tokens)
+    depth = 0
+    for j, text in enumerate(tokens):
+        if text == '<':
+            depth += 1
+        elif text == '>':
+            depth -= 1
+        elif depth == 0 and text in ('*', '&', '&&', '(', '['):
+            end = j
+            break
+    specifiers = tokens[:end]
+    declarator = tokens[end:]
+
+    if parameter:
+        # parameter name is either the last specifier (`int x`, `int x[2]`, `int x(int)`)
+        # or the last token of pointer declarator (`int *x`)
+        if declarator and declarator[0] in ('*', '&', '&&'):
+            if len(declarator) > 1 and is_name(declarator[-1]) and declarator[-1] not in CV_QUALIFIERS:
+                declarator = declarator[:-1]
+        elif (len(specifiers) > 1 and is_name(specifiers[-1]) and specifiers[-1] not in TYPE_KEYWORDS and
+              specifiers[-2] != '::' and any(text not in ELABORATED_KEYWORDS for text in specifiers[:-1])):
+            specifiers = specifiers[:-1]
+        if declarator[:1] == ['[']:
+            # array parameter is a pointer: `int [2][3]` is `int (*)[3]`
+            close = find_closing_text(declarator, 0, '[', ']')
+            declarator = ['(', '*', ')'] + declarator[close + 1:] if declarator[close + 1:] else ['*']
+        elif declarator[:1] == ['('] and declarator[1:2] not in (['*'], ['&'], ['&&']) and \
+                not (len(declarator) > 2 and declarator[2] == '::'):
+            # function parameter is a function pointer
+            declarator = ['(', '*', ')'] + declarator
+
+    cv = []
+    arithmetic = []
+    names = []
+    depth = 0
+    for text in specifiers:
+        if text == '<':
+            depth += 1
+        elif text == '>':
+            depth -= 1
+        if depth == 0 and text in CV_QUALIFIERS:
+            if text not in cv:
+                cv.append(text)
+        elif depth == 0 and text in ARITHMETIC_KEYWORDS:
+            if not arithmetic:
+                names.append(None)   # placeholder of canonical arithmetic type
+            arithmetic.append(text)
+        else:
+            names.append(text)
+    if arithmetic:
+        names[names.index(None)] = get_arithmetic_type(arithmetic)
+    spelling = join_tokens(sorted(cv, key=CV_QUALIFIERS.index) + names)
+
+    i = 0
+    while i < len(declarator):
+        text = declarator[i]
+        if text == '(':
+            close = find_closing_text(declarator, i, '(', ')')
+            inner = declarator[i + 1:close]
+            if inner and (inner[0] in ('*', '&', '&&') or inner[1:2] == ['::']):
+                # declarator in parentheses `(*name)`, `(&name)` or `(Class::*name)`
+                if len(inner) > 1 and is_name(inner[-1]) and inner[-1] not in CV_QUALIFIERS:
+                    inner = inner[:-1]
+                spelling += ' (' + join_declarator(inner, '(') + ')'
+            else:
+                spelling += '(' + ', '.join(get_parameter_types(inner)) + ')'
+            i = close + 1
+            continue
+        if text == '[':
+            close = find_closing_text(declarator, i, '[', ']')
+            spelling += ''.join(declarator[i:close + 1])
+            i = close + 1
+            continue
+        j = i
+        while j < len(declarator) and declarator[j] not in ('(', '['):
+            j += 1
+        spelling += join_declarator(declarator[i:j], names[-1] if names else '')
+        i = j
+    return spelling
+
+
+def join_declarator(tokens: list, prev: str) -> str:
+    '''
+    Join pointer declarator like libclang: `*const *`, `Class::*`.
+    :param tokens: token texts of the declarator
+    :param prev: token that precedes the declarator
+    '''
+    result = ''
+    for text in tokens:
+        if text in ('*', '&', '&&'):
+            sep = '' if prev in ('*', '&', '&&', '(', '::') else ' '
+        elif text == '::' or prev in ('*', '&', '&&', '(', '::'):
+            sep = ''
+        else:
+            sep = ' '
+        result += sep + text
+        prev = text
+    return result
+
+
+def get_arithmetic_type(keywords: list) -> str:
+    '''
+    Spell combination of arithmetic type keywords in canonical form.
+    :param keywords: for example `['long', 'unsigned', 'int']`
+    :return: spelling - for example `unsigned long`
+    '''
+    sign = 'unsigned ' if 'unsigned' in keywords else ''
+    if 'char' in keywords:
+        return ('signed ' if 'signed' in keywords else sign) + 'char'
+    if 'double' in keywords:
+        return 'long double' if 'long' in keywords else 'double'
+    if 'short' in keywords:
+        return sign + 'short'
+    if 'long' in keywords:
+        return sign + ' '.join(['long'] * min(keywords.count('long'), 2))
+    return sign + 'int'
+
+
+def get_function_name(tokens: list, p: int, start: int) -> (str, list, int):
+    '''
+    Get name of the function whose parameter list starts at `p`.
+    :param tokens: list of tokens
+    :param p: index of `(` of parameter list
+    :param start: index of the first token of the declaration
+    :return: spelling, qualifiers, name_start - unqualified name (`None` if there is no name before `p`),
+    list of qualifying names and index of the first token of qualified name
+    '''
+    texts = [t[0] for t in tokens[start:p]]
+    if not texts:
+        return None, [], p
+    operator_idx = None
+    for j in range(len(texts) - 1, max(len(texts) - 5, -1), -1):
+        if texts[j] == 'operator':
+            operator_idx = j
+            break
+    if operator_idx is not None:
+        symbol = texts[operator_idx + 1:]
+        if symbol and symbol[0][0].isalpha():
+            spelling = 'operator ' + ' '.join(symbol)
+        else:
+            spelling = 'operator' + ''.join(symbol)
+        j = operator_idx
+    elif re.match(r'[A-Za-z_$]', texts[-1]):
+        j = len(texts) - 1
+        spelling = texts[j]
+        if j > 0 and texts[j - 1] == '~':
+            j -= 1
+            spelling = '~' + spelling
+    else:
+        return None, [], p
+
+    qualifiers = []
+    while j > 1 and texts[j - 1] == '::':
+        k = j - 2
+        if texts[k] == '>':
+            # skip template arguments of the qualifier
+            depth = 0
+            while k > 0:
+                if texts[k] == '>':
+                    depth += 1
+                elif texts[k] == '<':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                k -= 1
+            k -= 1
+        if k < 0 or not re.match(r'[A-Za-z_$]', texts[k]):
+            break
+        qualifiers.insert(0, texts[k])
+        j = k
+    if j > 0 and texts[j - 1] == '::':
+        # global scope qualifier `::foo`
+        j -= 1
+    return spelling, qualifiers, start + j
+
+
+def find_lexical_definitions(data: bytes) -> list:
+    '''
+    Find function/method definitions from the token stream of the file itself (no headers are parsed).
+    Every definition gets the same signature key as `editcpp.get_method_signature_key` calculates except that
+    `virtual` and `static` are always `None`: these keywords are not repeated by out-of-class definitions.
+    Types are spelled by `normalize_type` (template arguments are kept as they are written).
+    Linkage specification and macros before the return type (see `skip_declaration_prefix`) are not
+    a part of the extent. Constructors, destructors and conversion operators are skipped like semantic search does.
+    :param data: file content (bytes or mmap)
+    :return: records - list of (key, start_offset, end_offset, line) tuples in the order of appearance
+    '''
+    # decoded straight from the buffer, mapped file isn't copied to `bytes` first
+    text = codecs.latin_1_decode(data)[0]
+    records = []
+    scopes = []     # list of (kind, name), kind is `namespace`, `class` or `extern`
+    namespaces = set()
+    line, line_pos = 1, 0
+
+    # only the tokens of the current declaration are kept, bodies are skipped by `skip_braces`
+    # and the scan is resumed after them
+    decl = []
+    closing = None      # `)` or `}` while the tokens are collected up to the closing bracket
+    depth = 0
+    pos = 0
+    while pos is not None:
+        resume, pos = pos, None
+        for token in iter_tokens(text, resume):
+            value = token[0]
+            if closing:
+                decl.append(token)
+                if value == closing:
+                    depth -= 1
+                    if depth == 0:
+                        closing = None
+                elif value == OPENING[closing]:
+                    depth += 1
+            elif value == ';':
+                decl = []
+            elif value == '}':
+                if scopes:
+                    scopes.pop()
+                decl = []
+            elif value == ':' and len(decl) == 1 and decl[0][0] in ACCESS_SPECIFIERS:
+                decl = []
+            elif value == '(':
+                decl.append(token)
+                closing, depth = ')', 1
+            elif value != '{':
+                decl.append(token)
+            else:
+                tokens = decl + [token]
+                i = len(decl)
+                start = skip_template_header(tokens, 0, i)
+                texts = [t[0] for t in tokens[start:i]]
+                function = find_function_declarator(tokens, start, i)
+                if function and is_initializer_brace(tokens, function[1], i):
+                    # member initializer is a part of the declaration
+                    decl.append(token)
+                    closing, depth = '}', 1
+                elif function:
+                    p, q, spelling, qualifiers, name_start = function
+                    pos = skip_braces(text, token[2])
+                    start, linkage = skip_declaration_prefix(tokens, start, name_start)
+                    record = get_record(tokens, texts, start, p, q, i, spelling, qualifiers, name_start,
+                                        scopes, namespaces, linkage)
+                    if record:
+                        start_offset = tokens[start][1]
+                        line += text.count('\n', line_pos, start_offset)
+                        line_pos = start_offset
+                        records.append((record, start_offset, pos, line))
+                    decl = []
+                    break
+                elif texts and texts[0] in ('namespace', 'inline') and 'namespace' in texts[:2]:
+                    name = texts[-1] if texts[-1] != 'namespace' else ''
+                    scopes.append(('namespace', name))
+                    namespaces.add(name)
+                    decl = []
+                elif texts[:1] == ['extern'] and len(texts) == 2:
+                    scopes.append(('extern', None))
+                    decl = []
+                elif ('=' not in texts and 'enum' not in texts and
+                      any(keyword in texts for keyword in ('class', 'struct', 'union'))):
+                    scopes.append(('class', get_class_name(texts)))
+                    decl = []
+                else:
+                    # enum body, brace initializer, lambda and alike stay in the declaration without their content
+                    pos = skip_braces(text, token[2])
+                    decl += [token, ('}', pos - 1, pos)]
+                    break
+    return records
+
+
+def find_function_declarator(tokens: list, start: int, brace: int) -> tuple:
+    '''
+    Find parameter list of the function whose body starts at `brace`. The first parenthesized group
+    that is preceded by a name and followed by function qualifiers (or body) is the parameter list,
+    so that macros before the declaration are skipped.
+    :return: (p, q, spelling, qualifiers, name_start) - indexes of parentheses of parameter list,
+    unqualified name, list of qualifying names and index of the first token of qualified name or None
+    '''
+    i = start
+    while i < brace:
+        token = tokens[i][0]
+        if token == '=' and 'operator' not in (tokens[i - 1][0], tokens[i - 2][0]):
+            # variable initializer (but not `operator=` or `operator==`)
+            return None
+        if token == '(':
+            q = find_closing(tokens, i, '(', ')')
+            if q >= brace:
+                return None
+            after = tokens[q + 1][0]
+            if after in FUNCTION_QUALIFIERS:
+                spelling, qualifiers, name_start = get_function_name(tokens, i, start)
+                if spelling:
+                    return i, q, spelling, qualifiers, name_start
+            i = q
+        i += 1
+    return None
+
+
+def is_initializer_brace(tokens: list, q: int, brace: int) -> bool:
+    '''
+    Check whether the brace is a member initializer of constructor initializer list (`: a{1}`)
+    rather than the body.
+    :param q: index of `)` of parameter list
+    :param brace: index of the brace
+    '''
+    if not any(token[0] == ':' for token in tokens[q + 1:brace]):
+        return False
+    prev = tokens[brace - 1][0]
+    return prev == '>' or bool(re.match(r'[A-Za-z_$]', prev))
+
+
+def get_class_name(texts: list) -> str:
+    for j, text in enumerate(texts):
+        if text in ('class', 'struct', 'union'):
+            for name in texts[j + 1:]:
+                if name == '[' or name == 'alignas':
+                    continue
+                if re.match(r'[A-Za-z_$]', name) and name not in ('final', 'alignas'):
+                    return name
+                if name in (':', '{'):
+                    break
+            return ''
+    return ''
+
+
+def get_record(tokens: list, texts: list, start: int, p: int, q: int, brace: int, spelling: str,
+               qualifiers: list, name_start: int, scopes: list, namespaces: set, linkage: bool = False) -> tuple:
+    '''
+    Calculate signature key of the function definition.
+    :param linkage: declaration has linkage specification (`extern "C" int f()`)
+    :return: key - tuple or None if it is a constructor, destructor or conversion operator
+    '''
+    class_scope = scopes[-1][1] if scopes and scopes[-1][0] == 'class' else None
+    enclosing = [name for kind, name in scopes if kind != 'extern']
+    if qualifiers:
+        parent = qualifiers[-1]
+        kind = 'FUNCTION_DECL' if parent in namespaces and class_scope is None else 'CXX_METHOD'
+    elif class_scope is not None and 'friend' not in texts:
+        parent = class_scope
+        kind = 'CXX_METHOD'
+    elif linkage or (scopes and scopes[-1][0] == 'extern'):
+        # semantic parent of the function is linkage specification
+        parent = ''
+        kind = 'FUNCTION_DECL'
+    else:
+        namespace_names = [name for kind, name in scopes if kind == 'namespace']
+        parent = namespace_names[-1] if namespace_names else None
+        kind = 'FUNCTION_DECL'
+
+    if spelling.startswith('~') or spelling == parent or (enclosing and spelling == enclosing[-1]):
+        return None
+
+    return_type = []
+    j = start
+    while j < name_start:
+        text = tokens[j][0]
+        if text == '[':
+            j = find_closing(tokens, j, '[', ']') + 1
+            continue
+        after = skip_macro(tokens, j, name_start)
+        if after != j and (text in ATTRIBUTE_KEYWORDS or
+                           any(t[0] not in SPECIFIERS for t in tokens[after:name_start])):
+            # macro (like `static API int f()`) is skipped if something is left for the return type
+            j = after
+            continue
+        if text not in SPECIFIERS:
+            return_type.append(text)
+        j += 1
+    if spelling.startswith('operator ') and spelling not in ('operator new', 'operator delete') and \
+            all(_MACRO_RE.match(text) for text in return_type):
+        # conversion operator
+        return None
+
+    param_types = get_parameter_types([t[0] for t in tokens[p + 1:q]])
+    const = False
+    trailing_return_type = None
+    for token in tokens[q + 1:brace]:
+        text = token[0]
+        if trailing_return_type is not None:
+            if text in (':', 'override', 'final'):
+                break
+            trailing_return_type.append(text)
+        elif text == 'const':
+            const = True
+        elif text == '->':
+            trailing_return_type = []
+        elif text == ':':
+            break
+    if trailing_return_type:
+        return_type = trailing_return_type
+
+    return_type = normalize_type(return_type) or 'void'
+    function_type = return_type + ('' if return_type.endswith(('*', '&')) else ' ')
+    function_type += '(' + ', '.join(param_types) + ')'
+    if const:
+        function_type += ' const'
+    return kind, True, const, None, None, spelling, function_type, parent
@@ -0,0 +1,190 @@
+import contextlib
+import cProfile
+import json
+import sys
+import time
+
+from clang.cindex import conf
+
+
+class Profiler:
+    '''
+    Collects wall/CPU time per phase and counters of a run. Phases may be entered several
+    times (e.g. `parse` for source and destination files), their times are summed up.
+    '''
+    def __init__(self, count_libclang_calls: bool = True):
+        '''
+        :param count_libclang_calls: wrap libclang functions to count the calls (adds overhead to every call)
+        '''
+        self.phases = {}        # name -> [wall, cpu, calls]
+        self.counters = {}      # name -> int
+        self.libclang_calls = {}    # libclang function name -> number of calls
+        self.count_libclang_calls = count_libclang_calls
+        self._wrapped_functions = {}
+        self._wall_start = None
+        self._cpu_start = None
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, [0.0, 0.0, 0])
+            phase[0] += time.perf_counter() - wall_start
+            phase[1] += time.process_time() - cpu_start
+            phase[2] += 1
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def _wrap_libclang(self):
+        lib = conf.lib
+        for name, func in list(vars(lib).items()):
+            if not name.startswith('clang_') or not callable(func):
+                continue
+
+            def wrapper(*args, _name=name, _func=func):
+                self.libclang_calls[_name] = self.libclang_calls.get(_name, 0) + 1
+                return _func(*args)
+
+            self._wrapped_functions[name] = func
+            setattr(lib, name, wrapper)
+
+    def _unwrap_libclang(self):
+        lib = conf.lib
+        for name, func in self._wrapped_functions.items():
+            setattr(lib, name, func)
+        self._wrapped_functions = {}
+
+    def start(self):
+        if self.count_libclang_calls:
+            self._wrap_libclang()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def stop(self):
+        self.wall += time.perf_counter() - self._wall_start
+        self.cpu += time.process_time() - self._cpu_start
+        self._unwrap_libclang()
+
+    def to_dict(self) -> dict:
+        '''
+        :return: report - dict with `wall`, `cpu`, `phases`, `counters` and `libclang_calls` keys (times in seconds)
+        '''
+        counters = dict(self.counters)
+        if self.count_libclang_calls:
+            counters['libclang_calls'] = sum(self.libclang_calls.values())
+        return {'wall': self.wall,
+                'cpu': self.cpu,
+                'phases': {name: {'wall': wall, 'cpu': cpu, 'calls': calls}
+                           for name, (wall, cpu, calls) in self.phases.items()},
+                'counters': counters,
+                'libclang_calls': dict(sorted(self.libclang_calls.items(), key=lambda item: -item[1]))}
+
+    def format_summary(self, top: int = 10) -> str:
+        '''
+        Format human readable summary.
+        :param top: number of most called libclang functions to be listed
+        :return: summary
+        '''
+        report = self.to_dict()
+        lines = [f"{'phase':24} {'wall, s':>10} {'cpu, s':>10} {'calls':>7}"]
+        for name, phase in report['phases'].items():
+            lines.append(f"{name:24} {phase['wall']:10.4f} {phase['cpu']:10.4f} {phase['calls']:7}")
+        lines.append(f"{'total':24} {report['wall']:10.4f} {report['cpu']:10.4f}")
+        lines.append('')
+        for name, value in report['counters'].items():
+            lines.append(f"{name:24} {value:>10}")
+        if report['libclang_calls']:
+            lines.append('')
+            lines.append('most called libclang functions:')
+            for name, value in list(report['libclang_calls'].items())[:top]:
+                lines.append(f"  {name:38} {value:>10}")
+        return '\n'.join(lines)
+
+
+# profiler of the current run, instrumented code does nothing if it isn't set
+_profiler = None
+
+
+@contextlib.contextmanager
+def _null_phase():
+    yield
+
+
+def get_profiler() -> Profiler:
+    return _profiler
+
+
+def phase(name: str):
+    '''
+    Context manager that measures the phase if profiling is enabled.
+    :param name: phase name
+    '''
+    if _profiler is None:
+        return _null_phase()
+    return _profiler.phase(name)
+
+
+def count(name: str, n: int = 1):
+    '''
+    Increment the counter if profiling is enabled.
+    :param name: counter name
+    :param n: increment
+    '''
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+@contextlib.contextmanager
+def profile(output_format: str = None, stream=None, pstats_file: str = None):
+    '''
+    Enable profiling for the code run in the context and report the results on exit.
+    :param output_format: `text`, `json` or `None` (profiling is disabled unless `pstats_file` is given)
+    :param stream: where to write the report (stderr by default)
+    :param pstats_file: also run cProfile and dump its stats to the file (may be read by `pstats` module)
+    :return: profiler or None if profiling is disabled
+    '''
+    global _profiler
+    if not output_format and not pstats_file:
+        yield None
+        return
+
+    profiler = Profiler(count_libclang_calls=bool(output_format))
+    cprofile = cProfile.Profile() if pstats_file else None
+    _profiler = profiler
+    profiler.start()
+    if cprofile:
+        cprofile.enable()
+    try:
+        yield profiler
+    finally:
+        if cprofile:
+            cprofile.disable()
+        profiler.stop()
+        _profiler = None
+        if cprofile:
+            cprofile.dump_stats(pstats_file)
+        stream = stream or sys.stderr
+        if output_format == 'json':
+            json.dump(profiler.to_dict(), stream, indent=2)
+            stream.write('\n')
+        elif output_format:
+            stream.write(profiler.format_summary() + '\n')
+
+
+def add_profile_arguments(parser):
+    '''
+    Add `--profile` and `--profile-pstats` options to the argument parser.
+    '''
+    parser.add_argument('--profile', dest='profile', action='store', nargs='?',
+                        const='text', default=None, choices=('text', 'json'),
+                        help='print wall/CPU time of every phase and counters (cursors visited, '
+                             'libclang calls etc.) to stderr as a summary (default) or JSON')
+    parser.add_argument('--profile-pstats', dest='profile_pstats', action='store',
+                        metavar='FILE', type=type('string'), default=None,
+                        help='run cProfile and dump its stats to the file (to be read by `pstats` module)')
@@ -0,0 +1,342 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+
+from clang.cindex import Index, TranslationUnit
+from collections import OrderedDict
+from cppguts.dumpcpp import FIELD_PRESETS, get_node_json, iter_nodes, parse_fields
+from cppguts.editcpp import (EditCppError, PARSE_CREATE_PREAMBLE_ON_FIRST_PARSE, FAST_DISCOVERY_PARSE_OPTIONS,
+                             finish_edit, get_error_message, get_replacement_spans, prepare_edit)
+from cppguts.splice import apply_spans
+from cppguts.tucache import default_cache_dir, get_file_record, has_errors, is_file_record_valid
+
+
+# preamble (headers included at the beginning of a file) is kept precompiled so that reparse is cheap
+SERVER_PARSE_OPTIONS = TranslationUnit.PARSE_PRECOMPILED_PREAMBLE | PARSE_CREATE_PREAMBLE_ON_FIRST_PARSE
+
+
+def default_socket_path() -> str:
+    return os.path.join(default_cache_dir(), 'servecpp.sock')
+
+
+class TranslationUnitStore:
+    '''
+    Keeps translation units in memory. If any of the files translation unit depends on is changed
+    (or different unsaved files are given) the translation unit is reparsed instead of being parsed from scratch.
+    Translation units with errors are reparsed by every request: the files they failed to include aren't recorded.
+    Least recently used translation units are dropped when there are more than `max_units` of them.
+    '''
+
+    def __init__(self, max_units: int = 64):
+        self.index = Index.create()
+        self.max_units = max_units
+        # (filename, clang args, options) -> {'tu': tu, 'files': file records, 'unsaved': unsaved files digest,
+        #                                     'errors': whether tu has errors}
+        self.units = OrderedDict()
+
+    def get(self, filename: str, clangcmd: list, options: int = SERVER_PARSE_OPTIONS,
+            unsaved_files: list = None) -> (TranslationUnit, str):
+        '''
+        Get up to date translation unit. Translation unit parsed with unsaved files is reused only
+        by the requests with the same unsaved files, files that are given as unsaved are never read from the disk.
+        :param filename: main file of translation unit (absolute path)
+        :param clangcmd: list of clang arguments (without file name)
+        :param options: parse options
+        :param unsaved_files: list of (filename, content) tuples
+        :return: tu, status - translation unit and one of `parsed`, `reparsed` or `reused`
+        '''
+        key = (filename, tuple(clangcmd), options)
+        unsaved_digest = get_unsaved_digest(unsaved_files)
+        unit = self.units.get(key)
+        if unit is None:
+            tu = self.index.parse(filename, list(clangcmd), unsaved_files, options)
+            status = 'parsed'
+        elif (unit['unsaved'] != unsaved_digest or unit['errors'] or
+              not all(is_file_record_valid(record) for record in unit['files'])):
+            tu = unit['tu']
+            # files that are not in `unsaved_files` are read from the disk again,
+            # units with errors may depend on the files that were missing so they are always reparsed
+            tu.reparse(unsaved_files)
+            status = 'reparsed'
+        else:
+            tu = unit['tu']
+            status = 'reused'
+
+        if status != 'reused':
+            unsaved_filenames = {name for name, _ in unsaved_files or []}
+            filenames = [filename] + [include.include.name for include in tu.get_includes() if include.include]
+            files = [get_file_record(name) for name in filenames
+                     if name not in unsaved_filenames and os.path.isfile(name)]
+            unit = {'tu': tu, 'files': files, 'unsaved': unsaved_digest, 'errors': has_errors(tu)}
+        self.units[key] = unit
+        self.units.move_to_end(key)
+        while len(self.units) > self.max_units:
+            self.units.popitem(last=False)
+        return tu, status
+
+
+def get_unsaved_digest(unsaved_files: list) -> str:
+    '''
+    Calculate digest of unsaved files (names and contents).
+    :param unsaved_files: list of (filename, content) tuples, content is str or bytes
+    :return: digest - hexdigest or None if there are no unsaved files
+    '''
+    if not unsaved_files:
+        return None
+    h = hashlib.sha256()
+    for filename, content in sorted(unsaved_files):
+        for data in (filename.encode('utf-8'), content.encode('utf-8') if isinstance(content, str) else content):
+            h.update(len(data).to_bytes(8, 'little'))
+            h.update(data)
+    return h.hexdigest()
+
+
+def _get_clang_args(request: dict) -> list:
+    # relative paths in clang arguments are relative to the client working directory
+    clang_args = list(request.get('clang_args', []))
+    if request.get('cwd'):
+        clang_args.insert(0, '-working-directory=' + request['cwd'])
+    return clang_args
+
+
+def _get_unsaved_files(request: dict) -> list:
+    return [(filename, content) for filename, content in request.get('unsaved_files', {}).items()]
+
+
+def _read_file(filename: str, unsaved_files: list) -> bytes:
+    for unsaved_filename, content in unsaved_files:
+        if unsaved_filename == filename:
+            return content.encode('utf-8')
+    with open(filename, mode='rb') as file:
+        return file.read()
+
+
+def handle_edit(store: TranslationUnitStore, request: dict) -> dict:
+    '''
+    Replace function/method definitions in `dest_file` by the ones found in `src_file`.
+    If `dest_file` is one of `unsaved_files` nothing is written: patched content is returned in `dest_text`.
+    :param store: translation units store
+    :param request: dict with `src_file`, `dest_file` and optional `clang_args`, `cwd`,
+    `unsaved_files`, `oldfile_delete`, `fast_discovery` and `use_usr` keys
+    :return: response - dict
+    '''
+    srcfile = request['src_file']
+    destfile = request['dest_file']
+    clang_args = _get_clang_args(request)
+    unsaved_files = _get_unsaved_files(request)
+    options = SERVER_PARSE_OPTIONS
+    if request.get('fast_discovery'):
+        options |= FAST_DISCOVERY_PARSE_OPTIONS
+    for filename in (srcfile, destfile):
+        if not os.path.isfile(filename) and filename not in dict(unsaved_files):
+            raise EditCppError(f"specified file doesn't exist:\n{filename}\n")
+
+    tu_src, status_src = store.get(srcfile, clang_args, options, unsaved_files)
+    tu_dest, status_dest = store.get(destfile, clang_args, options, unsaved_files)
+    srcdata = _read_file(srcfile, unsaved_files)
+    destdata = _read_file(destfile, unsaved_files)
+
+    spans = get_replacement_spans(tu_src, tu_dest, srcfile, destfile, srcdata, request.get('use_usr', False),
+                                  match_by_name=True)
+    changed = prepare_edit(destfile, destdata, spans)
+    response = {'ok': True,
+                'message': f"{len(changed)} of {len(spans)} definition(s) changed "
+                           f"(source {status_src}, destination {status_dest})"}
+    if destfile in dict(unsaved_files):
+        response['dest_text'] = apply_spans(destdata, changed).decode('utf-8')
+    else:
+        finish_edit(destfile, destdata, changed, request.get('oldfile_delete', False))
+    return response
+
+
+def handle_dump(store: TranslationUnitStore, request: dict, wfile) -> dict:
+    '''
+    Write one `{"node": ...}` JSON line per cursor.
+    :param store: translation units store
+    :param request: dict with `file` and optional `clang_args`, `cwd`, `unsaved_files`,
+    `fields`, `max_depth` and `object_name` keys
+    :param wfile: stream to write node lines to
+    :return: response - dict
+    '''
+    filename = request['file']
+    if not os.path.isfile(filename) and filename not in request.get('unsaved_files', {}):
+        raise EditCppError(f"specified file doesn't exist:\n{filename}\n")
+    fields = parse_fields(request.get('fields', 'full'))
+    objname = request.get('object_name')
+
+    tu, status = store.get(filename, _get_clang_args(request), SERVER_PARSE_OPTIONS, _get_unsaved_files(request))
+    nnodes = 0
+    for node_id, parent_id, depth, node in iter_nodes(tu.cursor, request.get('max_depth')):
+        if objname and objname != node.spelling:
+            continue
+        line = json.dumps({'node': get_node_json(node, node_id, parent_id, depth, fields)}) + '\n'
+        wfile.write(line.encode('utf-8'))
+        nnodes += 1
+    return {'ok': True, 'message': f"{nnodes} node(s) dumped (translation unit {status})"}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Reads one JSON request line and writes JSON response line(s): optional `{"node": ...}`
+    lines followed by the final `{"ok": ..., "message": ...}` line.
+    '''
+
+    def handle(self):
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            command = request.get('command')
+            if command == 'edit':
+                response = handle_edit(self.server.store, request)
+            elif command == 'dump':
+                response = handle_dump(self.server.store, request, self.wfile)
+            elif command == 'stats':
+                response = {'ok': True, 'message': f"{len(self.server.store.units)} translation unit(s) loaded"}
+            elif command == 'shutdown':
+                self.server.shutdown_requested = True
+                response = {'ok': True, 'message': 'shutting down'}
+            else:
+                response = {'ok': False, 'message': f"unknown command: {command}"}
+        except (EditCppError, ValueError, KeyError, OSError) as e:
+            response = {'ok': False, 'message': str(e)}
+        except Exception as e:
+            response = {'ok': False, 'message': get_error_message(e)}
+        response['elapsed'] = time.perf_counter() - start
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+# Unix sockets may be unavailable (Windows), `main` reports that
+class Server(getattr(socketserver, 'UnixStreamServer', socketserver.TCPServer)):
+    '''
+    Single threaded server: libclang translation units must not be used from several threads at once.
+    '''
+
+    def __init__(self, socket_path: str, max_units: int = 64):
+        self.store = TranslationUnitStore(max_units)
+        self.shutdown_requested = False
+        super().__init__(socket_path, RequestHandler)
+
+    def serve(self):
+        while not self.shutdown_requested:
+            self.handle_request()
+
+
+def send_request(request: dict, socket_path: str = None, stream=sys.stdout) -> dict:
+    '''
+    Send request to the server. Node lines (if any) are written to the `stream`.
+    :param request: request dict
+    :param socket_path: server socket path
+    :param stream: stream to write node lines to
+    :return: response - final response dict
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path or default_socket_path())
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as rfile:
+            for line in rfile:
+                message = json.loads(line.decode('utf-8'))
+                if 'node' in message:
+                    stream.write(json.dumps(message['node']) + '\n')
+                else:
+                    return message
+    return {'ok': False, 'message': 'connection closed by the server'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=
+                                     'Server that keeps parsed translation units in memory and serves '
+                                     '`editcpp`/`dumpcpp` requests over a Unix socket. '
+                                     'Changed files are reparsed incrementally. Use `servecpp-client` to send requests.')
+    parser.add_argument('--socket', dest='socket', action='store',
+                        type=type('string'), required=False, default=default_socket_path(),
+                        help='Unix socket path (default: %(default)s)')
+    parser.add_argument('--max-units', dest='max_units', action='store',
+                        metavar='N', type=int, required=False, default=64,
+                        help='max number of translation units kept in memory (default: %(default)s)')
+    args = parser.parse_args()
+
+    if not hasattr(socket, 'AF_UNIX'):
+        parser.error("Unix sockets are not supported on this platform\n")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = Server(args.socket, args.max_units)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+def client_main():
+    parser = argparse.ArgumentParser(description=
+                                     'Send `edit`/`dump` request to `servecpp` server. '
+                                     'After passing the command flags you are allowed to pass clang '
+                                     'commands like `-I` (to include dir), `-std=c++17` and other.')
+    parser.add_argument('--socket', dest='socket', action='store',
+                        type=type('string'), required=False, default=default_socket_path(),
+                        help='Unix socket path (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    edit_parser = subparsers.add_parser('edit', help='replace function/method definitions (see `editcpp`)')
+    edit_parser.add_argument('--src-file', dest='srcfile', action='store',
+                             type=type('string'), required=True,
+                             help='file with new functions definitions')
+    edit_parser.add_argument('--dest-file', dest='destfile', action='store',
+                             type=type('string'), required=True,
+                             help='file with old functions definitions')
+    edit_parser.add_argument('--oldfile-delete', dest='oldfile_del', action='store_true',
+                             help='use this to delete old version of destination file')
+    edit_parser.add_argument('--fast-discovery', dest='fast_discovery', action='store_true',
+                             help='skip function bodies of the headers included at the beginning of the files')
+    edit_parser.add_argument('--match-usr', dest='use_usr', action='store_true',
+                             help='also require USR of matching functions/methods to be equal')
+    dump_parser = subparsers.add_parser('dump', help='dump cursors as JSON Lines (see `dumpcpp --jsonl`)')
+    dump_parser.add_argument('--file', dest='file', action='store',
+                             type=type('string'), required=True,
+                             help='file to be dumped')
+    dump_parser.add_argument('--max-depth', dest='maxdepth', action='store',
+                             metavar='N', type=int, required=False, default=None,
+                             help='limit cursor expansion to depth N')
+    dump_parser.add_argument('--object-name', dest='objname', action='store',
+                             type=type('string'), required=False, default=None,
+                             help='dump only specified names (spelling)')
+    dump_parser.add_argument('--fields', dest='fields', action='store',
+                             type=type('string'), required=False, default='full',
+                             help='comma separated list of node fields and/or presets: ' + ', '.join(FIELD_PRESETS))
+    subparsers.add_parser('stats', help='print number of translation units kept by the server')
+    subparsers.add_parser('shutdown', help='stop the server')
+    args, clangcmd = parser.parse_known_args()
+
+    request = {'command': args.command, 'cwd': os.getcwd(), 'clang_args': clangcmd}
+    if args.command == 'edit':
+        request.update({'src_file': os.path.abspath(args.srcfile),
+                        'dest_file': os.path.abspath(args.destfile),
+                        'oldfile_delete': args.oldfile_del,
+                        'fast_discovery': args.fast_discovery,
+                        'use_usr': args.use_usr})
+    elif args.command == 'dump':
+        request.update({'file': os.path.abspath(args.file),
+                        'max_depth': args.maxdepth,
+                        'object_name': args.objname,
+                        'fields': args.fields})
+
+    try:
+        response = send_request(request, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        parser.error(f"unable to connect to the server:\n{args.socket}\n{e}\n")
+    print(response['message'].rstrip(), file=sys.stderr)
+    if not response['ok']:
+        parser.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+def check_spans(spans: list, size: int) -> list:
+    '''
+    Sort spans and check that they are within the data and don't overlap each other.
+    :param spans: list of (start_offset, end_offset, replacement) tuples
+    :param size: size of the data the spans are to be applied to
+    :return: sorted_spans - spans sorted by start offset
+    '''
+    sorted_spans = sorted(spans, key=lambda span: (span[0], span[1]))
+    prev_end = 0
+    prev_span = None
+    for span in sorted_spans:
+        start, end = span[0], span[1]
+        if start < 0 or end < start or end > size:
+            raise ValueError(f"span [{start}, {end}) is out of data bounds [0, {size})")
+        if start < prev_end:
+            raise ValueError(f"span [{start}, {end}) overlaps span [{prev_span[0]}, {prev_span[1]})")
+        prev_end = end
+        prev_span = span
+    return sorted_spans
+
+
+def apply_spans(data: bytes, spans: list) -> bytes:
+    '''
+    Replace all the spans in one linear pass over the original data.
+    Everything outside the spans (line endings, trailing whitespaces) is kept byte to byte.
+    :param data: original data
+    :param spans: list of (start_offset, end_offset, replacement) tuples, offsets are in bytes
+    :return: patched data
+    '''
+    chunks = []
+    pos = 0
+    for start, end, replacement in check_spans(spans, len(data)):
+        chunks.append(data[pos:start])
+        chunks.append(replacement)
+        pos = end
+    chunks.append(data[pos:])
+    return b''.join(chunks)
+
+
+# unchanged data is written by chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+
+def write_spans(stream, data, spans: list, chunk_size: int = CHUNK_SIZE) -> int:
+    '''
+    Same as `apply_spans` but the patched data is written to the stream chunk by chunk instead of
+    being joined in memory, so `data` may be memory-mapped file of any size.
+    :param stream: binary stream to write to
+    :param data: original data (bytes, mmap or anything that supports buffer protocol)
+    :param spans: list of (start_offset, end_offset, replacement) tuples, offsets are in bytes
+    :param chunk_size: max size of the unchanged data written at once
+    :return: size - number of bytes written
+    '''
+    size = 0
+    pos = 0
+    with memoryview(data) as view:
+        for start, end, replacement in check_spans(spans, len(view)) + [(len(view), len(view), b'')]:
+            for chunk_start in range(pos, start, chunk_size):
+                size += stream.write(view[chunk_start:min(chunk_start + chunk_size, start)])
+            size += stream.write(replacement)
+            pos = end
+    return size
@@ -1,9 +1,30 @@
+import io
+import json
 import os
 from pathlib import Path
 import shutil
+import socket
 import subprocess
 import sys
+import threading
 import unittest
+from unittest import mock
+
+from clang.cindex import Diagnostic, Index
+from cppguts.benchmarks.corpus import generate_corpus
+from cppguts.benchmarks.memory import run_memory_benchmark
+from cppguts.benchmarks.run import run_benchmarks
+from cppguts import profiling
+from cppguts.lexmatch import find_lexical_definitions, fingerprint
+from cppguts.dumpcpp import FIELD_PRESETS, dump_jsonl, get_node_info, parse_fields
+from cppguts.editcpp import (EditCppError, FAST_DISCOVERY_PARSE_OPTIONS, build_signature_index,
+                             edit_file, edit_files, edit_text, find_method_def_nodes, parse_concurrently,
+                             get_method_signature_key)
+from cppguts.indexcpp import query_symbols, update_index
+from cppguts.servecpp import Server, TranslationUnitStore, send_request
+from cppguts.splice import apply_spans, write_spans
+from cppguts import tucache
+from cppguts.tucache import DiagnosticsInfo, get_pch_args, parse_tu, select_diagnostics
 
 
 class test_basics(unittest.TestCase):
@@ -14,14 +35,18 @@ class test_basics(unittest.TestCase):
     dest = os.path.join(tmp_dir, 'dest.h')
     srcin = os.path.join(data_dir, 'src.h.in')
     destin = os.path.join(data_dir, 'dest.h.in')
+    dest_expected = os.path.join(data_dir, 'dest_expected.h.in')
 
     def setUp(self):
         shutil.rmtree(self.tmp_dir, ignore_errors=True)
         Path(self.tmp_dir).mkdir(parents=True, exist_ok=True)
+        self.env_patch = mock.patch.dict(os.environ, {'CPPGUTS_CACHE_DIR': os.path.join(self.tmp_dir, 'cache')})
+        self.env_patch.start()
         shutil.copy(self.srcin, self.src)
         shutil.copy(self.destin, self.dest)
 
     def tearDown(self):
+        self.env_patch.stop()
         shutil.rmtree(self.tmp_dir, ignore_errors=True)
 
     def test_basics(self):
@@ -33,4 +58,640 @@ class test_basics(unittest.TestCase):
 
         with open(self.dest) as f:
             with open(self.destin) as fin:
-                self.assertTrue(f != fin)
\ No newline at end of file
+                self.assertTrue(f != fin)
+        with open(self.dest, 'rb') as f:
+            with open(self.dest_expected, 'rb') as fexpected:
+                self.assertEqual(f.read(), fexpected.read())
+
+    def test_manifest(self):
+        guts_env = os.environ.copy()
+        guts_env["PATH"] += os.pathsep + os.path.dirname(sys.executable)
+        pairs = []
+        for i in range(2):
+            pair_dir = os.path.join(self.tmp_dir, f'pair_{i}')
+            Path(pair_dir).mkdir()
+            shutil.copy(self.destin, os.path.join(pair_dir, 'dest.h'))
+            pairs.append({'src_file': 'src.h',
+                          'dest_file': os.path.join(f'pair_{i}', 'dest.h'),
+                          'clang_args': ['-std=c++03']})
+        pairs.append({'src_file': 'src.h', 'dest_file': 'missing.h'})
+        manifest = os.path.join(self.tmp_dir, 'manifest.json')
+        with open(manifest, 'w') as f:
+            json.dump({'pairs': pairs}, f)
+
+        proc = subprocess.run(['editcpp', '--manifest', manifest, '--oldfile-delete'],
+                              env=guts_env, stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn('2 succeeded, 1 failed', proc.stdout)
+
+        with open(self.destin) as fin:
+            destin_data = fin.read()
+        for i in range(2):
+            pair_dir = os.path.join(self.tmp_dir, f'pair_{i}')
+            self.assertEqual(os.listdir(pair_dir), ['dest.h'])
+            with open(os.path.join(pair_dir, 'dest.h')) as f:
+                data = f.read()
+            self.assertNotEqual(data, destin_data)
+            self.assertIn('v += 10;', data)
+
+    def test_tu_cache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        # translation units with errors aren't cached, the warning is the diagnostic to be stored
+        main = os.path.join(self.tmp_dir, 'main.cpp')
+        with open(main, 'w') as f:
+            f.write('#warning cached\nvoid foo(){}\nvoid bar(){}\n')
+        index = Index.create()
+        tu, diagnostics = parse_tu(index, main, ['-std=c++03'], cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertFalse(isinstance(diagnostics[0]['location'], str))
+
+        # nothing changed: TU is loaded from the cache with stored diagnostics
+        tu_cached, diagnostics_cached = parse_tu(index, main, ['-std=c++03'], cache_dir=cache_dir)
+        self.assertTrue(isinstance(diagnostics_cached[0]['location'], str))
+        self.assertEqual([c.spelling for c in tu.cursor.get_children()],
+                         [c.spelling for c in tu_cached.cursor.get_children()])
+
+        # file changed: new entry is created, old one is evicted as it doesn't fit
+        with open(main, 'a') as f:
+            f.write('void baz(){}\n')
+        tu, diagnostics = parse_tu(index, main, ['-std=c++03'], cache_dir=cache_dir, cache_size=0)
+        self.assertFalse(isinstance(diagnostics[0]['location'], str))
+        self.assertIn('baz', [c.spelling for c in tu.cursor.get_children()])
+        self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_tu_cache_missing_include(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        main = os.path.join(self.tmp_dir, 'main.cpp')
+        with open(main, 'w') as f:
+            f.write('#include "missing.h"\nvoid f(){}\n')
+        index = Index.create()
+        tu, diagnostics = parse_tu(index, main, ['-std=c++03'], cache_dir=cache_dir)
+        self.assertEqual(len(select_diagnostics(diagnostics, Diagnostic.Error)), 1)
+        self.assertFalse(os.path.exists(cache_dir) and os.listdir(cache_dir))
+
+        # the header appears: translation unit with the error isn't served from the cache
+        with open(os.path.join(self.tmp_dir, 'missing.h'), 'w') as f:
+            f.write('void g();\n')
+        tu, diagnostics = parse_tu(index, main, ['-std=c++03'], cache_dir=cache_dir)
+        self.assertEqual(select_diagnostics(diagnostics, Diagnostic.Error), [])
+        self.assertEqual([c.spelling for c in tu.cursor.get_children() if c.location.file],
+                         ['g', 'f'])
+
+    def test_relative_paths_cached(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            # translation units with errors aren't cached, so the files have to be valid code
+            with open('src.cpp', 'w') as f:
+                f.write('int f(int a){ return a + 2; }\n')
+            # the second run loads translation units from the cache, they report absolute file names
+            for i in range(2):
+                with open('dest.cpp', 'w') as f:
+                    f.write('int g(){ return 0; }\nint f(int a){ return a + 1; }\n')
+                edit_file(Index.create(), 'src.cpp', 'dest.cpp', ['-std=c++03'], oldfile_del=True,
+                          print_diagnostics=False, cache_dir=cache_dir)
+                with open('dest.cpp') as f:
+                    self.assertEqual(f.read(), 'int g(){ return 0; }\nint f(int a){ return a + 2; }\n')
+                self.assertTrue(os.listdir(cache_dir))
+        finally:
+            os.chdir(cwd)
+
+    def test_fast_discovery(self):
+        header = os.path.join(self.tmp_dir, 'helper.h')
+        main = os.path.join(self.tmp_dir, 'main.cpp')
+        with open(header, 'w') as f:
+            f.write('inline int helper(int a){ return a+1; }\n'
+                    'struct H { int m(){ return 1; } };\n')
+        with open(main, 'w') as f:
+            f.write('#include "helper.h"\n'
+                    'namespace ns { int f(int a){ return helper(a); } }\n'
+                    'struct S { void g() const { int x = 1; } };\n')
+
+        index = Index.create()
+        for options in (0, FAST_DISCOVERY_PARSE_OPTIONS):
+            tu = index.parse(main, ['-std=c++11'], options=options)
+            nodes = []
+            find_method_def_nodes(tu.cursor, nodes, main)
+            self.assertEqual([n.spelling for n in nodes], ['f', 'g'])
+
+            nodes = []
+            find_method_def_nodes(tu.cursor, nodes, header)
+            self.assertEqual([n.spelling for n in nodes], [] if options else ['helper', 'm'])
+
+    def test_signature_index(self):
+        index = Index.create()
+        tu = index.parse(self.dest, ['-std=c++03'])
+        nodes = []
+        find_method_def_nodes(tu.cursor, nodes, self.dest)
+        signature_index = build_signature_index(nodes)
+        self.assertEqual(len(signature_index), len(nodes))
+        self.assertIn(('FUNCTION_DECL', True, False, False, False, 'bar', 'void (int &)', 'ns'), signature_index)
+        self.assertIn(('FUNCTION_DECL', True, False, False, False, 'foo', 'void (int &)', None), signature_index)
+
+        # the same function defined twice in destination can't be replaced
+        with open(self.dest, 'a') as f:
+            f.write('\nvoid foo(int &v){\n  v++;\n}\n')
+        with self.assertRaisesRegex(EditCppError, 'ambiguous'):
+            edit_file(index, self.src, self.dest, ['-std=c++03'], print_diagnostics=False)
+
+    def test_splice(self):
+        self.assertEqual(apply_spans(b'0123456789', [(6, 8, b'b'), (1, 3, b'aaa')]), b'0aaa345b89')
+        with self.assertRaisesRegex(ValueError, 'overlaps'):
+            apply_spans(b'0123456789', [(1, 3, b''), (2, 4, b'')])
+
+        # two definitions on one line, CRLF line endings and trailing whitespaces are kept
+        with open(self.src, 'wb') as f:
+            f.write(b'void b(int v){ v++; }\r\n')
+        with open(self.dest, 'wb') as f:
+            f.write(b'void a(){}   void b(int v){ v--; }  \r\n// end  \r\n')
+        edit_file(Index.create(), self.src, self.dest, [], oldfile_del=True, print_diagnostics=False)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), b'void a(){}   void b(int v){ v++; }  \r\n// end  \r\n')
+
+    def test_dump_jsonl(self):
+        tu = Index.create().parse(self.dest, ['-std=c++03'])
+        stream = io.StringIO()
+        dump_jsonl(tu.cursor, stream)
+        nodes = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(nodes[0]['kind'], 'TRANSLATION_UNIT')
+        self.assertEqual([n['id'] for n in nodes], list(range(len(nodes))))
+        for node in nodes[1:]:
+            self.assertEqual(nodes[node['parent_id']]['depth'], node['depth'] - 1)
+        self.assertIn({'kind': 'CXX_METHOD', 'parent': 'Src'},
+                      [{'kind': n['kind'], 'parent': n['semantic_parent.displayname']}
+                       for n in nodes if n['spelling'] == 'substract'])
+
+        stream = io.StringIO()
+        dump_jsonl(tu.cursor, stream, maxdepth=1, objname='foo')
+        nodes = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(n['spelling'], n['depth']) for n in nodes], [('foo', 1)])
+
+    def test_dump_fields(self):
+        self.assertEqual(parse_fields('minimal,get_usr,kind'), FIELD_PRESETS['minimal'] + ['get_usr'])
+        with self.assertRaises(ValueError):
+            parse_fields('minimal,no_such_field')
+
+        tu = Index.create().parse(self.dest, ['-std=c++03'])
+        node_info = get_node_info(tu.cursor, fields=['kind', 'spelling'])
+        self.assertEqual(list(node_info), ['kind', 'spelling', 'children'])
+
+        stream = io.StringIO()
+        dump_jsonl(tu.cursor, stream, objname='foo', fields=parse_fields('minimal'))
+        node = json.loads(stream.getvalue())
+        self.assertEqual(set(node), {'id', 'parent_id', 'depth'} | set(FIELD_PRESETS['minimal']))
+
+    def test_compile_commands(self):
+        guts_env = os.environ.copy()
+        guts_env["PATH"] += os.pathsep + os.path.dirname(sys.executable)
+        project_dir = os.path.join(self.tmp_dir, 'project')
+        patch_dir = os.path.join(self.tmp_dir, 'patch')
+        Path(os.path.join(project_dir, 'inc')).mkdir(parents=True)
+        Path(patch_dir).mkdir()
+        files = {os.path.join(project_dir, 'inc', 'lib.h'): 'inline int twice(int a){ return 2*a; }\n',
+                 os.path.join(project_dir, 'a.cpp'): '#include "lib.h"\nint a(){ return twice(1); }\n',
+                 os.path.join(project_dir, 'b.cpp'): '#include "lib.h"\nint b(){ return twice(2); }\n',
+                 os.path.join(patch_dir, 'patch.cpp'): 'inline int twice(int a){ return a+a; }\n'
+                                                       'int b(){ return 0; }\n'}
+        for filename, data in files.items():
+            with open(filename, 'w') as f:
+                f.write(data)
+        with open(os.path.join(project_dir, 'compile_commands.json'), 'w') as f:
+            json.dump([{'directory': project_dir, 'file': name,
+                        'command': f'clang++ -Iinc -std=c++11 -c {name} -o {name}.o'}
+                       for name in ('a.cpp', 'b.cpp')], f)
+
+        proc = subprocess.run(['editcpp', '--compile-commands', project_dir, '--src-dir', patch_dir,
+                               '--project-root', project_dir, '--oldfile-delete', '-std=c++11'],
+                              env=guts_env, stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertIn('2 succeeded, 0 failed', proc.stdout)
+        with open(os.path.join(project_dir, 'inc', 'lib.h')) as f:
+            self.assertEqual(f.read(), 'inline int twice(int a){ return a+a; }\n')
+        with open(os.path.join(project_dir, 'a.cpp')) as f:
+            self.assertEqual(f.read(), files[os.path.join(project_dir, 'a.cpp')])
+        with open(os.path.join(project_dir, 'b.cpp')) as f:
+            self.assertEqual(f.read(), '#include "lib.h"\nint b(){ return 0; }\n')
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+    def test_server(self):
+        socket_path = os.path.join(self.tmp_dir, 'servecpp.sock')
+        server = Server(socket_path)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            # translation units with errors are always reparsed, so the files have to be valid code
+            src = os.path.join(self.tmp_dir, 'src.cpp')
+            dest = os.path.join(self.tmp_dir, 'dest.cpp')
+            with open(src, 'w') as f:
+                f.write('int f(int a){ return a + 2; }\n')
+            with open(dest, 'w') as f:
+                f.write('int g(){ return 0; }\nint f(int a){ return a + 1; }\n')
+            request = {'command': 'edit', 'src_file': src, 'dest_file': dest,
+                       'clang_args': ['-std=c++03'], 'oldfile_delete': True}
+            response = send_request(request, socket_path)
+            self.assertTrue(response['ok'], response['message'])
+            self.assertIn('source parsed, destination parsed', response['message'])
+            with open(dest) as f:
+                self.assertEqual(f.read(), 'int g(){ return 0; }\nint f(int a){ return a + 2; }\n')
+
+            # source TU is reused, destination has been rewritten and is reparsed
+            response = send_request(request, socket_path)
+            self.assertTrue(response['ok'], response['message'])
+            self.assertIn('source reused, destination reparsed', response['message'])
+
+            stream = io.StringIO()
+            response = send_request({'command': 'dump', 'file': self.src, 'clang_args': ['-std=c++03'],
+                                     'object_name': 'foo', 'fields': 'minimal'}, socket_path, stream)
+            self.assertTrue(response['ok'], response['message'])
+            self.assertEqual(json.loads(stream.getvalue())['spelling'], 'foo')
+        finally:
+            send_request({'command': 'shutdown'}, socket_path)
+            thread.join()
+            server.server_close()
+
+    def test_server_missing_include(self):
+        main = os.path.join(self.tmp_dir, 'main.cpp')
+        with open(main, 'w') as f:
+            f.write('#include "missing.h"\nvoid f(){}\n')
+        store = TranslationUnitStore()
+        tu, status = store.get(main, ['-std=c++03'])
+        self.assertEqual(status, 'parsed')
+
+        # the header appears while the main file stays the same
+        with open(os.path.join(self.tmp_dir, 'missing.h'), 'w') as f:
+            f.write('void g();\n')
+        tu, status = store.get(main, ['-std=c++03'])
+        self.assertEqual(status, 'reparsed')
+        self.assertEqual([c.spelling for c in tu.cursor.get_children() if c.location.file], ['g', 'f'])
+        tu, status = store.get(main, ['-std=c++03'])
+        self.assertEqual(status, 'reused')
+
+    def test_server_unsaved_files(self):
+        socket_path = os.path.join(self.tmp_dir, 'servecpp.sock')
+        server = Server(socket_path)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            with open(self.destin) as f:
+                dest_text = '// unsaved\n' * 3 + f.read()
+            with open(self.dest_expected) as f:
+                dest_expected_text = f.read()
+            request = {'command': 'edit', 'src_file': self.src, 'dest_file': self.dest,
+                       'clang_args': ['-std=c++03'], 'oldfile_delete': True,
+                       'unsaved_files': {self.dest: dest_text}}
+            response = send_request(request, socket_path)
+            self.assertTrue(response['ok'], response['message'])
+            self.assertEqual(response['dest_text'], '// unsaved\n' * 3 + dest_expected_text)
+            # nothing is written for unsaved destination
+            with open(self.dest, 'rb') as f:
+                with open(self.destin, 'rb') as fin:
+                    self.assertEqual(f.read(), fin.read())
+
+            # translation units parsed with unsaved content are not reused for the files on disk
+            del request['unsaved_files']
+            response = send_request(request, socket_path)
+            self.assertTrue(response['ok'], response['message'])
+            self.assertIn('source reparsed, destination reparsed', response['message'])
+            self.assertNotIn('dest_text', response)
+            with open(self.dest, 'rb') as f:
+                with open(self.dest_expected, 'rb') as fexpected:
+                    self.assertEqual(f.read(), fexpected.read())
+
+            # file that exists only as unsaved one
+            virtual = os.path.join(self.tmp_dir, 'virtual.h')
+            stream = io.StringIO()
+            response = send_request({'command': 'dump', 'file': virtual, 'clang_args': ['-std=c++03'],
+                                     'unsaved_files': {virtual: 'void baz();\n'},
+                                     'object_name': 'baz', 'fields': 'minimal'}, socket_path, stream)
+            self.assertTrue(response['ok'], response['message'])
+            self.assertEqual(json.loads(stream.getvalue())['spelling'], 'baz')
+        finally:
+            send_request({'command': 'shutdown'}, socket_path)
+            thread.join()
+            server.server_close()
+
+    def test_edit_text(self):
+        with open(self.srcin) as f:
+            src_text = f.read()
+        with open(self.destin) as f:
+            dest_text = f.read()
+        with open(self.dest_expected) as f:
+            dest_expected_text = f.read()
+
+        # files don't exist: texts are passed to libclang as unsaved files
+        src_filename = os.path.join(self.tmp_dir, 'virtual', 'src.h')
+        dest_filename = os.path.join(self.tmp_dir, 'virtual', 'dest.h')
+        patched_text, spans = edit_text(src_text, dest_text, ['-std=c++03'], src_filename, dest_filename)
+        self.assertEqual(patched_text, dest_expected_text)
+        self.assertEqual(len(spans), 4)
+        self.assertFalse(os.path.exists(os.path.dirname(src_filename)))
+
+        patched_data, _ = edit_text(src_text.encode(), dest_text.encode(), ['-std=c++03'],
+                                    src_filename, dest_filename)
+        self.assertEqual(patched_data, dest_expected_text.encode())
+
+    def test_benchmark_corpus(self):
+        corpus_dir = os.path.join(self.tmp_dir, 'corpus')
+        corpus = generate_corpus(corpus_dir, nclasses=4, nmethods=6, nnamespaces=2, out_of_class=2, include_depth=3)
+        self.assertEqual(len(corpus['headers']), 3)
+
+        index = Index.create()
+        edit_file(index, corpus['src'], corpus['dest'], ['-std=c++11'], oldfile_del=True,
+                  print_diagnostics=False, cache_dir=None)
+        with open(corpus['src']) as f_src, open(corpus['dest']) as f_dest:
+            self.assertEqual(f_dest.read(), f_src.read())
+
+        report = run_benchmarks({'nclasses': 2, 'nmethods': 2}, repeat=1, scenarios=['parse', 'splicing'],
+                                workdir=os.path.join(self.tmp_dir, 'benchmark'))
+        self.assertEqual([r['scenario'] for r in report['results']], ['parse', 'splicing'])
+        self.assertEqual(report['meta']['corpus']['ndefinitions'], 4)
+
+    def test_profile(self):
+        stream = io.StringIO()
+        pstats_file = os.path.join(self.tmp_dir, 'editcpp.pstats')
+        with profiling.profile('json', stream, pstats_file):
+            edit_file(Index.create(), self.src, self.dest, ['-std=c++03'], oldfile_del=True,
+                      print_diagnostics=False, cache_dir=None)
+        self.assertIsNone(profiling.get_profiler())
+        self.assertTrue(os.path.isfile(pstats_file))
+        report = json.loads(stream.getvalue())
+        for phase in ('parse', 'find_definitions', 'matching', 'splice', 'write'):
+            self.assertIn(phase, report['phases'])
+        self.assertEqual(report['phases']['parse']['calls'], 2)
+        self.assertEqual(report['counters']['comparisons'], 4)
+        self.assertEqual(report['counters']['bytes_written'], os.path.getsize(self.dest))
+        self.assertGreater(report['counters']['cursors_visited'], report['counters']['definitions_found'])
+        self.assertGreater(report['counters']['libclang_calls'], 0)
+
+        # disabled profiling doesn't collect anything
+        with profiling.profile(None) as profiler:
+            self.assertIsNone(profiler)
+            profiling.count('cursors_visited')
+
+    def test_pch(self):
+        common = os.path.join(self.tmp_dir, 'common.hpp')
+        with open(common, 'w') as f:
+            f.write('#ifndef COMMON_HPP\n#define COMMON_HPP\nstruct Common { int x; };\n#endif\n')
+        src = os.path.join(self.tmp_dir, 'src.hpp')
+        dest = os.path.join(self.tmp_dir, 'dest.hpp')
+        with open(src, 'w') as f:
+            f.write('#include "common.hpp"\nstruct A { int f() { return Common{2}.x; } };\n')
+        with open(dest, 'w') as f:
+            f.write('#include "common.hpp"\nstruct A { int f() { return Common{1}.x; } };\n')
+
+        cache_dir = os.environ['CPPGUTS_CACHE_DIR']
+        index = Index.create()
+        tucache._pch_files.clear()
+        edit_file(index, src, dest, ['-std=c++11'], oldfile_del=True, print_diagnostics=False,
+                  cache_dir=cache_dir, pch_headers=[common])
+        with open(dest) as f:
+            self.assertIn('Common{2}', f.read())
+        pch_args = get_pch_args(index, [common], ['-std=c++11'], '.hpp', cache_dir)
+        self.assertEqual(pch_args[0], '-include-pch')
+        self.assertTrue(os.path.isfile(pch_args[1]))
+
+        # PCH is reused by the next run and rebuilt once the header changes
+        tucache._pch_files.clear()
+        self.assertEqual(get_pch_args(index, [common], ['-std=c++11'], '.hpp', cache_dir), pch_args)
+        with open(common, 'w') as f:
+            f.write('#ifndef COMMON_HPP\n#define COMMON_HPP\nstruct Common { int x, y; };\n#endif\n')
+        tucache._pch_files.clear()
+        new_pch_args = get_pch_args(index, [common], ['-std=c++11'], '.hpp', cache_dir)
+        self.assertNotEqual(new_pch_args[1], pch_args[1])
+        tu, _ = parse_tu(index, dest, ['-std=c++11'], cache_dir=cache_dir, pch_headers=[common])
+        self.assertEqual(list(tu.get_includes()), [])
+
+        # PCH metadata and umbrella headers are accounted and evicted together with PCHs
+        names = os.listdir(cache_dir)
+        self.assertTrue(any(name.endswith('.pch.json') for name in names))
+        self.assertTrue(any(name.endswith('_pch.hpp') for name in names))
+        entries = tucache.get_cache_entries(cache_dir)
+        self.assertEqual(sum(size for _, size, _ in entries),
+                         sum(os.path.getsize(os.path.join(cache_dir, name)) for name in names))
+        tucache.evict(cache_dir, 0)
+        self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_check_diff(self):
+        index = Index.create()
+        with open(self.dest, 'rb') as f:
+            destdata = f.read()
+        changed, report = edit_file(index, self.src, self.dest, ['-std=c++03'], print_diagnostics=False,
+                                    mode='check')
+        self.assertEqual(len(changed), len(report.splitlines()))
+        self.assertTrue(report.startswith(self.dest + ':'))
+        changed, report = edit_file(index, self.src, self.dest, ['-std=c++03'], print_diagnostics=False,
+                                    mode='diff')
+        self.assertIn('--- ' + self.dest, report)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), destdata)
+
+        edit_file(index, self.src, self.dest, ['-std=c++03'], print_diagnostics=False)
+        backups = [f for f in os.listdir(self.tmp_dir) if f.startswith('dest_OLD')]
+        self.assertEqual(backups, ['dest_OLD.h'])
+        with open(os.path.join(self.tmp_dir, 'dest_OLD.h'), 'rb') as f:
+            self.assertEqual(f.read(), destdata)
+
+        # nothing differs: destination isn't touched and no backup is created
+        mtime = os.stat(self.dest).st_mtime_ns
+        changed, report = edit_file(index, self.src, self.dest, ['-std=c++03'], print_diagnostics=False)
+        self.assertEqual((changed, report), ([], ''))
+        self.assertEqual(os.stat(self.dest).st_mtime_ns, mtime)
+        self.assertEqual(len([f for f in os.listdir(self.tmp_dir) if f.startswith('dest_OLD')]), 1)
+        self.assertEqual(edit_file(index, self.src, self.dest, ['-std=c++03'], print_diagnostics=False,
+                                   mode='diff'), ([], ''))
+
+    def test_many_dest_files(self):
+        with open(self.dest_expected, 'rb') as f:
+            dest_expected = f.read()
+        vendor_dir = os.path.join(self.tmp_dir, 'vendor')
+        dests = [os.path.join(vendor_dir, d, 'dest.h') for d in ('a', 'b', 'c')]
+        for dest in dests:
+            Path(os.path.dirname(dest)).mkdir(parents=True)
+            shutil.copy(self.destin, dest)
+        results = edit_files(self.src, dests[:2], ['-std=c++03'], oldfile_del=True, jobs=2)
+        self.assertEqual([(r['ok'], r['changed']) for r in results], [(True, 4), (True, 4)])
+        for dest in dests[:2]:
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), dest_expected)
+
+        # glob is expanded by the CLI, already patched files stay untouched
+        p = subprocess.run([sys.executable, '-m', 'cppguts.editcpp', '--src-file', self.src,
+                            '--dest-file', os.path.join(vendor_dir, '**', 'dest.h'), '--oldfile-delete',
+                            '--no-cache', '-std=c++03'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        self.assertIn('3 succeeded, 0 failed (2 unchanged)', p.stdout)
+        with open(dests[2], 'rb') as f:
+            self.assertEqual(f.read(), dest_expected)
+
+    def test_symbol_index(self):
+        index_file = os.path.join(self.tmp_dir, 'symbols.sqlite')
+        dest = os.path.join(self.tmp_dir, 'dest.hpp')
+        shutil.copy(self.destin, dest)
+        entries = [{'file': dest, 'clang_args': ['-std=c++03']}]
+        stats = update_index(index_file, entries, self.tmp_dir, jobs=1)
+        self.assertEqual((stats['indexed'], stats['up_to_date'], stats['errors']), (1, 0, []))
+        # nothing changed: nothing is parsed
+        self.assertEqual(update_index(index_file, entries, self.tmp_dir, jobs=1)['up_to_date'], 1)
+
+        symbols = query_symbols(index_file, name='substract', kinds=['CXX_METHOD'])
+        self.assertEqual([(s['parent'], s['start_line'], s['end_line']) for s in symbols],
+                         [('SrcPrivate', 12, 14), ('Src', 36, 38)])
+        self.assertEqual([s['spelling'] for s in query_symbols(index_file, regex='^(foo|ba)')], ['foo', 'bar'])
+        self.assertEqual(query_symbols(index_file, kinds=['FUNCTION_DECL'], filename=self.dest), [])
+
+        with open(dest, 'a') as f:
+            f.write('void baz(){}\n')
+        self.assertEqual(update_index(index_file, entries, self.tmp_dir, jobs=1)['indexed'], 1)
+        self.assertEqual(len(query_symbols(index_file, regex='^ba')), 2)
+
+        p = subprocess.run([sys.executable, '-m', 'cppguts.dumpcpp', '--index', index_file,
+                            '--object-name', 'baz', '--jsonl'], stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        self.assertEqual(json.loads(p.stdout)['file'], dest)
+
+        os.remove(dest)
+        self.assertEqual(update_index(index_file, [], self.tmp_dir)['removed'], 1)
+        self.assertEqual(query_symbols(index_file), [])
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint(b'void foo(int &v){\n  v -= 10;\n}'),
+                         fingerprint(b'void foo(int &v)\n{\n  // comment\n  v  -=  10; /* { */\n}'))
+        self.assertNotEqual(fingerprint(b'void foo(int &v){ v -= 10; }'), fingerprint(b'void foo(int &v){ v -= 1; }'))
+        self.assertNotEqual(fingerprint(b's = "a b";'), fingerprint(b's = "a  b";'))
+        # punctuators are split by maximal munch, whitespaces between them are significant
+        self.assertNotEqual(fingerprint(b'y = x++ +1;'), fingerprint(b'y = x+ + +1;'))
+        self.assertNotEqual(fingerprint(b'c = a<=b;'), fingerprint(b'c = a < = b;'))
+        self.assertEqual(fingerprint(b'c = a<=b;'), fingerprint(b'c = a <= b;'))
+        patched_text, spans = edit_text('int f(int x){ return --x; }', 'int f(int x){ return - -x; }',
+                                        ['-std=c++03'])
+        self.assertEqual(patched_text, 'int f(int x){ return --x; }')
+        self.assertEqual(len(spans), 1)
+
+        # `foo` differs only in formatting, `bar` has drifted
+        with open(self.dest_expected, 'rb') as f:
+            dest_expected = f.read()
+        dest = os.path.join(self.tmp_dir, 'drift.hpp')
+        destdata = (dest_expected.replace(b'v -= 10;', b'v -= 10; // already patched')
+                    .replace(b'v += 10;', b'v += 11;'))
+        with open(dest, 'wb') as f:
+            f.write(destdata)
+        src = os.path.join(self.tmp_dir, 'src.hpp')
+        shutil.copy(self.src, src)
+        changed, report = edit_file(Index.create(), src, dest, ['-std=c++03'], print_diagnostics=False,
+                                    mode='drift')
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(report.splitlines(), [f'{dest}:49: void bar(int &v){{',
+                                               f'{dest}: 1 of 4 definition(s) drifted from the source'])
+        edit_file(Index.create(), src, dest, ['-std=c++03'], oldfile_del=True, print_diagnostics=False)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), destdata.replace(b'v += 11;', b'v += 10;'))
+
+    def test_concurrent_parse_diagnostics(self):
+        code = os.path.join(self.tmp_dir, 'diag.cpp')
+        with open(code, 'w') as f:
+            f.write('int f() { return undeclared << 1; }\nint g() { return 1 << 40; }\n')
+        (tu_src, diag_src), (tu_dest, diag_dest) = parse_concurrently(
+            Index.create(), lambda index: parse_tu(index, self.src, ['-std=c++03']),
+            lambda index: parse_tu(index, code, ['-std=c++03']))
+        self.assertEqual((tu_src.spelling, tu_dest.spelling), (self.src, code))
+        self.assertIsInstance(diag_dest, DiagnosticsInfo)
+        self.assertEqual([d['severity'] for d in diag_dest], [Diagnostic.Error, Diagnostic.Warning])
+        self.assertEqual(select_diagnostics(diag_dest, Diagnostic.Error), [diag_dest[0]])
+
+        # diagnostics of the cached translation unit are filtered the same way
+        with open(code, 'w') as f:
+            f.write('int g() { return 1 << 40; }\n')
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        parse_tu(Index.create(), code, ['-std=c++03'], cache_dir=cache_dir)
+        _, diag_cached = parse_tu(Index.create(), code, ['-std=c++03'], cache_dir=cache_dir)
+        self.assertIsInstance(diag_cached, list)
+        self.assertEqual(len(select_diagnostics(diag_cached, Diagnostic.Warning)), 1)
+        self.assertEqual(select_diagnostics(diag_cached, Diagnostic.Error), [])
+
+    def test_bounded_memory(self):
+        data = b'0123456789' * 10
+        spans = [(10, 20, b'abc'), (0, 5, b''), (95, 100, b'xyz')]
+        stream = io.BytesIO()
+        self.assertEqual(write_spans(stream, data, spans, chunk_size=7), len(apply_spans(data, spans)))
+        self.assertEqual(stream.getvalue(), apply_spans(data, spans))
+
+        # peak Python memory doesn't depend on the size of destination file
+        report = run_memory_benchmark(1024 * 1024, nfunctions=3, scenarios=['write', 'check', 'lexer_only'],
+                                      workdir=os.path.join(self.tmp_dir, 'memory'))
+        self.assertEqual([r['scenario'] for r in report['results']], ['write', 'check', 'lexer_only'])
+        for result in report['results'][:2]:
+            self.assertLess(result['peak_to_file_size'], 0.25)
+        # lexer-only mode keeps the decoded file, not its tokens
+        self.assertLess(report['results'][2]['peak_to_file_size'], 1.5)
+
+    def test_lexer_only(self):
+        with open(self.dest_expected, 'rb') as f:
+            dest_expected = f.read()
+        changed, _ = edit_file(None, self.src, self.dest, [], oldfile_del=True, lexer_only=True)
+        self.assertEqual(len(changed), 4)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), dest_expected)
+
+        # keys and extents are the same as the ones found by libclang (except for virtual/static)
+        tu = Index.create().parse(self.destin, ['-x', 'c++'])
+        nodes = []
+        find_method_def_nodes(tu.cursor, nodes, self.destin)
+        with open(self.destin, 'rb') as f:
+            records = find_lexical_definitions(f.read())
+        self.assertEqual([(key[:3] + key[5:], start, end) for key, start, end, _ in records],
+                         [(get_method_signature_key(n)[:3] + get_method_signature_key(n)[5:],
+                           n.extent.start.offset, n.extent.end.offset) for n in nodes])
+
+        code = (b'#define M(x) { x }\n'
+                b'namespace ns { /* { */ class A : B {\n'
+                b'public:\n'
+                b'  A(int a) : a_{a} { }\n'
+                b'  bool operator==(const A &o) const { return "}" != 0; }\n'
+                b'  auto f(int x = 1) -> int { auto l = [](int y) { return y; }; return l(x); }\n'
+                b'  operator bool() const { return true; }\n'
+                b'};\n'
+                b'int A::g(const char *name) const { return 0; }\n'
+                b'}\n')
+        records = find_lexical_definitions(code)
+        self.assertEqual([key[5:] for key, _, _, _ in records],
+                         [('operator==', 'bool (const A &) const', 'A'),
+                          ('f', 'int (int)', 'A'),
+                          ('g', 'int (const char *) const', 'A')])
+        self.assertEqual([line for _, _, _, line in records], [5, 6, 9])
+
+        # bodies and data tables are skipped without tokenizing them: braces in literals, comments
+        # and directives don't count, digit separators aren't character literals
+        code = (b'static const int table[] = { 1\'000, \'{\', 0x7f };\n'
+                b'int f() { const char *s = "}"; auto r = R"x(})x"; // }\n'
+                b'#define CLOSE }\n'
+                b'  return u\'}\' + 1\'0; }\n'
+                b'int g() { return 0; }\n')
+        records = find_lexical_definitions(code)
+        self.assertEqual([key[5] for key, _, _, _ in records], ['f', 'g'])
+        self.assertEqual(code[records[0][1]:records[0][2]].splitlines()[-1], b"  return u'}' + 1'0; }")
+
+        # linkage specifications, macros, arithmetic types, cv-qualifiers and function pointers
+        # are spelled like libclang does
+        code = (b'#define API __attribute__((visibility("default")))\n'
+                b'struct Foo { int x; };\n'
+                b'API int f1(int a) { return a; }\n'
+                b'extern "C" int f2() { return 0; }\n'
+                b'unsigned f3(unsigned a, long unsigned int b, short int c, signed char d) { return 0; }\n'
+                b'int f4(int (*cb)(int a), int (&arr)[3], int v[2], int g(int)) { return 0; }\n'
+                b'void f5(const Foo, Foo const &b, char **p, char *const q, const char* const* r) {}\n'
+                b'static const char *f6() { return 0; }\n')
+        source = os.path.join(self.tmp_dir, 'lexer.cpp')
+        with open(source, 'wb') as f:
+            f.write(code)
+        tu = Index.create().parse(source, ['-std=c++11'])
+        nodes = []
+        find_method_def_nodes(tu.cursor, nodes, source)
+        records = find_lexical_definitions(code)
+        self.assertEqual([key[:3] + key[5:] for key, _, _, _ in records],
+                         [get_method_signature_key(n)[:3] + get_method_signature_key(n)[5:] for n in nodes])
+        # macros are not a part of the extent
+        self.assertEqual(code[records[0][1]:records[0][2]], b'int f1(int a) { return a; }')
+        self.assertEqual(code[records[1][1]:records[1][2]], b'int f2() { return 0; }')
@@ -0,0 +1,500 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import warnings
+
+from collections.abc import Sequence
+from clang.cindex import (Diagnostic, Index, TranslationUnit, TranslationUnitLoadError, TranslationUnitSaveError,
+                          conf, _CXString)
+from cppguts import profiling
+
+
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+# PCH files built or validated during this run: PCH key -> PCH file name (None if it can't be built)
+_pch_files = {}
+_pch_tmpdir = None
+
+
+def get_diag_info(diag):
+    return {'severity': diag.severity,
+            'location': diag.location,
+            'category_name': diag.category_name,
+            'spelling': diag.spelling,
+            'ranges': diag.ranges,
+            'fixits': diag.fixits}
+
+
+# names of the severities accepted by `--diagnostics-severity`
+DIAGNOSTIC_SEVERITIES = {'ignored': Diagnostic.Ignored,
+                         'note': Diagnostic.Note,
+                         'warning': Diagnostic.Warning,
+                         'error': Diagnostic.Error,
+                         'fatal': Diagnostic.Fatal}
+
+
+class DiagnosticsInfo(Sequence):
+    '''
+    Diagnostics info of parsed translation unit. Info of a diagnostic is built only when it is accessed,
+    so nothing is evaluated for the diagnostics that are not printed.
+    '''
+    def __init__(self, tu: TranslationUnit):
+        self._diagnostics = tu.diagnostics
+        self._infos = {}
+
+    def __len__(self):
+        return len(self._diagnostics)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('diagnostic index out of range')
+        info = self._infos.get(i)
+        if info is None:
+            info = self._infos[i] = get_diag_info(self._diagnostics[i])
+        return info
+
+    def select(self, min_severity: int) -> list:
+        '''
+        :param min_severity: severity threshold (e.g. `Diagnostic.Warning`)
+        :return: diagnostics - list of diagnostics info with severity not less than `min_severity`
+        '''
+        return [self[i] for i in range(len(self)) if self._diagnostics[i].severity >= min_severity]
+
+
+def has_errors(tu: TranslationUnit) -> bool:
+    '''
+    Translation unit with errors may depend on the files that don't exist yet (`'foo.h' file not found`),
+    they are not recorded among its includes so it can't be told whether it is up to date.
+    :return: True if translation unit has diagnostics with `Error` or `Fatal` severity
+    '''
+    return any(diag.severity >= Diagnostic.Error for diag in tu.diagnostics)
+
+
+def select_diagnostics(diagnostics, min_severity: int = Diagnostic.Ignored) -> list:
+    '''
+    Select diagnostics by severity, only the selected ones are evaluated.
+    :param diagnostics: diagnostics as returned by `parse_tu` (`DiagnosticsInfo` or list of dict)
+    :param min_severity: severity threshold (e.g. `Diagnostic.Warning`)
+    :return: diagnostics - list of diagnostics info
+    '''
+    if isinstance(diagnostics, DiagnosticsInfo):
+        return diagnostics.select(min_severity)
+    return [diag for diag in diagnostics if diag['severity'] >= min_severity]
+
+
+def add_diagnostics_arguments(parser):
+    '''
+    Add `--diagnostics-severity` option to the argument parser.
+    '''
+    parser.add_argument('--diagnostics-severity', dest='diagnostics_severity', action='store',
+                        choices=tuple(DIAGNOSTIC_SEVERITIES), default='warning',
+                        help='print only clang diagnostics of this severity or higher (default: %(default)s)')
+
+
+def get_diag_info_serializable(diag) -> dict:
+    '''
+    Same as `get_diag_info` but libclang objects are converted to `str`
+    so the result may be stored as JSON.
+    :param diag: clang diagnostic
+    :return: diag_info - dict with diagnostic information
+    '''
+    return {'severity': diag.severity,
+            'location': str(diag.location),
+            'category_name': diag.category_name,
+            'spelling': diag.spelling,
+            'ranges': [str(r) for r in diag.ranges],
+            'fixits': [str(f) for f in diag.fixits]}
+
+
+def default_cache_dir() -> str:
+    '''
+    Get cache directory: `CPPGUTS_CACHE_DIR` env variable if set,
+    otherwise `$XDG_CACHE_HOME/cppguts` or `~/.cache/cppguts`.
+    :return: cache_dir - path to the cache directory (may not exist yet)
+    '''
+    cache_dir = os.environ.get('CPPGUTS_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'cppguts')
+
+
+def file_hash(filename: str) -> str:
+    '''
+    Calculate sha256 of the file content.
+    :param filename: file to be hashed
+    :return: hexdigest
+    '''
+    h = hashlib.sha256()
+    with open(filename, mode='rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_file_record(filename: str) -> list:
+    '''
+    Get file record that is used to check whether the file was changed.
+    :param filename: file name
+    :return: record - [abspath, size, mtime_ns, sha256]
+    '''
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_size, st.st_mtime_ns, file_hash(filename)]
+
+
+def is_file_record_valid(record: list) -> bool:
+    '''
+    Check that the file didn't change since the record was taken.
+    Size and mtime are checked first, content hash is calculated only if they differ.
+    :param record: record as returned by `get_file_record`
+    :return: True if the file content is the same
+    '''
+    filename, size, mtime_ns, sha = record
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+    if st.st_size != size:
+        return False
+    if st.st_mtime_ns == mtime_ns:
+        return True
+    return file_hash(filename) == sha
+
+
+def get_libclang_version() -> str:
+    '''
+    Get libclang version string (serialized AST is bound to the libclang version).
+    :return: version - e.g. `clang version 12.0.0`
+    '''
+    func = conf.lib.clang_getClangVersion
+    # python bindings don't register this function so we have to set result type ourselves
+    func.restype = _CXString
+    func.errcheck = _CXString.from_result
+    return func()
+
+
+def get_cache_key(filename: str, clangcmd: list, options: int = 0) -> str:
+    '''
+    Calculate cache key of a translation unit. Key depends on the main file path and content,
+    clang arguments, parse options, working directory (relative `-I` paths) and libclang version.
+    The transitive include set is verified separately when the entry is loaded.
+    :param filename: main file of translation unit
+    :param clangcmd: list of clang arguments (without file name)
+    :param options: parse options
+    :return: key - hexdigest
+    '''
+    key_data = [os.path.abspath(filename), file_hash(filename), list(clangcmd), options,
+                os.getcwd(), get_libclang_version()]
+    return hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+
+# cache files: translation unit `<key>.ast` with its `<key>.json` metadata, PCH `<key>-<digest>.pch`
+# with its `<key>.pch.json` metadata and `<key>_pch<ext>` umbrella header
+_CACHE_FILE_RE = re.compile(r'^([0-9a-f]{64})(\.ast|\.json|-[0-9a-f]+\.pch|\.pch\.json|_pch\.[^.]+)$')
+
+
+def get_cache_entries(cache_dir: str) -> list:
+    '''
+    Group cache files into entries that are evicted together: translation unit with its metadata or
+    all the PCH versions of the same key with their metadata and umbrella header.
+    :param cache_dir: cache directory
+    :return: entries - list of (mtime, size, files) tuples, mtime is the latest mtime
+    of `.ast`/`.pch` files of the entry (of all its files if there are none)
+    '''
+    entries = {}    # (key, is PCH) -> [mtime of `.ast`/`.pch` files, mtime of all files, size, files]
+    for name in os.listdir(cache_dir):
+        match = _CACHE_FILE_RE.match(name)
+        if not match:
+            continue
+        key, suffix = match.groups()
+        filename = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        is_pch = suffix.endswith('.pch') or suffix.startswith(('.pch', '_pch'))
+        entry = entries.setdefault((key, is_pch), [0, 0, 0, []])
+        if suffix == '.ast' or suffix.endswith('.pch'):
+            entry[0] = max(entry[0], st.st_mtime)
+        entry[1] = max(entry[1], st.st_mtime)
+        entry[2] += st.st_size
+        entry[3].append(filename)
+    return [(mtime or all_mtime, size, files) for mtime, all_mtime, size, files in entries.values()]
+
+
+def evict(cache_dir: str, max_size: int):
+    '''
+    Remove least recently used entries until cache size is not greater than `max_size`.
+    :param cache_dir: cache directory
+    :param max_size: max cache size in bytes
+    '''
+    entries = get_cache_entries(cache_dir)
+    total_size = sum(size for _, size, _ in entries)
+    entries.sort(key=lambda entry: entry[0])
+    for _, size, files in entries:
+        if total_size <= max_size:
+            break
+        # metadata first so that the entry is never loaded without its data
+        for f in sorted(files, key=lambda f: not f.endswith('.json')):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        total_size -= size
+
+
+def load_tu(index: Index, cache_dir: str, key: str) -> (TranslationUnit, list):
+    '''
+    Load translation unit from the cache.
+    :param index: clang index
+    :param cache_dir: cache directory
+    :param key: cache key as returned by `get_cache_key`
+    :return: tu, diagnostics - (None, None) if there is no valid entry
+    '''
+    astfile = os.path.join(cache_dir, key + '.ast')
+    metafile = os.path.join(cache_dir, key + '.json')
+    try:
+        with open(metafile, mode='r') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None, None
+
+    if not all(is_file_record_valid(record) for record in meta['files']):
+        return None, None
+
+    try:
+        tu = TranslationUnit.from_ast_file(astfile, index)
+    except TranslationUnitLoadError:
+        return None, None
+
+    # update access time for LRU eviction
+    try:
+        os.utime(astfile)
+    except OSError:
+        pass
+    return tu, meta['diagnostics']
+
+
+def save_tu(tu: TranslationUnit, cache_dir: str, key: str, max_size: int = DEFAULT_CACHE_SIZE):
+    '''
+    Save translation unit to the cache together with the records of all the files
+    it depends on and its diagnostics (they are not serialized by libclang).
+    :param tu: translation unit
+    :param cache_dir: cache directory
+    :param key: cache key as returned by `get_cache_key`
+    :param max_size: max cache size in bytes
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    files = [get_file_record(tu.spelling)]
+    for include in tu.get_includes():
+        if include.include and os.path.isfile(include.include.name):
+            files.append(get_file_record(include.include.name))
+    meta = {'files': files,
+            'diagnostics': [get_diag_info_serializable(d) for d in tu.diagnostics]}
+
+    # write to temp files and then replace so that concurrent runs never see partial entry
+    fd, tmp_astfile = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    os.close(fd)
+    try:
+        tu.save(tmp_astfile)
+        os.replace(tmp_astfile, os.path.join(cache_dir, key + '.ast'))
+    except Exception:
+        os.remove(tmp_astfile)
+        raise
+    fd, tmp_metafile = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    with os.fdopen(fd, mode='w') as file:
+        json.dump(meta, file)
+    os.replace(tmp_metafile, os.path.join(cache_dir, key + '.json'))
+
+    evict(cache_dir, max_size)
+
+
+def get_pch_include(header: str) -> str:
+    '''
+    Get include directive for the PCH header: existing files are included by absolute path,
+    other names (like `iostream`) are searched in include directories.
+    :param header: file name or name of system header
+    :return: directive - `#include` line
+    '''
+    if os.path.isfile(header):
+        return f'#include "{os.path.abspath(header)}"'
+    return f'#include <{header}>'
+
+
+def get_pch_key(headers: list, clangcmd: list, extension: str) -> str:
+    '''
+    Calculate key of a PCH. PCH may be used only by translation units of the same language
+    (defined by file extension) parsed with the same arguments.
+    :param headers: list of headers to be precompiled
+    :param clangcmd: list of clang arguments (without file name)
+    :param extension: extension of translation unit main file
+    :return: key - hexdigest
+    '''
+    key_data = [[get_pch_include(h) for h in headers], list(clangcmd), extension.lower(),
+                os.getcwd(), get_libclang_version()]
+    return hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+
+def load_pch(cache_dir: str, key: str) -> str:
+    '''
+    Get PCH from the cache if none of the headers it consists of changed.
+    :param cache_dir: cache directory
+    :param key: PCH key as returned by `get_pch_key`
+    :return: pchfile - PCH file name or None if there is no valid entry
+    '''
+    try:
+        with open(os.path.join(cache_dir, key + '.pch.json'), mode='r') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    pchfile = os.path.join(cache_dir, meta['pch'])
+    if not os.path.isfile(pchfile) or not all(is_file_record_valid(record) for record in meta['files']):
+        return None
+
+    # update access time for LRU eviction
+    try:
+        os.utime(pchfile)
+    except OSError:
+        pass
+    return pchfile
+
+
+def build_pch(index: Index, headers: list, clangcmd: list, extension: str, cache_dir: str, key: str,
+              max_size: int = DEFAULT_CACHE_SIZE) -> str:
+    '''
+    Precompile headers and save PCH to the cache. PCH file name depends on the content of all
+    the headers it consists of so translation units cached with the old PCH are never reused.
+    :param index: clang index
+    :param headers: list of headers to be precompiled
+    :param clangcmd: list of clang arguments (without file name)
+    :param extension: extension of translation unit main file
+    :param cache_dir: cache directory
+    :param key: PCH key as returned by `get_pch_key`
+    :param max_size: max cache size in bytes
+    :return: pchfile - PCH file name or None if headers can't be precompiled
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    umbrella = os.path.join(cache_dir, key + '_pch' + extension)
+    with open(umbrella, mode='w') as file:
+        file.write('\n'.join(get_pch_include(h) for h in headers) + '\n')
+
+    try:
+        tu = index.parse(umbrella, list(clangcmd), options=TranslationUnit.PARSE_INCOMPLETE)
+    except TranslationUnitLoadError:
+        tu = None
+    errors = [str(d) for d in tu.diagnostics if d.severity >= Diagnostic.Error] if tu else ['unable to parse']
+    if errors:
+        warnings.warn("unable to precompile headers, files are parsed without PCH:\n" + '\n'.join(errors),
+                      RuntimeWarning)
+        return None
+
+    files = []
+    for include in tu.get_includes():
+        if include.include and os.path.isfile(include.include.name):
+            files.append(get_file_record(include.include.name))
+    digest = hashlib.sha256(json.dumps([record[3] for record in files]).encode('utf-8')).hexdigest()
+    pchfile = os.path.join(cache_dir, f'{key}-{digest[:16]}.pch')
+
+    fd, tmp_pchfile = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    os.close(fd)
+    try:
+        tu.save(tmp_pchfile)
+        os.replace(tmp_pchfile, pchfile)
+    except TranslationUnitSaveError:
+        os.remove(tmp_pchfile)
+        warnings.warn("unable to save PCH, files are parsed without PCH", RuntimeWarning)
+        return None
+    fd, tmp_metafile = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    with os.fdopen(fd, mode='w') as file:
+        json.dump({'pch': os.path.basename(pchfile), 'files': files}, file)
+    os.replace(tmp_metafile, os.path.join(cache_dir, key + '.pch.json'))
+
+    evict(cache_dir, max_size)
+    return pchfile
+
+
+def get_pch_args(index: Index, headers: list, clangcmd: list, extension: str = '.cpp',
+                 cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE) -> list:
+    '''
+    Get clang arguments that make translation unit use PCH of the common headers.
+    PCH is built once and then reused for the rest of the run and by the next runs until the headers change.
+    Headers must have include guards (or `#pragma once`) as translation units usually include them again.
+    :param index: clang index
+    :param headers: list of headers to be precompiled (file names or names like `iostream`)
+    :param clangcmd: list of clang arguments (without file name) translation units are parsed with
+    :param extension: extension of translation unit main file (it defines the language)
+    :param cache_dir: cache directory, `None` means PCH is kept in temporary directory until the end of the run
+    :param cache_size: max cache size in bytes
+    :return: args - `-include-pch` arguments or empty list if headers can't be precompiled
+    '''
+    global _pch_tmpdir
+    key = get_pch_key(headers, clangcmd, extension)
+    if key not in _pch_files:
+        if not cache_dir:
+            if not _pch_tmpdir:
+                _pch_tmpdir = tempfile.mkdtemp(prefix='cppguts_pch_')
+                atexit.register(shutil.rmtree, _pch_tmpdir, True)
+            cache_dir = _pch_tmpdir
+        with profiling.phase('pch'):
+            _pch_files[key] = (load_pch(cache_dir, key) or
+                               build_pch(index, headers, clangcmd, extension, cache_dir, key, cache_size))
+    if not _pch_files[key]:
+        return []
+    return ['-include-pch', _pch_files[key]]
+
+
+def parse_tu(index: Index, filename: str, clangcmd: list, options: int = 0,
+             cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE,
+             pch_headers: list = None) -> (TranslationUnit, list):
+    '''
+    Parse translation unit or load it from the cache if nothing changed since the last parse.
+    Translation units with errors are not cached (see `has_errors`).
+    :param index: clang index
+    :param filename: main file of translation unit
+    :param clangcmd: list of clang arguments (without file name)
+    :param options: parse options
+    :param cache_dir: cache directory, `None` disables the cache
+    :param cache_size: max cache size in bytes
+    :param pch_headers: list of common headers to be precompiled and used by the translation unit
+    :return: tu, diagnostics - translation unit and diagnostics info (`DiagnosticsInfo` that builds the info
+    on access or list of dict if translation unit is loaded from the cache)
+    '''
+    pch_args = []
+    if pch_headers:
+        pch_args = get_pch_args(index, pch_headers, clangcmd, os.path.splitext(filename)[1],
+                                cache_dir, cache_size)
+        clangcmd = list(clangcmd) + pch_args
+
+    key = None
+    if cache_dir:
+        key = get_cache_key(filename, clangcmd, options)
+        tu, diagnostics = load_tu(index, cache_dir, key)
+        if tu:
+            return tu, diagnostics
+
+    try:
+        tu = index.parse(None, list(clangcmd) + [filename], options=options)
+    except TranslationUnitLoadError:
+        if not pch_args:
+            raise
+        # PCH is incompatible with the translation unit (e.g. language mismatch)
+        warnings.warn(f"unable to use PCH for {filename}, it is parsed without PCH", RuntimeWarning)
+        clangcmd = clangcmd[:-len(pch_args)]
+        tu = index.parse(None, list(clangcmd) + [filename], options=options)
+    diagnostics = DiagnosticsInfo(tu)
+    if key and not has_errors(tu):
+        try:
+            save_tu(tu, cache_dir, key, cache_size)
+        except (TranslationUnitSaveError, OSError):
+            # cache dir isn't writable (or clang fails to save the TU): just don't cache it
+            pass
+    return tu, diagnostics
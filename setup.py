@@ -33,7 +33,10 @@ setuptools.setup(
     keywords='c cpp c-parser cpp-parser c-editor cpp-editor c-generator cpp-generator',
     entry_points={
         'console_scripts': ['editcpp=cppguts.editcpp:main',
-                            'dumpcpp=cppguts.dumpcpp:main']
+                            'dumpcpp=cppguts.dumpcpp:main',
+                            'indexcpp=cppguts.indexcpp:main',
+                            'servecpp=cppguts.servecpp:main',
+                            'servecpp-client=cppguts.servecpp:client_main']
     },
     python_requires='>=3',
     install_requires=[